@@ -1,5 +1,5 @@
 import os 
-from raypyng_bluesky.RaypyngOphydDevices import RaypyngOphydDevices
+from beamlinetools.simulation import TwinOphydDevices
 from .base import *
 
 # Get the directory where the script is located
@@ -15,21 +15,84 @@ rml_path = os.path.join(script_dir, 'rml', rml_file_name)
 # insert here the path to the rml file that you want to use
 
 
-# local
-RaypyngOphydDevices(RE=RE, rml_path=rml_path, temporary_folder=None, name_space=None, prefix=None, ray_ui_location=None)
+# local, simulated with RAY-UI as with raypyng-bluesky
+twin = TwinOphydDevices(RE=RE, rml_path=rml_path, temporary_folder=None, name_space=None, prefix=None, ray_ui_location=None)
+
+# the features below are opt-in, add the arguments to TwinOphydDevices above
+
+# simulation engine: a pool of long-lived RAY-UI instances (hidden with xvfb), pass
+# simulation_engine=simulation_engine. n_workers=None uses one worker per cpu,
+# dispatch can be 'least_loaded' or 'round_robin'
+# from beamlinetools.simulation import RayUIWorkerPool, PooledSimulationEngine
+# simulation_pool = RayUIWorkerPool(n_workers=4, ray_ui_location=None, dispatch='least_loaded', health_check_interval=10)
+# simulation_engine = PooledSimulationEngine(simulation_pool)
+
+# without RAY-UI (no licence or X server) use the numpy ray tracer instead,
+# it restarts the tracing at the first element that changed (bundle_cache_size in bytes)
+# from beamlinetools.simulation import NumpySimulationEngine
+# simulation_engine = NumpySimulationEngine(batch_size=100000, seed=None, bundle_cache_size=512*1024**2)
+# with max_workers=4, shared_memory=True the workers hand the rays to the detectors in shared memory
+# with energy_scans=True (and lookahead=True) a scan of rp_Dipole.en is traced in a single pass
+
+# cache of the simulation results, pass cache=simulation_cache: the same set of parameters
+# is simulated only once. Use simulation_cache.stats() to check hits/misses and
+# simulation_cache.invalidate(rml_path) after editing the rml file
+# from beamlinetools.simulation import SimulationCache
+# simulation_cache = SimulationCache(os.path.join(script_dir, 'simulation_cache'), max_entries=1000, max_size=2*1024**3)
+
+# with progressive_tolerance=0.01 the rays are traced in batches until the relative
+# Monte Carlo error of the intensity is below 1% (read back in <detector>_mc_error)
+# with surrogate=os.path.join(script_dir, 'surrogate_models') the triggers are answered by a model
+# of past simulations when its relative uncertainty is below surrogate_threshold
+# with lookahead=True the points of scan, list_scan, grid_scan, list_grid_scan and a2scan are
+# all submitted to the engine when the run is opened, lookahead_window limits how many
+# with workspace=True the simulation files are written on tmpfs, with size and file quotas
+# and the I/O of each scan in twin.workspace.history (see ScratchWorkspace)
+# with timing=True the timings of each point are saved in the 'timing' stream, and
+# with timing_exporters=[OTelFileExporter('spans.jsonl')] (from beamlinetools.simulation) written as
+# OpenTelemetry spans
+# with lazy_devices=True the rp_<Element> devices are only created at their first use,
+# build_devices(globals()) creates all of them
+# with scheduler=True the simulations of RE are queued as 'batch', and those of the
+# RunEngines added with twin.attach as 'interactive', that jump the queue
+# with common_random_numbers=True (numpy engine) all the points of a run use the same random
+# rays, the seed is saved as 'twin_seed' in the start document, seed=<twin_seed> replays a run
+# with ring_current=accelerator (see beamline.py) the intensities follow the ring current without
+# simulating again, ReplayedAccelerator(times, currents, fills) replays a recorded current
+
+# %ct and the other magics simulate the twin too, in their own folder, also while RE runs a scan
+# from beamlinetools.magics.standard_magics import BlueskyMagicsCustom
+# twin.attach(BlueskyMagicsCustom.RE)
 
 
 # with server
-from raypyng_bluesky.RaypyngOphydDevices import RaypyngOphydDevices
-
-# RaypyngOphydDevices(RE=RE, # this is the RunEngine
-#                     rml_path=rml_path, # path to elisa.rml
-#                     prefix='rp', 
-#                     temporary_folder=None, 
-#                     name_space=None, 
-#                     simulation_engine='rayuiClient', 
-#                     ip='127.0.0.1',
-#                     port=12345)
-
-# to run the server use file 
-# python test/test_asyncio_server.py
+# TwinOphydDevices(RE=RE, # this is the RunEngine
+#                  rml_path=rml_path, # path to elisa.rml
+#                  prefix='rp', 
+#                  temporary_folder=None, 
+#                  name_space=None, 
+#                  simulation_engine='rayuiClient', 
+#                  ip='127.0.0.1',
+#                  port=12345,
+#                  lookahead=True)
+
+# to run the server (--engine pool, numpy or fake)
+# python -m beamlinetools.simulation server --engine pool --workers 4 --port 12345
+
+
+# with many simulation hosts, simulation_dispatcher.stats() shows the state of the workers
+# from beamlinetools.simulation import SimulationDispatcher
+# simulation_dispatcher = SimulationDispatcher(['node1:12345', 'node2:12345', 'node3:12345'],
+#                                              heartbeat_timeout=5, max_retries=2,
+#                                              token=os.environ['BEAMLINETOOLS_SIMULATION_TOKEN'])
+# TwinOphydDevices(RE=RE,
+#                  rml_path=rml_path,
+#                  prefix='rp',
+#                  temporary_folder=None,
+#                  name_space=None,
+#                  simulation_engine=simulation_dispatcher, # or 'dispatcher' with engine_options={'workers': [...]}
+#                  lookahead=True)
+
+# to run a worker on each host (--engine pool, numpy or fake), with the same
+# BEAMLINETOOLS_SIMULATION_TOKEN in the environment
+# python -m beamlinetools.simulation worker --engine numpy --workers 8 --host 0.0.0.0 --port 12345
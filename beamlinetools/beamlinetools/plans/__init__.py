@@ -1,2 +1,3 @@
 from .ID_controls import *
 from .keithley_scripts import *
+from .optimize import *
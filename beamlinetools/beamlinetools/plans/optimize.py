@@ -0,0 +1,376 @@
+import logging
+
+import numpy as np
+from ophyd import Signal
+from bluesky import Msg
+from bluesky.plan_stubs import mv
+
+from beamlinetools.simulation.batch import BatchEvaluator
+from beamlinetools.simulation.detectors import source_element
+from beamlinetools.simulation.surrogate import SurrogateModel
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['optimize_twin', 'ParallelNelderMead', 'CMAES', 'BatchBayesianOptimizer']
+
+
+class ParallelNelderMead():
+    """Nelder-Mead simplex updating several vertices per iteration
+
+    At each iteration the ``p`` worst vertices are reflected through the
+    centroid of the others (Lee and Wiswall, 2007). For each of them the
+    reflection, the expansion and the contraction are evaluated together,
+    so an iteration is a single batch of ``3*p`` points. If no vertex
+    improves, the simplex shrinks towards the best vertex.
+
+    The points are in the unit box ``[0, 1]^n``, the objective is minimized.
+
+    Args:
+        x0 (array): the first vertex
+        step (float, optional): size of the initial simplex. Defaults to 0.1.
+        batch_size (int, optional): points per iteration, ``p = batch_size//3``.
+                                    Defaults to ``3*max(1, n//2)``.
+        xtol (float, optional): the optimization converged when all vertices are
+                                within ``xtol`` of the best one. Defaults to 1e-3.
+    """
+    def __init__(self, x0, step:float=0.1, batch_size:int=None, xtol:float=1e-3):
+        x0 = np.clip(np.asarray(x0, dtype=float), 0, 1)
+        n = x0.shape[0]
+        self.p = max(1, min(n, (batch_size or 3*max(1, n//2))//3))
+        self.xtol = xtol
+        vertices = [x0]
+        for i in range(n):
+            vertex = x0.copy()
+            vertex[i] += step if x0[i]+step <= 1 else -step
+            vertices.append(vertex)
+        self.simplex = np.array(vertices)
+        self.values = None
+        self._stage = 'init'
+        self._worst = None
+
+    @property
+    def converged(self)->bool:
+        if self.values is None:
+            return False
+        best = self.simplex[np.argmin(self.values)]
+        return bool(np.max(np.abs(self.simplex-best)) < self.xtol)
+
+    def ask(self)->np.ndarray:
+        """Return the points to evaluate"""
+        if self._stage in ('init', 'shrink'):
+            return self.simplex.copy()
+        order = np.argsort(self.values)
+        self._worst = order[-self.p:]
+        centroid = self.simplex[order[:-self.p]].mean(axis=0)
+        points = []
+        for j in self._worst:
+            d = centroid-self.simplex[j]
+            points.extend([centroid+d, centroid+2*d, centroid-0.5*d])
+        return np.clip(np.array(points), 0, 1)
+
+    def tell(self, points, values):
+        """Update the simplex with the values of the points of :meth:`ask`"""
+        points, values = np.asarray(points, dtype=float), np.asarray(values, dtype=float)
+        if self._stage in ('init', 'shrink'):
+            self.simplex, self.values = points, values
+            self._stage = 'reflect'
+            return
+        best = np.min(self.values)
+        improved = False
+        for k, j in enumerate(self._worst):
+            (r, e, c), (fr, fe, fc) = points[3*k:3*k+3], values[3*k:3*k+3]
+            if fr < best:
+                self.simplex[j], self.values[j] = (e, fe) if fe < fr else (r, fr)
+            elif fr < self.values[j]:
+                self.simplex[j], self.values[j] = r, fr
+            elif fc < self.values[j]:
+                self.simplex[j], self.values[j] = c, fc
+            else:
+                continue
+            improved = True
+        if not improved:
+            x_best = self.simplex[np.argmin(self.values)]
+            self.simplex = x_best+0.5*(self.simplex-x_best)
+            self._stage = 'shrink'
+
+
+class CMAES():
+    """Covariance matrix adaptation evolution strategy
+
+    Each generation samples ``batch_size`` points from a multivariate normal
+    distribution, whose mean, step size and covariance are adapted to the
+    ranking of the points (Hansen, The CMA Evolution Strategy: A Tutorial).
+    Points outside the unit box are sampled again.
+
+    The points are in the unit box ``[0, 1]^n``, the objective is minimized.
+
+    Args:
+        x0 (array): the initial mean
+        sigma (float, optional): the initial step size. Defaults to 0.2.
+        batch_size (int, optional): points per generation. Defaults to ``4+3*ln(n)``.
+        xtol (float, optional): the optimization converged when the step size along the
+                                largest axis is below ``xtol``. Defaults to 1e-3.
+        seed (optional): seed of the random generator. Defaults to None.
+    """
+    def __init__(self, x0, sigma:float=0.2, batch_size:int=None, xtol:float=1e-3, seed=None):
+        self.mean = np.clip(np.asarray(x0, dtype=float), 0, 1)
+        n = self.n = self.mean.shape[0]
+        self.sigma = sigma
+        self.xtol = xtol
+        self.rng = np.random.default_rng(seed)
+        self.lam = max(2, batch_size or int(4+3*np.log(n)))
+        self.mu = self.lam//2
+        weights = np.log(self.mu+0.5)-np.log(np.arange(1, self.mu+1))
+        self.weights = weights/weights.sum()
+        self.mueff = 1/np.sum(self.weights**2)
+        self.cc = (4+self.mueff/n)/(n+4+2*self.mueff/n)
+        self.cs = (self.mueff+2)/(n+self.mueff+5)
+        self.c1 = 2/((n+1.3)**2+self.mueff)
+        self.cmu = min(1-self.c1, 2*(self.mueff-2+1/self.mueff)/((n+2)**2+self.mueff))
+        self.damps = 1+2*max(0, np.sqrt((self.mueff-1)/(n+1))-1)+self.cs
+        self.chin = np.sqrt(n)*(1-1/(4*n)+1/(21*n**2))
+        self.pc, self.ps = np.zeros(n), np.zeros(n)
+        self.B, self.D = np.eye(n), np.ones(n)
+        self.C = np.eye(n)
+        self.generation = 0
+
+    @property
+    def converged(self)->bool:
+        return bool(self.sigma*np.max(self.D) < self.xtol)
+
+    def ask(self)->np.ndarray:
+        """Return the points of the next generation"""
+        points = []
+        for _ in range(self.lam):
+            for _ in range(100):
+                x = self.mean+self.sigma*(self.B @ (self.D*self.rng.standard_normal(self.n)))
+                if np.all((x >= 0) & (x <= 1)):
+                    break
+            points.append(np.clip(x, 0, 1))
+        return np.array(points)
+
+    def tell(self, points, values):
+        """Adapt the distribution to the values of the points of :meth:`ask`"""
+        points, values = np.asarray(points, dtype=float), np.asarray(values, dtype=float)
+        self.generation += 1
+        n = self.n
+        selected = points[np.argsort(values)[:self.mu]]
+        old = self.mean
+        self.mean = self.weights @ selected
+        y = (self.mean-old)/self.sigma
+        inv_sqrt = self.B @ np.diag(1/self.D) @ self.B.T
+        self.ps = (1-self.cs)*self.ps+np.sqrt(self.cs*(2-self.cs)*self.mueff)*(inv_sqrt @ y)
+        hsig = (np.linalg.norm(self.ps)/np.sqrt(1-(1-self.cs)**(2*self.generation))/self.chin) < 1.4+2/(n+1)
+        self.pc = (1-self.cc)*self.pc+hsig*np.sqrt(self.cc*(2-self.cc)*self.mueff)*y
+        steps = (selected-old)/self.sigma
+        self.C = ((1-self.c1-self.cmu)*self.C
+                  + self.c1*(np.outer(self.pc, self.pc)+(1-hsig)*self.cc*(2-self.cc)*self.C)
+                  + self.cmu*(steps.T @ np.diag(self.weights) @ steps))
+        self.sigma *= np.exp((self.cs/self.damps)*(np.linalg.norm(self.ps)/self.chin-1))
+        self.C = (self.C+self.C.T)/2
+        eigenvalues, self.B = np.linalg.eigh(self.C)
+        self.D = np.sqrt(np.maximum(eigenvalues, 1e-20))
+
+
+class BatchBayesianOptimizer():
+    """Bayesian optimization proposing a batch of points per iteration
+
+    The objective is modelled with the Gaussian process of :class:`SurrogateModel`.
+    The batch is chosen one point at a time, minimizing the lower confidence
+    bound ``mean-kappa*std`` over random candidates, each chosen point being
+    added to the model with its predicted value ("kriging believer"), so that
+    the next points are spread out. The first ``n_initial`` points are random.
+
+    The points are in the unit box ``[0, 1]^n``, the objective is minimized.
+
+    Args:
+        x0 (array): the first point
+        batch_size (int, optional): points per iteration. Defaults to 4.
+        n_initial (int, optional): number of random points. Defaults to ``max(2*n+1, batch_size)``.
+        kappa (float, optional): weight of the uncertainty. Defaults to 2.
+        n_candidates (int, optional): number of random candidates. Defaults to 1000.
+        seed (optional): seed of the random generator. Defaults to None.
+    """
+    converged = False
+
+    def __init__(self, x0, batch_size:int=None, n_initial:int=None, kappa:float=2., n_candidates:int=1000, seed=None):
+        self.x0 = np.clip(np.asarray(x0, dtype=float), 0, 1)
+        n = self.x0.shape[0]
+        self.batch_size = batch_size or 4
+        self.n_initial = n_initial or max(2*n+1, self.batch_size)
+        self.kappa = kappa
+        self.n_candidates = n_candidates
+        self.rng = np.random.default_rng(seed)
+        self.X = np.zeros((0, n))
+        self.y = np.zeros(0)
+
+    def ask(self)->np.ndarray:
+        """Return the points to evaluate"""
+        n = self.x0.shape[0]
+        if len(self.y) < self.n_initial:
+            points = self.rng.random((min(self.batch_size, self.n_initial-len(self.y)), n))
+            if len(self.y) == 0:
+                points[0] = self.x0
+            return points
+        finite = np.isfinite(self.y)
+        model = SurrogateModel(max_points=len(self.y)+self.batch_size)
+        for x, y in zip(self.X[finite], self.y[finite]):
+            model.add(self._inputs(x), {'y': y})
+        best = self.X[finite][np.argmin(self.y[finite])]
+        candidates = np.vstack((self.rng.random((self.n_candidates, n)),
+                                np.clip(best+0.05*self.rng.standard_normal((self.n_candidates//4, n)), 0, 1)))
+        points = []
+        for _ in range(self.batch_size):
+            scores = np.full(len(candidates), np.inf)
+            means = np.zeros(len(candidates))
+            for i, x in enumerate(candidates):
+                prediction = model.predict(self._inputs(x))
+                if prediction is not None:
+                    means[i] = prediction[0]['y']
+                    scores[i] = means[i]-self.kappa*prediction[1]['y']
+            i = int(np.argmin(scores)) if np.isfinite(scores).any() else 0
+            points.append(candidates[i])
+            model.add(self._inputs(candidates[i]), {'y': means[i]})
+            candidates = np.delete(candidates, i, axis=0)
+        return np.array(points)
+
+    def tell(self, points, values):
+        """Add the values of the points of :meth:`ask`"""
+        self.X = np.vstack((self.X, np.asarray(points, dtype=float)))
+        self.y = np.concatenate((self.y, np.asarray(values, dtype=float)))
+
+    @staticmethod
+    def _inputs(x)->dict:
+        return {f'x{i}': v for i, v in enumerate(x)}
+
+
+OPTIMIZERS = {'nelder-mead': ParallelNelderMead,
+              'cma-es': CMAES,
+              'bayesian': BatchBayesianOptimizer}
+
+# objective -> (function of the detector values and of the photon energy, True to maximize)
+OBJECTIVES = {'flux': (lambda values, energy: values['intensity'], True),
+              'spot_size': (lambda values, energy: values['hor_foc']*values['ver_foc'], False),
+              'resolving_power': (lambda values, energy: energy/values['bw'] if values['bw'] > 0 else 0., True)}
+
+
+def optimize_twin(detector, motors, bounds, *, twin, objective:str='flux', method:str='cma-es',
+                  batch_size:int=None, max_evaluations:int=100, tolerance:float=1e-3, seed=None,
+                  move:bool=True, md:dict=None):
+    """Optimize a signal of a twin detector over raypyng motors
+
+    Each iteration of the optimizer proposes a batch of positions that
+    are simulated at the same time by the engine of the twin (see
+    :class:`BatchEvaluator`), without moving the motors. Every evaluation is
+    an event of the primary stream, with the position of the motors, the
+    signals of the detector, the value of the objective (``optimizer_objective``)
+    and the iteration (``optimizer_iteration``). The optimization stops after
+    ``max_evaluations`` evaluations or when the optimizer converged.
+
+    Args:
+        detector (TwinDetectorDevice): the detector, e.g. ``rp_DetectorAtFocus``
+        motors (list): raypyng motors, e.g. ``[rp_M1.rx, rp_M1.ry, rp_KB1.tx]``
+        bounds (list): (low, high) of each motor
+        twin (TwinOphydDevices): the digital twin
+        objective (str, optional): 'flux' (maximize the intensity), 'spot_size' (minimize the product
+                                   of the focus sizes) or 'resolving_power' (maximize the photon energy
+                                   divided by the bandwidth). Defaults to 'flux'.
+        method (str, optional): 'nelder-mead' (:class:`ParallelNelderMead`), 'cma-es' (:class:`CMAES`)
+                                or 'bayesian' (:class:`BatchBayesianOptimizer`). Defaults to 'cma-es'.
+        batch_size (int, optional): number of positions simulated at the same time, if None
+                                    the default of the optimizer. Defaults to None.
+        max_evaluations (int, optional): maximum number of evaluations. Defaults to 100.
+        tolerance (float, optional): convergence tolerance on the positions, relative to the
+                                     bounds. Defaults to 1e-3.
+        seed (optional): seed of the random generator of the optimizer. Defaults to None.
+        move (bool, optional): move the motors to the best position at the end. Defaults to True.
+        md (dict, optional): metadata. Defaults to None.
+
+    Returns:
+        dict: the best ``position`` of the motors, its ``objective``, the number of
+              ``evaluations`` and ``iterations``
+    """
+    if objective not in OBJECTIVES:
+        raise ValueError(f"Unknown objective '{objective}', use one of {list(OBJECTIVES)}")
+    if method not in OPTIMIZERS:
+        raise ValueError(f"Unknown method '{method}', use one of {list(OPTIMIZERS)}")
+    bounds = np.asarray(bounds, dtype=float).reshape(len(motors), 2)
+    low, span = bounds[:, 0], bounds[:, 1]-bounds[:, 0]
+    if np.any(span <= 0):
+        raise ValueError("The high bound of each motor must be above the low bound")
+    evaluator = BatchEvaluator(twin, motors, [detector], folder_name='optimize')
+    function, maximize = OBJECTIVES[objective]
+    x0 = np.clip((np.array(evaluator.positions())-low)/span, 0, 1)
+    kwargs = {'batch_size': batch_size}
+    if method != 'bayesian':
+        kwargs['xtol'] = tolerance
+    if method != 'nelder-mead':
+        kwargs['seed'] = seed
+    optimizer = OPTIMIZERS[method](x0, **kwargs)
+    source = source_element(evaluator.rml)
+    energy_motor = next((i for i, param in enumerate(evaluator.params) if param is source.photonEnergy), None)
+
+    motor_names = [motor.name for motor in motors]
+    _md = {'detectors': [detector.name],
+           'motors': motor_names,
+           'plan_args': {'detector': repr(detector), 'motors': list(map(repr, motors)),
+                         'bounds': bounds.tolist(), 'objective': objective, 'method': method,
+                         'batch_size': batch_size, 'max_evaluations': max_evaluations},
+           'plan_name': 'optimize_twin',
+           'hints': {'dimensions': [(['optimizer_iteration'], 'primary')]}}
+    _md.update(md or {})
+
+    positions = [Signal(name=name, value=0.) for name in motor_names]
+    values = [Signal(name=signal.name, value=0.) for signal in evaluator.signals]
+    objective_signal = Signal(name='optimizer_objective', value=0.)
+    iteration_signal = Signal(name='optimizer_iteration', value=0)
+
+    evaluations, iteration = 0, 0
+    best = (np.inf, None, None)
+    yield Msg('open_run', **_md)
+    while not optimizer.converged:
+        candidates = optimizer.ask()
+        if evaluations+len(candidates) > max_evaluations:
+            break
+        iteration += 1
+        points = low+candidates*span
+        jobs = evaluator.submit(points)
+        try:
+            yield from evaluator.wait(jobs)
+            results = evaluator.values(jobs)
+        finally:
+            evaluator.release(jobs)
+        scores = []
+        for point, result in zip(points, results):
+            signals = {signal.attr_name: value for signal, value in zip(evaluator.signals, result)}
+            energy = point[energy_motor] if energy_motor is not None else float(source.photonEnergy.cdata)
+            value = float(function(signals, energy)) if signals['intensity'] > 0 else np.nan
+            # the optimizers minimize, positions where no ray arrives are the worst
+            score = -value if maximize else value
+            scores.append(score if np.isfinite(score) else np.inf)
+            if scores[-1] < best[0]:
+                best = (scores[-1], point, value)
+            for signal, v in zip(positions, point):
+                signal.put(float(v))
+            for signal, v in zip(values, result):
+                signal.put(v)
+            objective_signal.put(value)
+            iteration_signal.put(iteration)
+            yield Msg('create', name='primary')
+            for obj in positions+values+[objective_signal, iteration_signal]:
+                yield Msg('read', obj)
+            yield Msg('save')
+        evaluations += len(candidates)
+        optimizer.tell(candidates, scores)
+    yield Msg('close_run')
+    if best[1] is None:
+        logger.warning("optimize_twin: no position was evaluated")
+        return {'position': None, 'objective': None, 'evaluations': evaluations, 'iterations': iteration}
+    logger.info(f"optimize_twin: best {objective} {best[2]:.6g} after {evaluations} evaluations")
+    if move:
+        args = []
+        for motor, value in zip(motors, best[1]):
+            args.extend([motor, float(value)])
+        yield from mv(*args)
+    return {'position': dict(zip(motor_names, map(float, best[1]))), 'objective': best[2],
+            'evaluations': evaluations, 'iterations': iteration}
@@ -0,0 +1,29 @@
+from .rml_utils import *
+from .rml_model import *
+from .rays import *
+from .shared_rays import *
+from .reductions import *
+from .timing import *
+from .engine import *
+from .cache import *
+from .workspace import *
+from .pool import *
+from .numpy_tracer import *
+from .ring import *
+from .detectors import *
+from .lazy import *
+from .timing_stream import *
+from .progressive import *
+from .scheduler import *
+from .lookahead import *
+from .interrupts import *
+from .seeding import *
+from .sensitivity import *
+from .batch import *
+from .surrogate import *
+from .fake import *
+from .server import *
+from .client import *
+from .dispatcher import *
+from .benchmark import *
+from .twin import *
@@ -0,0 +1,108 @@
+import os
+import logging
+import argparse
+
+from .server import SimulationServer, DEFAULT_PORT
+
+# environment variable with the default secret of the servers and workers
+TOKEN_VARIABLE = 'BEAMLINETOOLS_SIMULATION_TOKEN'
+
+
+def create_engine(args):
+    """Create the simulation engine selected on the command line"""
+    if args.engine == 'pool':
+        from .pool import RayUIWorkerPool, PooledSimulationEngine
+        return PooledSimulationEngine(RayUIWorkerPool(n_workers=args.workers, ray_ui_location=args.ray_ui_location))
+    if args.engine == 'numpy':
+        from .numpy_tracer import NumpySimulationEngine
+        return NumpySimulationEngine(max_workers=args.workers)
+    from .fake import FakeSimulationEngine
+    return FakeSimulationEngine(delay=args.delay)
+
+
+def server(args):
+    """Run a :class:`SimulationServer` until interrupted"""
+    engine = create_engine(args)
+    try:
+        SimulationServer(engine, host=args.host, port=args.port, max_jobs=args.workers, token=args.token).run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        engine.shutdown()
+
+
+def worker(args):
+    """Run a worker of a :class:`SimulationDispatcher` until interrupted"""
+    server(args)
+
+
+def benchmark(args):
+    """Run the benchmarks of :func:`run_benchmarks` and print the mean time per point"""
+    from .benchmark import run_benchmarks, format_results
+    results = run_benchmarks(args.rml, engine=args.engine, rays=args.rays, workers=args.workers,
+                             points=args.points, output=args.output, ray_ui_location=args.ray_ui_location,
+                             fake_delay=args.delay)
+    print(format_results(results))
+    print(f"Results saved in {args.output}")
+
+
+def rml_benchmark(args):
+    """Time loading and writing rml files, see :func:`run_rml_benchmarks`"""
+    from .benchmark import run_rml_benchmarks, format_rml_results
+    results = run_rml_benchmarks(args.rml, elements=args.elements, repeats=args.repeats, output=args.output)
+    print(format_rml_results(results))
+    if args.output is not None:
+        print(f"Results saved in {args.output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m beamlinetools.simulation',
+                                     description="Simulation services of the digital twin")
+    commands = parser.add_subparsers(dest='command', required=True)
+    parser_server = commands.add_parser('server', help="run a simulation server for SimulationClient")
+    parser_server.add_argument('--host', default='127.0.0.1')
+    parser_server.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser_server.add_argument('--engine', choices=('pool', 'numpy', 'fake'), default='pool')
+    parser_server.add_argument('--workers', type=int, default=4, help="number of worker processes")
+    parser_server.add_argument('--ray-ui-location', default=None)
+    parser_server.add_argument('--delay', type=float, default=0., help="duration of the fake simulations")
+    parser_server.add_argument('--token', default=os.environ.get(TOKEN_VARIABLE),
+                               help="secret the clients must send, default: $BEAMLINETOOLS_SIMULATION_TOKEN")
+    parser_server.set_defaults(func=server)
+    parser_worker = commands.add_parser('worker', help="run a simulation worker for SimulationDispatcher")
+    parser_worker.add_argument('--host', default='127.0.0.1',
+                               help="use e.g. 0.0.0.0 to accept dispatchers on other computers, with a token")
+    parser_worker.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser_worker.add_argument('--engine', choices=('pool', 'numpy', 'fake'), default='numpy')
+    parser_worker.add_argument('--workers', type=int, default=4, help="number of simulation slots")
+    parser_worker.add_argument('--ray-ui-location', default=None)
+    parser_worker.add_argument('--delay', type=float, default=0., help="duration of the fake simulations")
+    parser_worker.add_argument('--token', default=os.environ.get(TOKEN_VARIABLE),
+                               help="secret the clients must send, default: $BEAMLINETOOLS_SIMULATION_TOKEN")
+    parser_worker.set_defaults(func=worker)
+    parser_benchmark = commands.add_parser('benchmark', help="time the phases of the points of scans")
+    parser_benchmark.add_argument('rml', help="the rml file, e.g. rml/elisa.rml")
+    parser_benchmark.add_argument('--engine', choices=('pool', 'numpy', 'fake'), default=None,
+                                  help="default: pool if RAY-UI is installed, otherwise fake")
+    parser_benchmark.add_argument('--rays', type=lambda x: int(float(x)), nargs='+', default=[1000, 10000, 100000])
+    parser_benchmark.add_argument('--workers', type=int, nargs='+', default=[1, 4])
+    parser_benchmark.add_argument('--points', type=int, default=10)
+    parser_benchmark.add_argument('--output', default='benchmark.json')
+    parser_benchmark.add_argument('--ray-ui-location', default=None)
+    parser_benchmark.add_argument('--delay', type=float, default=0., help="duration of the fake simulations")
+    parser_benchmark.set_defaults(func=benchmark)
+    parser_rml = commands.add_parser('rml-benchmark', help="time loading and writing rml files")
+    parser_rml.add_argument('rml', help="the rml file, e.g. rml/elisa.rml")
+    parser_rml.add_argument('--elements', type=int, nargs='+', default=[200],
+                            help="number of elements of the synthetic beamlines")
+    parser_rml.add_argument('--repeats', type=int, default=20)
+    parser_rml.add_argument('--output', default=None)
+    parser_rml.set_defaults(func=rml_benchmark)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger('beamlinetools').setLevel(logging.INFO)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+import os
+import shutil
+import asyncio
+import logging
+
+from bluesky import Msg
+
+from .rml_utils import rml_key
+from .rays import load_rays
+from .engine import submit_simulation
+from .lookahead import LookAheadSimulationEngine, rml_parameter
+from .detectors import load_statistics, detector_statistics, source_flux, simulated_source_flux
+
+logger = logging.getLogger(__name__)
+
+
+def detector_signals(detectors)->list:
+    """Return the signals of the twin detectors, a device stands for its intensity, bandwidth and focus sizes"""
+    signals = []
+    for det in detectors:
+        if hasattr(det, 'information_to_extract'):
+            signals.append(det)
+        else:
+            signals.extend((det.intensity, det.bw, det.hor_foc, det.ver_foc))
+    return signals
+
+
+def signal_values(folder:str, signals, source:tuple)->list:
+    """Read the values of the detector signals from a simulation folder
+
+    Args:
+        folder (str): the simulation folder
+        signals (list): the signals, see :class:`TwinDetector`
+        source (tuple): photon flux and number of rays of the source of the simulated rml file,
+                        see :func:`simulated_source_flux`
+
+    Returns:
+        list: the value of each signal
+    """
+    statistics = {}
+    values = []
+    for signal in signals:
+        device = signal.parent
+        if device.name not in statistics:
+            stats = load_statistics(folder, device.name, device.export_format)
+            if stats is None:
+                rays = load_rays(folder, device.name, device.export_format)
+                stats = detector_statistics(rays, simulated_source_flux(folder, device.name, source),
+                                            device.current_correction, device.chunk_size)
+            statistics[device.name] = stats
+        values.append(statistics[device.name][signal.information_to_extract])
+    return values
+
+
+class BatchEvaluator():
+    """Simulate many positions of the motors of the twin at the same time
+
+    The positions are written into the rml file one after the other and
+    submitted to the engine of the twin, so they are simulated in parallel
+    (e.g. on the workers of a :class:`RayUIWorkerPool`), and the motors are
+    never moved. Positions with the same simulation key share one simulation.
+    The engine is set up before the first submission, as raypyng-bluesky does
+    at the first trigger of a run, e.g. to start RAY-UI.
+    The simulation folders are taken from the workspace of the twin if it
+    has one, otherwise they are ``<trigger folder>/<folder_name>/<i>``.
+
+    Args:
+        twin (TwinOphydDevices): the digital twin
+        motors (list): raypyng motors, e.g. ``[rp_M1.rx, rp_KB1.tx]``
+        detectors (list): signals or devices of the twin detectors, see :func:`detector_signals`
+        folder_name (str, optional): name of the folder of the simulations. Defaults to 'batch'.
+    """
+    def __init__(self, twin, motors, detectors, folder_name:str='batch'):
+        self.params = [rml_parameter(motor) for motor in motors]
+        if any(param is None for param in self.params):
+            raise ValueError("All the motors must be raypyng motors of the twin")
+        self.motors = list(motors)
+        self.signals = detector_signals(detectors)
+        self.trigger = twin.trigger_detector()
+        engine = self.trigger.simulation_engine
+        if isinstance(engine, LookAheadSimulationEngine):
+            engine = engine.engine
+        self.engine = engine
+        self.workspace = getattr(twin, 'workspace', None)
+        self.base = os.path.join(self.trigger.path, folder_name)
+        self.exports_list = sorted({signal.parent.name for signal in self.signals})
+        self._count = 0
+        self._setup = False
+
+    @property
+    def rml(self):
+        return self.trigger.rml
+
+    def positions(self)->list:
+        """Return the current position of the motors in the rml file"""
+        return [float(param.cdata) for param in self.params]
+
+    def submit(self, positions)->list:
+        """Submit the simulations of ``positions``
+
+        Args:
+            positions (list): for each simulation the position of each motor
+
+        Returns:
+            list: for each position (future, folder, source), see :func:`source_flux`.
+                  Positions sharing a simulation share the same future and folder.
+        """
+        if not self._setup:
+            self.engine.setup_simulation()
+            self._setup = True
+        saved = [param.cdata for param in self.params]
+        submitted = {}
+        jobs = []
+        try:
+            for position in positions:
+                for param, value in zip(self.params, position):
+                    param.cdata = str(float(value))
+                key = rml_key(self.rml, self.exports_list)
+                if key not in submitted:
+                    folder = self._folder()
+                    submitted[key] = (submit_simulation(self.engine, folder, self.rml, self.exports_list),
+                                      folder, source_flux(self.rml))
+                jobs.append(submitted[key])
+        finally:
+            for param, value in zip(self.params, saved):
+                param.cdata = value
+        return jobs
+
+    def wait(self, jobs):
+        """Plan stub waiting for the simulations of ``jobs``, without blocking the RunEngine"""
+        futures = list({id(job[0]): job[0] for job in jobs}.values())
+        yield Msg('wait_for', None, [lambda f=f: asyncio.wrap_future(f) for f in futures])
+
+    def values(self, jobs)->list:
+        """Read the values of the signals of finished simulations
+
+        Returns:
+            list: for each job the value of each signal, see :func:`signal_values`
+        """
+        read = {}
+        for future, folder, source in jobs:
+            future.result()
+            if folder not in read:
+                read[folder] = signal_values(folder, self.signals, source)
+        return [read[folder] for future, folder, source in jobs]
+
+    def release(self, jobs):
+        """Cancel the simulations still running and give back their folders"""
+        unique = {folder: future for future, folder, source in jobs}
+        for folder, future in unique.items():
+            future.cancel()
+            if self.workspace is not None:
+                # a cancelled simulation may still be running: release its folder once it is done
+                future.add_done_callback(lambda f, folder=folder: self.workspace.release(folder))
+            else:
+                future.add_done_callback(lambda f, folder=folder: shutil.rmtree(folder, ignore_errors=True))
+
+    def _folder(self)->str:
+        if self.workspace is not None:
+            return self.workspace.acquire()
+        self._count += 1
+        return os.path.join(self.base, str(self._count))
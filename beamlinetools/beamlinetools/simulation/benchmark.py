@@ -0,0 +1,370 @@
+import os
+import re
+import json
+import time
+import types
+import socket
+import logging
+import platform
+import tempfile
+import datetime
+
+import numpy as np
+
+from .timing import PHASES, TimingRecorder, span
+from .detectors import source_element
+from .rml_model import load_rml, write_rml_file
+
+logger = logging.getLogger(__name__)
+
+# RunEngine commands timed by the benchmark, and their phase
+COMMAND_PHASES = {'set': 'rml_mutation', 'read': 'result_parsing', 'save': 'document_emission'}
+
+
+def rayui_available(ray_ui_location:str=None)->bool:
+    """Return True if RAY-UI is installed"""
+    try:
+        from raypyng.runner import RayUIRunner
+        RayUIRunner(ray_path=ray_ui_location, hide=True)
+    except Exception:
+        return False
+    return True
+
+
+def create_engine(engine:str, workers:int=1, ray_ui_location:str=None, fake_delay:float=0.):
+    """Create a simulation engine for the benchmarks
+
+    Args:
+        engine (str): 'pool', 'numpy' or 'fake'
+        workers (int, optional): number of workers. Defaults to 1.
+        ray_ui_location (str, optional): the location of RAY-UI. Defaults to None.
+        fake_delay (float, optional): duration of the simulations of the fake engine. Defaults to 0.
+
+    Returns:
+        the engine
+    """
+    if engine == 'pool':
+        from .pool import RayUIWorkerPool, PooledSimulationEngine
+        return PooledSimulationEngine(RayUIWorkerPool(n_workers=workers, ray_ui_location=ray_ui_location))
+    if engine == 'numpy':
+        from .numpy_tracer import NumpySimulationEngine
+        return NumpySimulationEngine(max_workers=workers, seed=0)
+    if engine == 'fake':
+        from .fake import FakeSimulationEngine
+        return FakeSimulationEngine(delay=fake_delay, max_workers=workers, seed=0)
+    raise ValueError(f"Unknown engine '{engine}'")
+
+
+def time_commands(RE, commands=COMMAND_PHASES):
+    """Record a span for each execution of some RunEngine commands
+
+    Args:
+        RE (RunEngine): the RunEngine
+        commands (dict, optional): command -> name of the span. Defaults to COMMAND_PHASES.
+    """
+    for command, phase in commands.items():
+        coroutine = RE._command_registry[command]
+
+        async def timed(msg, coroutine=coroutine, phase=phase):
+            with span(phase, command=msg.command):
+                return await coroutine(msg)
+        RE.register_command(command, timed)
+
+
+def point_breakdown(spans)->list:
+    """Split the spans of a scan into its points
+
+    A point ends with its event document (the end of a ``document_emission``
+    span), spans are attributed to the point during which they start.
+
+    Args:
+        spans (list): the spans, see :class:`TimingRecorder`
+
+    Returns:
+        list: for each point a dict phase -> duration, with the duration of
+              the whole ``point`` and the time not spent in any phase (``other``)
+    """
+    spans = sorted(spans, key=lambda s: s['start'])
+    ends = sorted(s['start']+s['duration'] for s in spans if s['name'] == 'document_emission')
+    if not spans or not ends:
+        return []
+    starts = [spans[0]['start']]+ends[:-1]
+    points = [dict.fromkeys(PHASES, 0.) for _ in ends]
+    for s in spans:
+        index = min(np.searchsorted(ends, s['start']), len(ends)-1)
+        if s['name'] in points[index]:
+            points[index][s['name']] += s['duration']
+    for point, start, end in zip(points, starts, ends):
+        point['point'] = end-start
+        point['other'] = max(0., point['point']-sum(point[p] for p in PHASES))
+    return points
+
+
+def summarize(points:list)->dict:
+    """Mean, median, 95th percentile and total of each phase over the points"""
+    summary = {}
+    for phase in points[0] if points else ():
+        values = np.array([p[phase] for p in points])
+        summary[phase] = {'mean': float(values.mean()), 'median': float(np.median(values)),
+                          'p95': float(np.percentile(values, 95)), 'total': float(values.sum())}
+    return summary
+
+
+def benchmark_scan(rml_path:str, engine:str='fake', nrays:int=10000, workers:int=1, points:int=10,
+                   start:float=500, stop:float=2000, lookahead:bool=None, **engine_kwargs)->dict:
+    """Time each phase of the points of ``scan([rp_DetectorAtFocus.intensity], rp_Dipole.en, start, stop, points)``
+
+    Args:
+        rml_path (str): the rml file, e.g. ``rml/elisa.rml``
+        engine (str, optional): 'pool', 'numpy' or 'fake', see :func:`create_engine`. Defaults to 'fake'.
+        nrays (int, optional): number of rays of the source. Defaults to 10000.
+        workers (int, optional): number of workers of the engine. Defaults to 1.
+        points (int, optional): number of points of the scan. Defaults to 10.
+        start (float, optional): first photon energy. Defaults to 500.
+        stop (float, optional): last photon energy. Defaults to 2000.
+        lookahead (bool, optional): prefetch the points, if None only with more than one worker.
+                                    With the look-ahead the simulations of the following points
+                                    overlap with the current one. Defaults to None.
+        **engine_kwargs: passed to :func:`create_engine`
+
+    Returns:
+        dict: the configuration, the duration of the scan, the time of each phase
+              for each point and their summary
+    """
+    from bluesky import RunEngine
+    from bluesky.plans import scan
+    from .twin import TwinOphydDevices
+    if lookahead is None:
+        lookahead = workers > 1
+    RE = RunEngine({})
+    time_commands(RE)
+    name_space = types.SimpleNamespace(f_globals={})
+    simulation_engine = create_engine(engine, workers, **engine_kwargs)
+    with tempfile.TemporaryDirectory() as tmp:
+        twin = TwinOphydDevices(RE=RE, rml_path=rml_path, temporary_folder=tmp, name_space=name_space,
+                                simulation_engine=simulation_engine, lookahead=lookahead)
+        source_element(twin.rml).numberRays.cdata = str(int(nrays))
+        devices = name_space.f_globals
+        plan = scan([devices['rp_DetectorAtFocus'].intensity], devices['rp_Dipole'].en, start, stop, points)
+        try:
+            with TimingRecorder() as recorder:
+                t0 = time.perf_counter()
+                RE(plan)
+                duration = time.perf_counter()-t0
+        finally:
+            twin.simulation_engine.shutdown()
+    breakdown = point_breakdown(recorder.spans)
+    return {'engine': engine, 'nrays': int(nrays), 'workers': workers, 'points': points,
+            'lookahead': lookahead, 'duration': duration, 'summary': summarize(breakdown),
+            'per_point': breakdown}
+
+
+def run_benchmarks(rml_path:str, engine:str=None, rays=(1000, 10000, 100000), workers=(1, 4),
+                   points:int=10, output:str=None, **kwargs)->dict:
+    """Run :func:`benchmark_scan` for all the ray and worker counts
+
+    Args:
+        rml_path (str): the rml file, e.g. ``rml/elisa.rml``
+        engine (str, optional): 'pool', 'numpy' or 'fake', if None 'pool' when RAY-UI
+                                is installed, otherwise 'fake'. Defaults to None.
+        rays (list, optional): numbers of rays. Defaults to (1000, 10000, 100000).
+        workers (list, optional): numbers of workers. Defaults to (1, 4).
+        points (int, optional): number of points of each scan. Defaults to 10.
+        output (str, optional): json file where the results are saved. Defaults to None.
+        **kwargs: passed to :func:`benchmark_scan`
+
+    Returns:
+        dict: the machine, the date and the results of each scan
+    """
+    if engine is None:
+        engine = 'pool' if rayui_available(kwargs.get('ray_ui_location')) else 'fake'
+    results = {'date': datetime.datetime.now().isoformat(timespec='seconds'),
+               'host': socket.gethostname(), 'platform': platform.platform(),
+               'python': platform.python_version(), 'cpus': os.cpu_count(),
+               'rml': os.path.abspath(rml_path), 'phases': list(PHASES), 'results': []}
+    for n in rays:
+        for w in workers:
+            logger.info(f"Benchmark: {engine} engine, {n} rays, {w} workers")
+            result = benchmark_scan(rml_path, engine=engine, nrays=n, workers=w, points=points, **kwargs)
+            results['results'].append(result)
+            if output is not None:
+                with open(output, 'w') as f:
+                    json.dump(results, f, indent=1)
+    return results
+
+
+def synthetic_rml(rml_path:str, n_elements:int, filename:str)->str:
+    """Write a beamline of ``n_elements`` elements, repeating the optical elements of ``rml_path``
+
+    The source stays first and the last element (e.g. the detector) last,
+    the copies of the other elements are renamed ``<name> <i>``.
+
+    Args:
+        rml_path (str): the rml file, e.g. ``rml/elisa.rml``
+        n_elements (int): number of elements of the new beamline
+        filename (str): the new rml file
+
+    Returns:
+        str: ``filename``
+    """
+    with open(rml_path) as f:
+        text = f.read()
+    objects = list(re.finditer(r'[ \t]*<object .*?</object>\n?', text, re.S))
+    first, middle, last = objects[0], objects[1:-1], objects[-1]
+    blocks = [first.group()]
+    for i in range(n_elements-2):
+        block = middle[i % len(middle)].group()
+        blocks.append(re.sub(r'<object name="([^"]*)"', lambda m: f'<object name="{m.group(1)} {i}"', block, count=1))
+    blocks.append(last.group())
+    with open(filename, 'w') as f:
+        f.write(text[:first.start()]+''.join(blocks)+text[last.end():])
+    return filename
+
+
+def benchmark_rml(rml_path:str, repeats:int=20)->dict:
+    """Time loading and writing an rml file with raypyng and with :class:`CompactRML`,
+    and creating its ophyd devices (see :func:`benchmark_devices`)
+
+    Each write follows the change of one parameter, like a scan point.
+
+    Args:
+        rml_path (str): the rml file
+        repeats (int, optional): number of repetitions. Defaults to 20.
+
+    Returns:
+        dict: the median time in seconds of ``raypyng_load``, ``compact_load``,
+              ``raypyng_write`` (full serialization), ``template_write`` (the raypyng
+              tree written through :func:`rml_template`) and ``compact_write``,
+              and ``devices``, the results of :func:`benchmark_devices` for ``eager`` and ``lazy`` devices
+    """
+    from raypyng.rml import RMLFile
+
+    def median(func):
+        times = []
+        for i in range(repeats):
+            t0 = time.perf_counter()
+            func(i)
+            times.append(time.perf_counter()-t0)
+        return float(np.median(times))
+
+    def first_param(rml):
+        return source_element(rml).numberRays
+
+    rml, compact = RMLFile(rml_path), load_rml(rml_path)
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'tmp.rml')
+
+        def raypyng_write(i):
+            first_param(rml).cdata = str(1000+i)
+            rml.write(filename)
+
+        def template_write(i):
+            first_param(rml).cdata = str(2000+i)
+            write_rml_file(rml, filename)
+
+        def compact_write(i):
+            first_param(compact).cdata = str(3000+i)
+            compact.write(filename)
+        write_rml_file(rml, filename)
+        return {'rml': os.path.abspath(rml_path), 'elements': len(rml.beamline.children()),
+                'raypyng_load': median(lambda i: RMLFile(rml_path)),
+                'compact_load': median(lambda i: load_rml(rml_path)),
+                'raypyng_write': median(raypyng_write),
+                'template_write': median(template_write),
+                'compact_write': median(compact_write),
+                'devices': {'eager': benchmark_devices(rml_path), 'lazy': benchmark_devices(rml_path, True)}}
+
+
+def benchmark_devices(rml_path:str, lazy_devices:bool=False)->dict:
+    """Time the creation of the ophyd devices of the twin, and measure their memory
+
+    Args:
+        rml_path (str): the rml file
+        lazy_devices (bool, optional): register :class:`LazyDevice` proxies. Defaults to False.
+
+    Returns:
+        dict: ``time`` and ``memory`` (bytes allocated, traced with ``tracemalloc``) of the creation
+              of :class:`TwinOphydDevices`, and ``first_use`` the time to read the first element
+    """
+    import tracemalloc
+    from bluesky import RunEngine
+    from .twin import TwinOphydDevices
+    from .fake import FakeSimulationEngine
+
+    def create(tmp):
+        name_space = types.SimpleNamespace(f_globals={})
+        twin = TwinOphydDevices(RE=RunEngine({}), rml_path=rml_path, temporary_folder=tmp, name_space=name_space,
+                                simulation_engine=FakeSimulationEngine(), lazy_devices=lazy_devices)
+        return twin, name_space.f_globals
+
+    with tempfile.TemporaryDirectory() as tmp:
+        create(tmp)
+        t0 = time.perf_counter()
+        twin, devices = create(tmp)
+        duration = time.perf_counter()-t0
+        element = next(k for k in devices if k != 'TriggerDetector')
+        t0 = time.perf_counter()
+        devices[element].read()
+        first_use = time.perf_counter()-t0
+        twin = devices = None
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            twin, devices = create(tmp)
+            memory = tracemalloc.get_traced_memory()[0]-before
+        finally:
+            tracemalloc.stop()
+    return {'time': duration, 'memory': memory, 'first_use': first_use}
+
+
+def run_rml_benchmarks(rml_path:str, elements=(200,), repeats:int=20, output:str=None)->dict:
+    """Run :func:`benchmark_rml` on ``rml_path`` and on synthetic beamlines
+
+    Args:
+        rml_path (str): the rml file, e.g. ``rml/elisa.rml``
+        elements (list, optional): number of elements of the synthetic beamlines,
+                                   see :func:`synthetic_rml`. Defaults to (200,).
+        repeats (int, optional): number of repetitions. Defaults to 20.
+        output (str, optional): json file where the results are saved. Defaults to None.
+
+    Returns:
+        dict: the machine, the date and the results of each file
+    """
+    results = {'date': datetime.datetime.now().isoformat(timespec='seconds'),
+               'host': socket.gethostname(), 'platform': platform.platform(),
+               'python': platform.python_version(), 'results': [benchmark_rml(rml_path, repeats)]}
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in elements:
+            filename = synthetic_rml(rml_path, n, os.path.join(tmp, f'synthetic_{n}.rml'))
+            result = benchmark_rml(filename, repeats)
+            result['rml'] = f'synthetic, {n} elements'
+            results['results'].append(result)
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=1)
+    return results
+
+
+def format_rml_results(results:dict)->str:
+    """Table of the load and write times, and of the creation of the devices"""
+    columns = ('raypyng_load', 'compact_load', 'raypyng_write', 'template_write', 'compact_write')
+    lines = [f"{'elements':>8} "+" ".join(f"{c:>14}" for c in columns)]
+    for r in results['results']:
+        lines.append(f"{r['elements']:>8} "+" ".join(f"{r[c]*1e3:>14.2f}" for c in columns))
+    lines.append("")
+    lines.append(f"{'elements':>8} {'devices':>8} {'create [ms]':>12} {'memory [MB]':>12} {'first use [ms]':>15}")
+    for r in results['results']:
+        for mode, d in r['devices'].items():
+            lines.append(f"{r['elements']:>8} {mode:>8} {d['time']*1e3:>12.1f} {d['memory']/1024**2:>12.2f} "
+                         f"{d['first_use']*1e3:>15.2f}")
+    return "\n".join(lines)
+
+
+def format_results(results:dict)->str:
+    """Table of the mean time per point of each phase, in ms"""
+    columns = list(PHASES)+['other', 'point']
+    lines = [f"{'engine':>7} {'rays':>7} {'workers':>7} "+" ".join(f"{c[:10]:>10}" for c in columns)]
+    for r in results['results']:
+        values = " ".join(f"{r['summary'].get(c, {}).get('mean', np.nan)*1e3:>10.1f}" for c in columns)
+        lines.append(f"{r['engine']:>7} {r['nrays']:>7} {r['workers']:>7} {values}")
+    return "\n".join(lines)
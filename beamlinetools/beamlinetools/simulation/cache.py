@@ -0,0 +1,342 @@
+import os
+import json
+import time
+import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from .rml_utils import rml_key, hash_parameters
+from .engine import SimulationEngineBase, submit_simulation, submit_energy_scan, chain_future, simulation_seed, simulation_precision
+from .shared_rays import materialize_shared_rays
+
+
+def exported_files(path:str, exports_list)->list:
+    """List the files produced in ``path`` for the exported elements
+
+    RAY-UI exports are named ``<element>-<format>.csv`` and the
+    post-processed results ``<element>_analyzed_rays.dat``.
+
+    Args:
+        path (str): the simulation folder
+        exports_list (list): the exported elements
+
+    Returns:
+        list: the file names (not the full path)
+    """
+    if not os.path.isdir(path):
+        return []
+    files = []
+    for fn in sorted(os.listdir(path)):
+        for exp in exports_list:
+            if fn.startswith(exp+'-') or fn.startswith(exp+'_'):
+                files.append(fn)
+                break
+    return files
+
+
+class SimulationCache():
+    """On-disk, content-addressed cache of simulation results.
+
+    Each entry is a folder named after the key of the simulation
+    (see :func:`rml_key`) containing the exported files. An index
+    is kept in ``index.json`` to survive between sessions.
+    Entries are evicted least-recently-used first, as soon as either
+    ``max_entries`` or ``max_size`` is exceeded. The access times of the
+    hits are written to the index at most every ``index_save_interval``
+    seconds, and by :meth:`flush`.
+
+    Args:
+        cache_folder (str): folder where the cache is stored
+        max_entries (int, optional): maximum number of entries. Defaults to 1000.
+        max_size (int, optional): maximum size of the cache in bytes. Defaults to 2 GB.
+    """
+    index_file = 'index.json'
+    index_save_interval = 10.
+
+    def __init__(self, cache_folder:str, max_entries:int=1000, max_size:int=2*1024**3):
+        self.cache_folder = cache_folder
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+        self._entries = OrderedDict()
+        # the index has access times that are not saved yet
+        self._dirty = False
+        self._last_save = 0.
+        if not os.path.exists(self.cache_folder):
+            os.makedirs(self.cache_folder)
+        self._load_index()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    @property
+    def size(self)->int:
+        """Total size of the cached files in bytes"""
+        return sum(entry['size'] for entry in self._entries.values())
+
+    def key(self, rml, exports_list, export_format='RawRaysOutgoing')->str:
+        """Return the key of a simulation, see :func:`rml_key`"""
+        return rml_key(rml, exports_list, export_format)
+
+    def get(self, key:str, path:str)->bool:
+        """Copy the cached results of ``key`` into ``path``
+
+        Args:
+            key (str): the key of the simulation
+            path (str): destination folder
+
+        Returns:
+            bool: True if the results were found in the cache
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or not os.path.isdir(self._entry_folder(key)):
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return False
+            self._entries.move_to_end(key)
+            entry['last_access'] = time.time()
+            self.hits += 1
+            if not os.path.exists(path):
+                os.makedirs(path)
+            for fn in entry['files']:
+                shutil.copyfile(os.path.join(self._entry_folder(key), fn), os.path.join(path, fn))
+            self._dirty = True
+            if time.time()-self._last_save > self.index_save_interval:
+                self._save_index()
+        return True
+
+    def put(self, key:str, path:str, exports_list, rml_file:str=None):
+        """Store the exported files found in ``path`` under ``key``
+
+        Args:
+            key (str): the key of the simulation
+            path (str): folder containing the results
+            exports_list (list): the exported elements
+            rml_file (str, optional): the rml file the simulation originates from,
+                                      used by :meth:`invalidate`. Defaults to None.
+        """
+        # the rays in shared memory only live until the end of the point
+        materialize_shared_rays(path, exports_list)
+        files = exported_files(path, exports_list)
+        if not files:
+            return
+        with self._lock:
+            # also removes a folder left by a crash, that is not in the index
+            self._remove(key)
+            folder = self._entry_folder(key)
+            os.makedirs(folder)
+            size = 0
+            for fn in files:
+                shutil.copyfile(os.path.join(path, fn), os.path.join(folder, fn))
+                size += os.path.getsize(os.path.join(folder, fn))
+            self._entries[key] = {'files': files,
+                                  'size': size,
+                                  'rml': os.path.abspath(rml_file) if rml_file is not None else None,
+                                  'exports': sorted(set(exports_list)),
+                                  'last_access': time.time()}
+            self._evict()
+            self._save_index()
+
+    def invalidate(self, rml_file:str=None)->int:
+        """Remove entries from the cache
+
+        Args:
+            rml_file (str, optional): remove only the entries originating from this rml file.
+                                      If None the whole cache is cleared. Defaults to None.
+
+        Returns:
+            int: the number of removed entries
+        """
+        with self._lock:
+            if rml_file is None:
+                keys = list(self._entries)
+            else:
+                rml_file = os.path.abspath(rml_file)
+                keys = [k for k, e in self._entries.items() if e['rml'] == rml_file]
+            for key in keys:
+                self._remove(key)
+            self._save_index()
+        return len(keys)
+
+    def flush(self):
+        """Write the access times of the last hits to the index"""
+        with self._lock:
+            if self._dirty:
+                self._save_index()
+
+    def stats(self)->dict:
+        """Return hits, misses, number of entries and size of the cache
+
+        Returns:
+            dict: the statistics of the cache
+        """
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits/lookups if lookups else 0.,
+                'entries': len(self._entries),
+                'size': self.size}
+
+    def reset_stats(self):
+        """Reset hits and misses counters"""
+        self.hits = 0
+        self.misses = 0
+
+    def _entry_folder(self, key):
+        return os.path.join(self.cache_folder, key[:2], key)
+
+    def _remove(self, key):
+        self._entries.pop(key, None)
+        shutil.rmtree(self._entry_folder(key), ignore_errors=True)
+
+    def _evict(self):
+        size = self.size
+        while self._entries and (len(self._entries) > self.max_entries or size > self.max_size):
+            key = next(iter(self._entries))
+            size -= self._entries[key]['size']
+            self._remove(key)
+
+    def _load_index(self):
+        fn = os.path.join(self.cache_folder, self.index_file)
+        if not os.path.exists(fn):
+            return
+        try:
+            with open(fn) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return
+        for key, entry in sorted(entries.items(), key=lambda item: item[1]['last_access']):
+            if os.path.isdir(self._entry_folder(key)):
+                self._entries[key] = entry
+        self._evict()
+
+    def _save_index(self):
+        fn = os.path.join(self.cache_folder, self.index_file)
+        with open(fn+'.tmp', 'w') as f:
+            json.dump(self._entries, f)
+        os.replace(fn+'.tmp', fn)
+        self._dirty = False
+        self._last_save = time.time()
+
+
+class CachedSimulationEngine(SimulationEngineBase):
+    """Simulation engine that looks up the results in a :class:`SimulationCache`
+    before delegating the simulation to another engine.
+
+    It exposes the same interface as the engines of raypyng-bluesky, so it
+    can be set on the trigger detector with ``set_simulation_engine``.
+    When the wrapped engine is seeded (see :func:`simulation_seed`) the seed
+    is part of the key, so the runs with common random numbers only reuse
+    the results simulated with their seed. Likewise the tolerance of a
+    :class:`ProgressiveSimulationEngine` (see :func:`simulation_precision`)
+    is part of the key, so a result is not reused at a finer tolerance.
+
+    Args:
+        engine: the simulation engine used in case of a cache miss
+        cache (SimulationCache): the cache
+        export_format (str, optional): the exported format. Defaults to 'RawRaysOutgoing'.
+    """
+    def __init__(self, engine, cache:SimulationCache, export_format='RawRaysOutgoing'):
+        self.engine = engine
+        self.cache = cache
+        self.export_format = export_format
+
+    def setup_simulation(self):
+        """Prepare the wrapped engine, the engine is only started on a cache miss
+
+        Returns:
+            the simulation api of the wrapped engine
+        """
+        return self.engine.setup_simulation()
+
+    def simulate(self, path, rml, exports_list):
+        """Copy the results from the cache, or simulate and store them
+
+        Args:
+            path (str): the path to the temporary folder
+            rml (RMLFile): the instance of the RMLFile class used to save the rml file
+            exports_list (list): list of the exported objects
+        """
+        key = self._key(rml, exports_list)
+        if self.cache.get(key, path):
+            return
+        self.engine.simulate(path, rml, exports_list)
+        self.cache.put(key, path, exports_list, rml_file=rml.template)
+
+    def submit(self, path, rml, exports_list):
+        """Like :meth:`simulate`, but return a future
+
+        On a cache miss the simulation is submitted to the wrapped engine,
+        and the future is resolved once the results are stored in the cache.
+        """
+        key = self._key(rml, exports_list)
+        if self.cache.get(key, path):
+            future = Future()
+            future.set_result(None)
+            return future
+        future = submit_simulation(self.engine, path, rml, exports_list)
+        rml_file = rml.template
+        return chain_future(future, lambda result: self.cache.put(key, path, exports_list, rml_file=rml_file))
+
+    @property
+    def energy_scans(self)->bool:
+        """True if the wrapped engine simulates energy scans in a single pass"""
+        return getattr(self.engine, 'energy_scans', False)
+
+    def submit_energy_scan(self, paths, rml, exports_list, param, energies)->list:
+        """Like :meth:`submit`, for all the points of an energy scan, see :func:`submit_energy_scan`
+
+        The energies found in the cache are copied, the others are submitted
+        together to the wrapped engine and stored in the cache once simulated.
+        """
+        saved = param.cdata
+        keys = []
+        try:
+            for energy in energies:
+                param.cdata = str(energy)
+                keys.append(self._key(rml, exports_list))
+        finally:
+            param.cdata = saved
+        futures = []
+        missing = []
+        for i, (key, path) in enumerate(zip(keys, paths)):
+            future = Future()
+            if self.cache.get(key, path):
+                future.set_result(None)
+            else:
+                missing.append(i)
+            futures.append(future)
+        if not missing:
+            return futures
+        submitted = submit_energy_scan(self.engine, [paths[i] for i in missing], rml, exports_list, param,
+                                       [energies[i] for i in missing])
+        rml_file = rml.template
+        for i, future in zip(missing, submitted):
+            futures[i] = chain_future(future, lambda result, key=keys[i], path=paths[i]:
+                                      self.cache.put(key, path, exports_list, rml_file=rml_file))
+        return futures
+
+    def shutdown(self):
+        self.cache.flush()
+        if hasattr(self.engine, 'shutdown'):
+            self.engine.shutdown()
+
+    def _key(self, rml, exports_list)->str:
+        key = self.cache.key(rml, exports_list, self.export_format)
+        seed = simulation_seed(self.engine)
+        if seed is not None:
+            # the rays of a seeded engine depend on the seed too
+            key = hash_parameters(key, seed)
+        precision = simulation_precision(self.engine)
+        if precision is not None:
+            # a progressive engine traces as many rays as its tolerance requires
+            key = hash_parameters(key, *precision)
+        return key
@@ -0,0 +1,180 @@
+import asyncio
+import logging
+import itertools
+import threading
+from concurrent.futures import Future, InvalidStateError
+
+from .engine import SimulationEngineBase
+from .server import DEFAULT_PORT, read_message, encode_message, unpack_files
+
+logger = logging.getLogger(__name__)
+
+
+class SimulationClient(SimulationEngineBase):
+    """Simulation engine sending the simulations to a :class:`SimulationServer`
+
+    The jobs submitted within ``batch_window`` seconds (e.g. all the points
+    of a scan prefetched by the :class:`LookAheadSimulationEngine`) are sent
+    to the server in a single message, and the results are written into
+    the simulation folders as soon as the server sends them back. The
+    connection is handled by an event loop running in a background thread,
+    and opened at the first simulation.
+
+    Args:
+        host (str, optional): the address of the server. Defaults to '127.0.0.1'.
+        port (int, optional): the port of the server. Defaults to 12345.
+        batch_window (float, optional): time in seconds during which the submitted jobs
+                                        are grouped in one message. Defaults to 0.01.
+        token (str, optional): the secret shared with the server, see :class:`SimulationServer`.
+                               Defaults to None.
+    """
+    def __init__(self, host:str='127.0.0.1', port:int=DEFAULT_PORT, batch_window:float=0.01, token:str=None):
+        self.host = host
+        self.port = port
+        self.batch_window = batch_window
+        self.token = token
+        self.round_trips = 0
+        self._ids = itertools.count()
+        self._jobs = {}
+        self._batch = []
+        self._writer = None
+        self._connected = None
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='simulation-client', daemon=True)
+        self._thread.start()
+
+    def submit(self, path, rml, exports_list):
+        return self._submit_file(path, self.write_rml(path, rml), exports_list)
+
+    def run(self, path, rml_file, exports_list):
+        return self._submit_file(path, rml_file, exports_list).result()
+
+    def stats(self)->dict:
+        """Return the number of round-trips to the server and of pending jobs
+
+        Returns:
+            dict: round_trips and pending
+        """
+        return {'round_trips': self.round_trips,
+                'pending': len(self._jobs)}
+
+    def cancel(self)->int:
+        """Cancel the jobs waiting for their results, the server drops those that did not start yet
+
+        Returns:
+            int: the number of cancelled jobs
+        """
+        async def pending():
+            return [future for path, future in self._jobs.values()]
+        futures = asyncio.run_coroutine_threadsafe(pending(), self._loop).result()
+        return sum(future.cancel() for future in futures)
+
+    def shutdown(self):
+        async def close():
+            if self._writer is not None:
+                self._writer.close()
+        asyncio.run_coroutine_threadsafe(close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def _submit_file(self, path, rml_file, exports_list)->Future:
+        with open(rml_file, 'rb') as f:
+            content = f.read()
+        future = Future()
+        job_id = next(self._ids)
+        future.add_done_callback(lambda f: self._cancel(job_id) if f.cancelled() else None)
+        self._loop.call_soon_threadsafe(self._add_job, job_id, path, content, list(exports_list), future)
+        return future
+
+    def _add_job(self, job_id, path, content, exports_list, future):
+        if future.cancelled():
+            return
+        self._jobs[job_id] = (path, future)
+        self._batch.append({'id': job_id, 'exports': exports_list, 'rml': content})
+        if len(self._batch) == 1:
+            self._loop.call_later(self.batch_window, lambda: asyncio.ensure_future(self._send_batch()))
+
+    def _cancel(self, job_id):
+        def cancel():
+            if self._jobs.pop(job_id, None) is not None and self._writer is not None:
+                self._writer.write(encode_message({'type': 'cancel', 'ids': [job_id]}))
+        self._loop.call_soon_threadsafe(cancel)
+
+    async def _connect(self)->bool:
+        if self._connected is None:
+            self._connected = asyncio.ensure_future(self._open_connection())
+        return await asyncio.shield(self._connected)
+
+    async def _open_connection(self)->bool:
+        try:
+            reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        except OSError as e:
+            self._connected = None
+            self._fail(ConnectionError(f"Cannot connect to the simulation server {self.host}:{self.port}: {e}"))
+            return False
+        if self.token is not None:
+            self._writer.write(encode_message({'type': 'hello', 'token': self.token}))
+        asyncio.ensure_future(self._read_results(reader))
+        return True
+
+    async def _send_batch(self):
+        batch, self._batch = self._batch, []
+        batch = [job for job in batch if job['id'] in self._jobs]
+        if not batch or not await self._connect():
+            return
+        header = {'type': 'submit',
+                  'jobs': [{'id': job['id'], 'exports': job['exports'], 'rml_size': len(job['rml'])} for job in batch]}
+        self._writer.write(encode_message(header, b''.join(job['rml'] for job in batch)))
+        self.round_trips += 1
+        try:
+            await self._writer.drain()
+        except ConnectionError as e:
+            self._lost(e)
+
+    async def _read_results(self, reader):
+        try:
+            while True:
+                message = await read_message(reader)
+                if message is None:
+                    break
+                header, payload = message
+                if header.get('id') is None:
+                    if header['type'] == 'error':
+                        logger.error(f"Simulation server error: {header.get('error')}")
+                    continue
+                path, future = self._jobs.pop(header['id'], (None, None))
+                if future is None or future.cancelled():
+                    continue
+                if header['type'] == 'result':
+                    try:
+                        unpack_files(path, header['files'], payload)
+                        _resolve(future, None)
+                    except Exception as e:
+                        _resolve(future, exception=e)
+                else:
+                    _resolve(future, exception=RuntimeError(f"Simulation failed on the server: {header.get('error')}"))
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            self._lost(e)
+            return
+        self._lost(ConnectionError("The simulation server closed the connection"))
+
+    def _lost(self, error):
+        self._connected = None
+        self._writer = None
+        self._fail(ConnectionError(f"Connection with the simulation server lost: {error}"))
+
+    def _fail(self, error):
+        jobs, self._jobs = self._jobs, {}
+        for path, future in jobs.values():
+            _resolve(future, exception=error)
+
+
+def _resolve(future:Future, result=None, exception=None):
+    # the future may be cancelled by another thread at any time
+    try:
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+    except InvalidStateError:
+        pass
@@ -0,0 +1,331 @@
+import os
+import json
+import logging
+import threading
+
+import numpy as np
+
+from ophyd import Component as Cpt
+from ophyd.status import DeviceStatus
+from raypyng_bluesky.detector import RaypyngDetector, RaypyngDetectorDevice, RaypyngTriggerDetector
+
+from .rays import load_rays, ray_file
+from .shared_rays import shared_ray_file
+from .reductions import ray_statistics, CHUNK_SIZE
+from .scheduler import current_run, scheduled_run
+from .interrupts import cancel_run_simulations, resume_run_simulations
+
+logger = logging.getLogger(__name__)
+
+# the signals computed from the rays by detector_statistics
+SIGNALS = ('intensity', 'bandwidth', 'hor_foc', 'ver_foc')
+
+# the simulation folder of the last trigger of each rml file, in each thread, see reading_folder
+_reading = threading.local()
+
+
+def reading_folder(rml, default:str)->str:
+    """Return the simulation folder read by the detectors of ``rml`` in this thread
+
+    Each RunEngine attached to the twin has its own trigger detector, simulating
+    in its own folder (see :meth:`TwinOphydDevices.attach`). A trigger detector
+    records its folder for the thread that triggers it, the thread of the
+    RunEngine, which then reads the detectors from the same thread.
+
+    Args:
+        rml (RMLFile): the rml file of the detectors
+        default (str): the folder returned if no trigger detector of ``rml`` was triggered from this thread
+
+    Returns:
+        str: the simulation folder
+    """
+    return getattr(_reading, 'folders', {}).get(id(rml), default)
+
+
+def source_element(rml):
+    """Return the source of an rml file, the first element with ``numberRays``"""
+    for oe in rml.beamline.children():
+        if hasattr(oe, 'numberRays'):
+            return oe
+    raise ValueError("No source found in the rml file")
+
+
+def source_flux(rml)->tuple:
+    """Return the photon flux and the number of rays of the source of an rml file"""
+    source = source_element(rml)
+    return float(source.photonFlux.cdata), float(source.numberRays.cdata)
+
+
+def simulated_source_flux(path:str, element:str, source:tuple)->tuple:
+    """Return the photon flux and the number of rays of the source of a simulation
+
+    RAY-UI computes the photon flux of some sources, e.g. of a Dipole at the
+    simulated photon energy, and saves it in the rml file of the simulation,
+    from which it is post-processed into the ``SourcePhotonFlux`` of
+    ``<element>_analyzed_rays.dat`` (see :func:`postprocess_rays`). That file
+    is copied with the rays by the cache, the look-ahead and the simulation
+    server, unlike the rml file.
+
+    Args:
+        path (str): the simulation folder
+        element (str): the exported element
+        source (tuple): photon flux and number of rays of the simulated rml file, see
+                        :func:`source_flux`, the flux is used if the folder has no analyzed rays
+
+    Returns:
+        tuple: the photon flux and the number of rays
+    """
+    analyzed = os.path.join(path, element+'_analyzed_rays.dat')
+    if not os.path.exists(analyzed):
+        return source
+    # the columns of the RayProperties of raypyng, the source flux is the first one
+    flux = float(np.loadtxt(analyzed, ndmin=1)[0])
+    return flux, source[1]
+
+
+def statistics_file(path:str, element:str)->str:
+    """Return the name of the file with the statistics of an exported element
+
+    Engines that do not export rays, like the :class:`SurrogateSimulationEngine`,
+    or that know more than the rays, like the :class:`ProgressiveSimulationEngine`,
+    write the values of the detector signals in ``<path>/<element>_statistics.json``.
+    """
+    return os.path.join(path, element+'_statistics.json')
+
+
+def load_statistics(path:str, element:str, export_format='RawRaysOutgoing')->dict:
+    """Read the statistics file of an exported element, if it is up to date
+
+    Args:
+        path (str): the simulation folder
+        element (str): the exported element
+        export_format (str, optional): the exported format. Defaults to 'RawRaysOutgoing'.
+
+    Returns:
+        dict: the values of the signals, None if the file does not exist or
+              is older than the rays
+    """
+    json_file = statistics_file(path, element)
+    if not os.path.exists(json_file):
+        return None
+    for rays_file in (ray_file(path, element, export_format), shared_ray_file(path, element, export_format)):
+        if os.path.exists(rays_file) and os.path.getmtime(json_file) < os.path.getmtime(rays_file):
+            return None
+    with open(json_file) as f:
+        return json.load(f)
+
+
+def write_statistics(path:str, element:str, statistics:dict):
+    """Write the statistics file of an exported element, see :func:`statistics_file`"""
+    if not os.path.exists(path):
+        os.makedirs(path)
+    with open(statistics_file(path, element), 'w') as f:
+        json.dump(statistics, f)
+
+
+def detector_statistics(rays, source:tuple, current_correction:float=3, chunk_size:int=CHUNK_SIZE)->dict:
+    """Compute the values of the signals of a :class:`TwinDetectorDevice`
+
+    Args:
+        rays (RayTable): the rays reaching the detector
+        source (tuple): photon flux and number of rays of the source, see :func:`source_flux`
+        current_correction (float, optional): ratio between the ring current and the
+                                              current of the flux of the source. Defaults to 3.
+        chunk_size (int, optional): number of rays read at once. Defaults to 1000000.
+
+    Returns:
+        dict: intensity [ph/s], bandwidth [eV], hor_foc and ver_foc [mm], uncertainty (0)
+              and mc_error (nan, not estimated)
+    """
+    flux = source[0]*len(rays)/source[1]
+    statistics = {'intensity': flux*current_correction,
+                  'bandwidth': 0., 'hor_foc': 0., 'ver_foc': 0., 'uncertainty': 0., 'mc_error': np.nan}
+    if len(rays) > 0:
+        reduced = ray_statistics(rays, ('OX', 'OY', 'EN'), chunk_size)
+        statistics['bandwidth'] = reduced['EN']['fwhm']
+        statistics['hor_foc'] = reduced['OX']['fwhm']
+        statistics['ver_foc'] = reduced['OY']['fwhm']
+    return statistics
+
+
+class TwinDetector(RaypyngDetector):
+    """Detector signal reading the binary ray files, see :func:`load_rays`
+
+    The values are taken from the statistics of the parent
+    :class:`TwinDetectorDevice`, so all the signals of a detector
+    are computed with a single read of the rays.
+    """
+    def get(self):
+        return self.parent.statistics()[self.information_to_extract]
+
+
+class TwinDetectorDevice(RaypyngDetectorDevice):
+    """Same as :class:`RaypyngDetectorDevice`, reading the binary ray files
+
+    The rays are reduced in chunks (see :func:`ray_statistics`) the first
+    time a signal is read after a simulation, so the memory used does not
+    depend on the number of rays. The intensity is in photons/s, the
+    bandwidth in eV and the focus sizes (fwhm) in mm, as with raypyng-bluesky
+    (whose signal names say um). ``uncertainty`` is the relative
+    uncertainty of the values predicted by a surrogate model, 0 when
+    the values come from a simulation. ``mc_error`` is the relative Monte
+    Carlo error estimated by the :class:`ProgressiveSimulationEngine`, nan
+    when it is not estimated.
+
+    The simulations give the intensity at the nominal ring current. With
+    ``ring_current`` the intensity is scaled to the current of the ring each
+    time it is read (see :class:`RingCurrentScaling`), and ``ring_current``
+    is the current used, in mA.
+    """
+    intensity = Cpt(TwinDetector, name='_intensity[ph/s/0.1A/BW]', kind='hinted')
+    bw =        Cpt(TwinDetector, name='_bandwidth[eV]', kind='hinted')
+    hor_foc =   Cpt(TwinDetector, name='_hor_foc[um]', kind='hinted')
+    ver_foc =   Cpt(TwinDetector, name='_Ver_foc[um]', kind='hinted')
+    uncertainty = Cpt(TwinDetector, name='_uncertainty', kind='normal')
+    mc_error =    Cpt(TwinDetector, name='_mc_error', kind='normal')
+    ring_current = Cpt(TwinDetector, name='_ring_current', kind='normal')
+
+    # the photon flux of the source is given for 100 mA, the ring current is 300 mA
+    source_current = 100
+    current_correction = 3
+    export_format = 'RawRaysOutgoing'
+    chunk_size = CHUNK_SIZE
+
+    def __init__(self, *args, rml, tmp, ring_current=None, **kwargs):
+        super().__init__(*args, rml=rml, tmp=tmp, **kwargs)
+        self.ring_current_scaling = ring_current
+        for signal in (self.uncertainty, self.mc_error, self.ring_current):
+            signal.rml = rml
+            signal.set_simulation_temporary_folder(tmp)
+            signal.information_to_extract = signal.attr_name
+            signal.parent_detector_name = self.name
+            signal.name = self.name+'_'+signal.attr_name
+        self._lock = threading.Lock()
+        # by simulation folder, one for each RunEngine, see reading_folder
+        self._source = {}
+        self._statistics = {}
+        self._stagings = 0
+
+    def stage(self):
+        """Stage the device, once for all the RunEngines attached to the twin using it"""
+        with self._lock:
+            self._stagings += 1
+            if self._stagings > 1:
+                return [self]
+        return super().stage()
+
+    def unstage(self):
+        """Unstage the device once the last RunEngine using it unstages it"""
+        with self._lock:
+            self._stagings = max(self._stagings-1, 0)
+            if self._stagings > 0:
+                return [self]
+        return super().unstage()
+
+    @property
+    def nominal_current(self)->float:
+        """The ring current of the simulated intensities [mA]"""
+        return self.source_current*self.current_correction
+
+    def statistics(self)->dict:
+        """Return intensity, bandwidth and focus sizes of the last simulation
+
+        The intensity is scaled to the ring current if ``ring_current`` is set.
+
+        Returns:
+            dict: the values of the signals, by ``information_to_extract``
+        """
+        statistics = dict(self.simulated_statistics())
+        scaling = self.ring_current_scaling
+        if scaling is None:
+            statistics['ring_current'] = self.nominal_current
+            return statistics
+        current = scaling.current()
+        statistics['intensity'] = float(scaling.scale(statistics['intensity'], self.nominal_current, current))
+        statistics['ring_current'] = current
+        return statistics
+
+    def simulated_statistics(self)->dict:
+        """Return the statistics of the last simulation, at the nominal ring current
+
+        They are computed once per simulation, with the photon flux of the source
+        computed by the simulation, see :func:`simulated_source_flux`. If an engine wrote the statistics
+        file (see :func:`statistics_file`) after the rays, the values are read from there.
+        Once raypyng-bluesky removed the simulation folder at the end of the run,
+        the statistics of the last simulation are kept, e.g. to follow the ring current.
+        The simulation folder is the one of the RunEngine reading the detector, see
+        :func:`reading_folder`.
+
+        Returns:
+            dict: the values of the signals, by ``information_to_extract``
+        """
+        path = reading_folder(self.intensity.rml, self.intensity.path)
+        if path in self._statistics and not os.path.exists(path):
+            return self._statistics[path]
+        statistics = load_statistics(path, self.name, self.export_format)
+        if statistics is not None:
+            with self._lock:
+                self._statistics[path], self._source[path] = statistics, None
+            return statistics
+        rays = load_rays(path, self.name, self.export_format)
+        with self._lock:
+            if path not in self._statistics or rays is not self._source[path]:
+                source = simulated_source_flux(path, self.name, source_flux(self.intensity.rml))
+                self._statistics[path] = detector_statistics(rays, source, self.current_correction, self.chunk_size)
+                self._source[path] = rays
+            return self._statistics[path]
+
+
+class TwinTriggerDetector(RaypyngTriggerDetector):
+    """Same as :class:`RaypyngTriggerDetector`, simulating for the run that triggers it
+
+    The simulation runs in its own thread, as in raypyng-bluesky, and is
+    submitted for the run of the RunEngine that triggered it, so that the
+    :class:`SimulationScheduler` queues it with the priority class of the run.
+    A failed simulation fails the status of the trigger.
+
+    When the RunEngine pauses or is suspended the simulations in flight are
+    cancelled (see :func:`cancel_run_simulations`), and the trigger waiting for
+    them is abandoned: the RunEngine triggers the point again when it resumes,
+    and the points of the scan that are still needed are submitted again.
+
+    ``shared`` is True when other RunEngines attached to the twin trigger their
+    own trigger detector with the same engine, only the simulations of the runs
+    of this one are then cancelled.
+    """
+    # the status of the trigger in flight when the RunEngine paused
+    _abandoned = None
+    shared = False
+
+    def trigger(self):
+        self.exports_list = list(set(self.exports_list))
+        # the RunEngine reads the detectors from this thread, see reading_folder
+        if not hasattr(_reading, 'folders'):
+            _reading.folders = {}
+        _reading.folders[id(self.rml)] = self.path
+        self.complete_status = DeviceStatus(self)
+        status, run = self.complete_status, current_run()
+
+        def simulate():
+            try:
+                with scheduled_run(run):
+                    self.simulation_engine.simulate(self.path, self.rml, self.exports_list)
+            except Exception as e:
+                if status is not self._abandoned:
+                    status.set_exception(e)
+                    return
+                # the RunEngine does not wait for it anymore, it must not fail the run
+                logger.debug(f"Abandoned trigger: {e}")
+                status.set_finished()
+            else:
+                status.set_finished()
+        threading.Thread(target=simulate, daemon=True).start()
+        return status
+
+    def pause(self):
+        self._abandoned = getattr(self, 'complete_status', None)
+        cancelled = cancel_run_simulations(self)
+        logger.info(f"RunEngine paused, {cancelled} simulations cancelled")
+
+    def resume(self):
+        resume_run_simulations(self)
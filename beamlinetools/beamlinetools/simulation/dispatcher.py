@@ -0,0 +1,380 @@
+import json
+import time
+import asyncio
+import logging
+import itertools
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+from .engine import SimulationEngineBase
+from .rml_model import rml_template, load_rml
+from .rml_utils import hash_parameters
+from .server import DEFAULT_PORT, read_message, encode_message, unpack_files
+from .client import _resolve
+
+logger = logging.getLogger(__name__)
+
+
+def parse_address(address, default_port:int=DEFAULT_PORT)->tuple:
+    """Return the host and the port of a worker
+
+    Args:
+        address (str or tuple): ``'host:port'``, ``'host'`` or ``(host, port)``
+        default_port (int, optional): the port if it is not given. Defaults to 12345.
+
+    Returns:
+        tuple: (host, port)
+    """
+    if not isinstance(address, str):
+        host, port = address
+        return host, int(port)
+    host, _, port = address.rpartition(':')
+    if not host:
+        return port, default_port
+    return host, int(port)
+
+
+class _Base():
+    # the parts of the template of an rml file, sent once to each worker
+    __slots__ = ('id', 'static', 'values', 'payload')
+
+    def __init__(self, parts:list):
+        self.static = parts[0::2]
+        self.values = parts[1::2]
+        self.payload = json.dumps(parts).encode()
+        self.id = hash_parameters(parts)[:16]
+
+
+class _Job():
+    __slots__ = ('id', 'path', 'exports', 'base', 'delta', 'future', 'attempts', 'worker', 'queued')
+
+    def __init__(self, job_id, path, exports, base, delta, future):
+        self.id = job_id
+        self.path = path
+        self.exports = exports
+        self.base = base
+        self.delta = delta
+        self.future = future
+        self.attempts = 0
+        self.worker = None
+        self.queued = time.monotonic()
+
+
+class _RemoteWorker():
+    # the connection with a worker and the jobs sent to it
+    def __init__(self, host:str, port:int):
+        self.host = host
+        self.port = port
+        self.writer = None
+        self.slots = 0
+        self.jobs = {}
+        self.base = None
+        self.alive = False
+        self.connecting = False
+        self.last_seen = 0.
+        self.last_attempt = -float('inf')
+        self.done = 0
+        self.failed = 0
+        self.lost = 0
+
+    @property
+    def name(self)->str:
+        return f"{self.host}:{self.port}"
+
+
+class SimulationDispatcher(SimulationEngineBase):
+    """Simulation engine spreading the simulations over the workers of many hosts
+
+    Each worker is a :class:`SimulationServer`, e.g. started on each host with
+    ``python -m beamlinetools.simulation worker --engine numpy --workers 8``.
+    The dispatcher connects to all of them, learns their number of slots, and
+    sends each job to the least loaded worker with a free slot. The other jobs
+    wait in the dispatcher, so that they go to the first worker that is free.
+
+    The rml file is not sent with each job: each worker receives once the
+    template of the rml file (see :class:`RMLTemplate`), the base, and each job
+    only carries the values that differ from it, a few bytes for the point of a
+    scan. A new base is sent when more than ``max_delta`` of the values changed.
+    The exported files come back in the binary payload of the result messages.
+
+    The workers send a heartbeat every ``heartbeat_interval`` seconds, also while
+    their slots are busy. A worker that is silent for ``heartbeat_timeout`` seconds,
+    or whose connection is lost, is dropped and its jobs are resubmitted to the
+    other workers, at most ``max_retries`` times. The dropped workers are
+    reconnected every ``reconnect_interval`` seconds. The connections are handled
+    by an event loop running in a background thread, and opened when the
+    dispatcher is created, so that ``max_workers`` is the number of slots of the workers.
+
+    Args:
+        workers (list): the addresses of the workers, ``'host:port'`` or ``(host, port)``
+        heartbeat_interval (float, optional): seconds between two heartbeats of the workers.
+                                              Defaults to 1.
+        heartbeat_timeout (float, optional): seconds without messages after which a worker
+                                             is dropped. Defaults to 5.
+        max_retries (int, optional): how many times the jobs of a dropped worker are resubmitted.
+                                     Defaults to 2.
+        reconnect_interval (float, optional): seconds between two connection attempts to a
+                                              worker. Defaults to 5.
+        wait_timeout (float, optional): seconds a job waits for a worker when none is
+                                        connected, before failing. Defaults to 60.
+        max_delta (float, optional): largest fraction of the values of the rml file sent as a delta.
+                                     Defaults to 0.25.
+        token (str, optional): the secret shared with the workers, see :class:`SimulationServer`.
+                               Defaults to None.
+    """
+    def __init__(self, workers, heartbeat_interval:float=1., heartbeat_timeout:float=5., max_retries:int=2,
+                 reconnect_interval:float=5., wait_timeout:float=60., max_delta:float=0.25, token:str=None):
+        if not workers:
+            raise ValueError("At least one worker is needed")
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.max_retries = max_retries
+        self.reconnect_interval = reconnect_interval
+        self.wait_timeout = wait_timeout
+        self.max_delta = max_delta
+        self.token = token
+        self.workers = [_RemoteWorker(*parse_address(address)) for address in workers]
+        self.resubmitted = 0
+        self.bases_sent = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self._ids = itertools.count()
+        self._queue = deque()
+        self._base = None
+        self._lock = threading.Lock()
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='simulation-dispatcher', daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._connect_all(), self._loop).result()
+        self._monitor = asyncio.run_coroutine_threadsafe(self._monitor_workers(), self._loop)
+
+    @property
+    def max_workers(self)->int:
+        """The number of slots of the workers, as many as workers before they are connected"""
+        return sum(worker.slots or 1 for worker in self.workers)
+
+    def submit(self, path, rml, exports_list):
+        base, delta = self._delta(rml)
+        future = Future()
+        job = _Job(next(self._ids), path, sorted(set(exports_list)), base, delta, future)
+        future.add_done_callback(lambda f: self._loop.call_soon_threadsafe(self._cancel_job, job)
+                                 if f.cancelled() else None)
+        self._loop.call_soon_threadsafe(self._add_job, job)
+        return future
+
+    def run(self, path, rml_file, exports_list):
+        return self.submit(path, load_rml(rml_file), exports_list).result()
+
+    def cancel(self)->int:
+        """Cancel the jobs waiting for a worker or for their results
+
+        The workers drop the jobs that did not start yet.
+
+        Returns:
+            int: the number of cancelled jobs
+        """
+        async def pending():
+            jobs = list(self._queue)
+            for worker in self.workers:
+                jobs.extend(worker.jobs.values())
+            return [job.future for job in jobs]
+        futures = asyncio.run_coroutine_threadsafe(pending(), self._loop).result()
+        return sum(future.cancel() for future in futures)
+
+    def stats(self)->dict:
+        """Return the state of the workers and the traffic
+
+        Returns:
+            dict: queued and resubmitted jobs, bases sent, bytes sent and received, and for
+                  each worker if it is alive, its slots, its running, done and failed jobs
+                  and how many times it was lost
+        """
+        async def collect():
+            return {'queued': len(self._queue),
+                    'resubmitted': self.resubmitted,
+                    'bases_sent': self.bases_sent,
+                    'bytes_sent': self.bytes_sent,
+                    'bytes_received': self.bytes_received,
+                    'workers': {w.name: {'alive': w.alive,
+                                         'slots': w.slots,
+                                         'running': len(w.jobs),
+                                         'done': w.done,
+                                         'failed': w.failed,
+                                         'lost': w.lost} for w in self.workers}}
+        return asyncio.run_coroutine_threadsafe(collect(), self._loop).result()
+
+    def shutdown(self):
+        async def close():
+            self._monitor.cancel()
+            for worker in self.workers:
+                writer, worker.writer = worker.writer, None
+                if writer is not None:
+                    writer.close()
+                worker.alive = False
+        asyncio.run_coroutine_threadsafe(close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def _delta(self, rml)->tuple:
+        # the base of the rml file, and the (slot, value) that differ from it
+        template = rml_template(rml)
+        template.sync()
+        parts = list(template.parts)
+        values = parts[1::2]
+        with self._lock:
+            base = self._base
+            if base is not None and len(values) == len(base.values) and parts[0::2] == base.static:
+                delta = [[slot, value] for slot, (value, old) in enumerate(zip(values, base.values)) if value != old]
+                if len(delta) <= self.max_delta*len(values):
+                    return base, delta
+            self._base = _Base(parts)
+            return self._base, []
+
+    def _add_job(self, job):
+        self._queue.append(job)
+        self._dispatch()
+
+    def _cancel_job(self, job):
+        worker = job.worker
+        if worker is None or worker.jobs.pop(job.id, None) is None:
+            return
+        if worker.writer is not None:
+            self._write(worker, encode_message({'type': 'cancel', 'ids': [job.id]}))
+        self._dispatch()
+
+    def _dispatch(self):
+        sent = {}
+        while self._queue:
+            free = [w for w in self.workers if w.alive and len(w.jobs) < w.slots]
+            if not free:
+                break
+            job = self._queue.popleft()
+            if job.future.done():
+                continue
+            worker = min(free, key=lambda w: len(w.jobs)/w.slots)
+            job.worker = worker
+            worker.jobs[job.id] = job
+            sent.setdefault(worker, []).append(job)
+        for worker, jobs in sent.items():
+            self._send_jobs(worker, jobs)
+
+    def _send_jobs(self, worker, jobs):
+        batch = []
+        for job in jobs:
+            if worker.base != job.base.id:
+                if batch:
+                    self._write(worker, encode_message({'type': 'submit', 'jobs': batch}))
+                    batch = []
+                self._write(worker, encode_message({'type': 'base', 'id': job.base.id}, job.base.payload))
+                worker.base = job.base.id
+                self.bases_sent += 1
+            batch.append({'id': job.id, 'exports': job.exports, 'base': job.base.id, 'delta': job.delta})
+        self._write(worker, encode_message({'type': 'submit', 'jobs': batch}))
+
+    def _write(self, worker, message:bytes):
+        worker.writer.write(message)
+        self.bytes_sent += len(message)
+
+    async def _connect_all(self):
+        await asyncio.gather(*[self._connect(worker) for worker in self.workers])
+        if not any(worker.alive for worker in self.workers):
+            logger.warning("No simulation worker is available, the dispatcher keeps trying to connect")
+
+    async def _connect(self, worker):
+        worker.connecting = True
+        worker.last_attempt = time.monotonic()
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(worker.host, worker.port),
+                                                    self.heartbeat_timeout)
+            hello = {'type': 'hello', 'heartbeat': self.heartbeat_interval}
+            if self.token is not None:
+                hello['token'] = self.token
+            writer.write(encode_message(hello))
+            message = await asyncio.wait_for(read_message(reader), self.heartbeat_timeout)
+            if message is None or message[0].get('type') != 'hello':
+                writer.close()
+                if message is not None and message[0].get('type') == 'error':
+                    logger.warning(f"The worker {worker.name} refused the connection: {message[0].get('error')}")
+                raise ConnectionError("no hello")
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            logger.debug(f"Cannot connect to the worker {worker.name}: {e!r}")
+            return
+        finally:
+            worker.connecting = False
+        worker.writer = writer
+        worker.slots = message[0]['slots']
+        worker.base = None
+        worker.alive = True
+        worker.last_seen = time.monotonic()
+        logger.info(f"Connected to the worker {worker.name}, {worker.slots} slots")
+        asyncio.ensure_future(self._read_results(worker, reader, writer))
+        self._dispatch()
+
+    async def _read_results(self, worker, reader, writer):
+        loop = asyncio.get_running_loop()
+        reason = "connection closed"
+        try:
+            while True:
+                message = await read_message(reader)
+                if message is None or worker.writer is not writer:
+                    break
+                worker.last_seen = time.monotonic()
+                header, payload = message
+                self.bytes_received += len(payload)
+                if header['type'] not in ('result', 'error'):
+                    continue
+                job = worker.jobs.pop(header['id'], None)
+                if job is None or job.future.done():
+                    continue
+                if header['type'] == 'result':
+                    try:
+                        await loop.run_in_executor(None, unpack_files, job.path, header['files'], payload)
+                        worker.done += 1
+                        _resolve(job.future, None)
+                    except Exception as e:
+                        _resolve(job.future, exception=e)
+                else:
+                    worker.failed += 1
+                    _resolve(job.future, exception=RuntimeError(
+                        f"Simulation failed on the worker {worker.name}: {header.get('error')}"))
+                self._dispatch()
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            reason = repr(e)
+        self._lost(worker, writer, reason)
+
+    def _lost(self, worker, writer, reason:str):
+        if worker.writer is not writer:
+            return
+        worker.writer = None
+        worker.alive = False
+        worker.lost += 1
+        writer.close()
+        jobs = [job for job in worker.jobs.values() if not job.future.done()]
+        worker.jobs.clear()
+        logger.warning(f"Worker {worker.name} lost ({reason}), resubmitting {len(jobs)} jobs")
+        for job in reversed(jobs):
+            job.worker = None
+            job.attempts += 1
+            if job.attempts > self.max_retries:
+                _resolve(job.future, exception=ConnectionError(
+                    f"Simulation lost {job.attempts} times, last on the worker {worker.name}"))
+                continue
+            self.resubmitted += 1
+            job.queued = time.monotonic()
+            self._queue.appendleft(job)
+        self._dispatch()
+
+    async def _monitor_workers(self):
+        while True:
+            now = time.monotonic()
+            for worker in self.workers:
+                if worker.alive and now-worker.last_seen > self.heartbeat_timeout:
+                    self._lost(worker, worker.writer, f"no heartbeat for {now-worker.last_seen:.1f} s")
+                elif not worker.alive and not worker.connecting and now-worker.last_attempt >= self.reconnect_interval:
+                    asyncio.ensure_future(self._connect(worker))
+            if not any(worker.alive for worker in self.workers):
+                while self._queue and now-self._queue[0].queued > self.wait_timeout:
+                    job = self._queue.popleft()
+                    _resolve(job.future, exception=ConnectionError("No simulation worker is available"))
+            await asyncio.sleep(min(self.heartbeat_interval, self.reconnect_interval)/2)
@@ -0,0 +1,321 @@
+import os
+from concurrent.futures import Future
+
+from .timing import span
+from .rml_model import write_rml_file
+
+
+class SimulationEngineBase():
+    """Base class for the simulation engines of the digital twin
+
+    The trigger detector of raypyng-bluesky only requires ``setup_simulation()``
+    and ``simulate(path, rml, exports_list)``. On top of this, the engines
+    deriving from this class can ``submit`` a simulation and return a
+    :class:`concurrent.futures.Future`, so that many simulations can run at the same time.
+
+    Subclasses must implement :meth:`run`.
+    """
+    rml_file_name = 'tmp.rml'
+
+    def setup_simulation(self):
+        """Get ready to simulate
+
+        Returns:
+            the engine itself, it is passed to the detectors as simulation api
+        """
+        return self
+
+    def write_rml(self, path:str, rml)->str:
+        """Save the current state of ``rml`` into ``path``
+
+        Only the parameters that changed since the last write are
+        patched in the text of the file, see :func:`rml_template`.
+
+        Args:
+            path (str): the simulation folder, created if it does not exist
+            rml (RMLFile): the rml file
+
+        Returns:
+            str: the path of the saved rml file
+        """
+        if not os.path.exists(path):
+            os.makedirs(path)
+        rml_file = os.path.join(path, self.rml_file_name)
+        with span('rml_serialization', path=path):
+            write_rml_file(rml, rml_file)
+        return rml_file
+
+    def run(self, path:str, rml_file:str, exports_list):
+        """Simulate ``rml_file`` and export the results into ``path``
+
+        Args:
+            path (str): the simulation folder
+            rml_file (str): the rml file to simulate
+            exports_list (list): list of the exported objects
+        """
+        raise NotImplementedError
+
+    def submit(self, path:str, rml, exports_list)->Future:
+        """Start a simulation of the current state of ``rml``
+
+        The rml file is saved before returning, so ``rml`` can be
+        modified as soon as this method returns. The default
+        implementation simulates synchronously.
+
+        Args:
+            path (str): the simulation folder
+            rml (RMLFile): the rml file
+            exports_list (list): list of the exported objects
+
+        Returns:
+            Future: resolved once the results are exported in ``path``
+        """
+        rml_file = self.write_rml(path, rml)
+        future = Future()
+        try:
+            future.set_result(self.run(path, rml_file, list(exports_list)))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def simulate(self, path:str, rml, exports_list):
+        """Simulate the current state of ``rml`` and wait for the results
+
+        Args:
+            path (str): the simulation folder
+            rml (RMLFile): the rml file
+            exports_list (list): list of the exported objects
+        """
+        return self.submit(path, rml, exports_list).result()
+
+    def cancel(self)->int:
+        """Cancel the submitted simulations that are not done, see :func:`cancel_simulations`
+
+        Returns:
+            int: the number of cancelled simulations
+        """
+        return 0
+
+    def resume(self):
+        """Resubmit the simulations still needed after :meth:`cancel`, see :func:`resume_simulations`"""
+        pass
+
+    def shutdown(self):
+        """Release the resources of the engine"""
+        pass
+
+
+def submit_simulation(engine, path:str, rml, exports_list)->Future:
+    """Submit a simulation to any engine
+
+    Engines that do not implement ``submit`` (e.g. the engines of
+    raypyng-bluesky) simulate synchronously.
+
+    Args:
+        engine: the simulation engine
+        path (str): the simulation folder
+        rml (RMLFile): the rml file
+        exports_list (list): list of the exported objects
+
+    Returns:
+        Future: resolved once the results are exported in ``path``
+    """
+    if hasattr(engine, 'submit'):
+        return engine.submit(path, rml, exports_list)
+    future = Future()
+    try:
+        future.set_result(engine.simulate(path, rml, exports_list))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def submit_batch(engine, path:str, rml, exports_list, batch:int)->Future:
+    """Submit one of many independent simulations of the same rml file
+
+    RAY-UI draws new random rays at each simulation. Engines with a seed
+    (e.g. :class:`NumpySimulationEngine`) implement ``submit_batch``, so
+    that each batch uses different random rays.
+
+    Args:
+        engine: the simulation engine
+        path (str): the simulation folder
+        rml (RMLFile): the rml file
+        exports_list (list): list of the exported objects
+        batch (int): the number of the batch
+
+    Returns:
+        Future: resolved once the results are exported in ``path``
+    """
+    if hasattr(engine, 'submit_batch'):
+        return engine.submit_batch(path, rml, exports_list, batch)
+    return submit_simulation(engine, path, rml, exports_list)
+
+
+def submit_energy_scan(engine, paths, rml, exports_list, param, energies)->list:
+    """Submit all the points of a scan of the photon energy of the source as a single simulation
+
+    Engines with ``energy_scans`` set (e.g. :class:`NumpySimulationEngine`)
+    trace all the energies in one pass, see :func:`run_numpy_energy_scan`.
+
+    Args:
+        engine: the simulation engine
+        paths (list): the simulation folder of each energy
+        rml (RMLFile): the rml file
+        exports_list (list): list of the exported objects
+        param (ParamElement): the photon energy of the source in ``rml``
+        energies (list): the photon energies [eV]
+
+    Returns:
+        list: for each energy a future resolved once its results are exported in its folder,
+              None if the engine simulates one energy at a time
+    """
+    if not getattr(engine, 'energy_scans', False):
+        return None
+    return engine.submit_energy_scan(paths, rml, exports_list, param, energies)
+
+
+def submits_in_background(engine)->bool:
+    """Return True if the backend of an engine, the last engine of the chain, implements ``submit``
+
+    The engines of raypyng-bluesky (i.e. ``'rayui'``) do not: they drive a single
+    RAY-UI instance, simulating one point at a time in the thread that calls them.
+
+    Args:
+        engine: the simulation engine
+
+    Returns:
+        bool: True if the simulations can be submitted to the backend
+    """
+    while getattr(engine, 'engine', None) is not None:
+        engine = engine.engine
+    return hasattr(engine, 'submit')
+
+
+def cancel_simulations(engine)->int:
+    """Cancel the simulations of an engine and of the engines it wraps
+
+    Each engine of the chain (the wrapped engine is ``engine.engine``) that
+    implements ``cancel`` drops its queued simulations and interrupts the
+    running ones where it can (e.g. :class:`RayUIWorkerPool` kills the busy
+    RAY-UI instances), so that the workers are free at once. The futures
+    of the cancelled simulations are cancelled or fail.
+
+    Args:
+        engine: the simulation engine
+
+    Returns:
+        int: the number of cancelled simulations
+    """
+    cancelled = 0
+    while engine is not None:
+        if hasattr(engine, 'cancel'):
+            cancelled += engine.cancel()
+        engine = getattr(engine, 'engine', None)
+    return cancelled
+
+
+def resume_simulations(engine):
+    """Resubmit the simulations still needed after :func:`cancel_simulations`
+
+    E.g. the :class:`LookAheadSimulationEngine` resubmits the points of
+    the scan that were not simulated yet.
+
+    Args:
+        engine: the simulation engine
+    """
+    while engine is not None:
+        if hasattr(engine, 'resume'):
+            engine.resume()
+        engine = getattr(engine, 'engine', None)
+
+
+def simulation_seed(engine):
+    """Return the seed of the random rays of an engine, or of the engines it wraps
+
+    Args:
+        engine: the simulation engine
+
+    Returns:
+        the seed of the first engine of the chain with a ``seed`` attribute,
+        None if it is not set or if no engine has one (e.g. RAY-UI)
+    """
+    while engine is not None:
+        if hasattr(engine, 'seed'):
+            return engine.seed
+        engine = getattr(engine, 'engine', None)
+    return None
+
+
+def simulation_precision(engine):
+    """Return the settings deciding how many rays an engine, or the engines it wraps, traces
+
+    Args:
+        engine: the simulation engine
+
+    Returns:
+        the ``precision`` of the first engine of the chain that has one (e.g.
+        :class:`ProgressiveSimulationEngine`), None if no engine has one, then
+        the number of rays is ``numberRays`` of the rml file
+    """
+    while engine is not None:
+        if hasattr(engine, 'precision'):
+            return engine.precision
+        engine = getattr(engine, 'engine', None)
+    return None
+
+
+def seed_simulations(engine, seed)->list:
+    """Set the seed of the random rays of the engines of the chain that have one
+
+    Engines with a ``seed`` attribute (e.g. :class:`NumpySimulationEngine`)
+    then draw the same rays for every simulation of the same rml file.
+    RAY-UI draws new random rays at each simulation and cannot be seeded.
+
+    Args:
+        engine: the simulation engine
+        seed: the seed, None for fresh random rays
+
+    Returns:
+        list: (engine, previous seed) for each seeded engine, empty if no engine has a seed
+    """
+    seeded = []
+    while engine is not None:
+        if hasattr(engine, 'seed'):
+            seeded.append((engine, engine.seed))
+            engine.seed = seed
+        engine = getattr(engine, 'engine', None)
+    return seeded
+
+
+def chain_future(future:Future, callback)->Future:
+    """Return a future resolved after ``callback(result)`` is done
+
+    Args:
+        future (Future): the future to chain
+        callback (callable): called with the result of ``future``, if it succeeds
+
+    Returns:
+        Future: resolved with the result of ``future``, cancelling it cancels ``future``
+    """
+    chained = Future()
+    chained.add_done_callback(lambda c: future.cancel() if c.cancelled() else None)
+
+    def done(f):
+        if chained.cancelled():
+            return
+        if f.cancelled():
+            chained.cancel()
+            chained.set_running_or_notify_cancel()
+            return
+        if f.exception() is not None:
+            chained.set_exception(f.exception())
+            return
+        try:
+            callback(f.result())
+        except Exception as e:
+            chained.set_exception(e)
+        else:
+            chained.set_result(f.result())
+    future.add_done_callback(done)
+    return chained
@@ -0,0 +1,98 @@
+import threading
+from concurrent.futures import CancelledError
+
+import numpy as np
+
+from .engine import SimulationEngineBase
+from .rays import RayFileWriter, ray_file, postprocess_rays
+from .rml_utils import rml_key
+from .numpy_tracer import EXPORT_COLUMNS
+from .detectors import source_element
+from .timing import span
+
+
+class FakeSimulationEngine(SimulationEngineBase):
+    """Simulation engine producing random rays, without tracing
+
+    A stand-in for RAY-UI in tests and benchmarks: each exported element
+    gets ``transmission*numberRays`` gaussian rays around the photon energy of
+    the source, after waiting ``delay`` seconds to mimic the duration of a trace.
+    The files are the same as the ones of the other engines.
+    :meth:`cancel` interrupts the waiting simulations.
+
+    Args:
+        delay (float, optional): duration of each simulation in seconds. Defaults to 0.
+        transmission (float, optional): fraction of the rays reaching the exported elements. Defaults to 0.5.
+        seed (optional): if not None the rays only depend on the seed and on the rml file. Defaults to None.
+        max_workers (int, optional): if larger than 1 simulations submitted with
+                                     ``submit`` run in parallel threads. Defaults to 1.
+        export_format (str, optional): the exported format. Defaults to 'RawRaysOutgoing'.
+    """
+    def __init__(self, delay:float=0., transmission:float=0.5, seed=None, max_workers:int=1,
+                 export_format='RawRaysOutgoing'):
+        self.delay = delay
+        self.max_workers = max_workers
+        self.transmission = transmission
+        self.seed = seed
+        self.export_format = export_format
+        self.simulations = 0
+        self._executor = None
+        self._futures = set()
+        # set by cancel, then replaced for the next simulations
+        self._cancelled = threading.Event()
+
+    def run(self, path, rml_file, exports_list):
+        from raypyng.rml import RMLFile
+        with span('engine_load', path=path):
+            rml = RMLFile(rml_file)
+            source = source_element(rml)
+            nrays = int(float(source.numberRays.cdata)*self.transmission)
+            energy = float(source.photonEnergy.cdata) if hasattr(source, 'photonEnergy') else 1000.
+            seed = None if self.seed is None else [self.seed, int(rml_key(rml, exports_list)[:8], 16)]
+        rng = np.random.default_rng(seed)
+        cancelled = self._cancelled
+        with span('trace', path=path):
+            if cancelled.wait(self.delay):
+                raise CancelledError("The simulation was cancelled")
+            rays = {}
+            for exp in exports_list:
+                rays[exp] = np.zeros((nrays, len(EXPORT_COLUMNS)))
+                rays[exp][:, 0] = rng.normal(0, 0.03, nrays)
+                rays[exp][:, 1] = rng.normal(0, 0.01, nrays)
+                rays[exp][:, 5] = 1
+                rays[exp][:, 6] = rng.normal(energy, energy*1e-4, nrays)
+                rays[exp][:, 8] = 1
+        with span('export', path=path):
+            for exp in exports_list:
+                with RayFileWriter(ray_file(path, exp, self.export_format), EXPORT_COLUMNS) as writer:
+                    writer.write(rays[exp])
+                postprocess_rays(path, exp, rml_file, self.export_format)
+        self.simulations += 1
+
+    def submit(self, path, rml, exports_list):
+        if self.max_workers <= 1:
+            return super().submit(path, rml, exports_list)
+        if self._executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix='fake-engine')
+        rml_file = self.write_rml(path, rml)
+        future = self._executor.submit(self.run, path, rml_file, list(exports_list))
+        self._futures.add(future)
+        future.add_done_callback(self._futures.discard)
+        return future
+
+    def cancel(self)->int:
+        """Cancel the queued simulations and interrupt the waiting ones
+
+        Returns:
+            int: the number of cancelled queued simulations
+        """
+        cancelled = sum(future.cancel() for future in list(self._futures))
+        self._cancelled.set()
+        self._cancelled = threading.Event()
+        return cancelled
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
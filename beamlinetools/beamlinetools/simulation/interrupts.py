@@ -0,0 +1,83 @@
+import logging
+
+from bluesky.preprocessors import plan_mutator
+
+from .engine import cancel_simulations, resume_simulations
+from .scheduler import SimulationScheduler, current_run
+
+logger = logging.getLogger(__name__)
+
+
+def cancel_run_simulations(trigger_detector)->int:
+    """Cancel the simulations of the runs of a trigger detector
+
+    Same as :func:`cancel_simulations` if the trigger detector is the only
+    one of the twin. When other RunEngines attached to the twin trigger their
+    own trigger detectors (``trigger_detector.shared``, see :meth:`TwinOphydDevices.attach`)
+    the engines serve all of them: the look-ahead engine cancels the points it
+    prefetched into the folder of the trigger detector, the :class:`SimulationScheduler`
+    the simulations of the current run, and the engines it wraps are left alone.
+    Without a scheduler the running simulations of the run are not interrupted.
+
+    Args:
+        trigger_detector (TwinTriggerDetector): the trigger detector
+
+    Returns:
+        int: the number of cancelled simulations
+    """
+    engine = trigger_detector.simulation_engine
+    if not trigger_detector.shared:
+        return cancel_simulations(engine)
+    from .lookahead import LookAheadSimulationEngine
+    run = current_run()
+    cancelled = 0
+    while engine is not None:
+        if isinstance(engine, LookAheadSimulationEngine):
+            cancelled += engine.cancel(path=trigger_detector.path)
+        elif isinstance(engine, SimulationScheduler):
+            if run is not None and run.uid is not None:
+                cancelled += engine.cancel(uid=run.uid)
+            break
+        engine = getattr(engine, 'engine', None)
+    return cancelled
+
+
+def resume_run_simulations(trigger_detector):
+    """Resubmit the simulations cancelled by :func:`cancel_run_simulations`
+
+    Args:
+        trigger_detector (TwinTriggerDetector): the trigger detector
+    """
+    engine = trigger_detector.simulation_engine
+    if not trigger_detector.shared:
+        return resume_simulations(engine)
+    from .lookahead import LookAheadSimulationEngine
+    while engine is not None:
+        if isinstance(engine, LookAheadSimulationEngine):
+            engine.resume(path=trigger_detector.path)
+        engine = getattr(engine, 'engine', None)
+
+
+class AbortPreprocessor():
+    """RunEngine preprocessor cancelling the simulations of the twin when a run is aborted or fails
+
+    The pauses and the suspensions are handled by the trigger detector, see
+    :class:`TwinTriggerDetector`. This covers the runs closed without a pause,
+    e.g. by an exception in the plan, so that the prefetched points and the
+    simulations still running free the workers at once.
+
+    Args:
+        trigger_detector (TwinTriggerDetector): the trigger detector of the twin
+    """
+    def __init__(self, trigger_detector):
+        self.trigger_detector = trigger_detector
+
+    def __call__(self, plan):
+        def cancel_at_close_run(msg):
+            if msg.command == 'close_run' and msg.kwargs.get('exit_status') in ('abort', 'fail'):
+                cancelled = cancel_run_simulations(self.trigger_detector)
+                logger.info(f"Run closed with exit status {msg.kwargs['exit_status']}, "
+                            f"{cancelled} simulations cancelled")
+            return None, None
+
+        return (yield from plan_mutator(plan, cancel_at_close_run))
@@ -0,0 +1,82 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class LazyDevice():
+    """Placeholder of an ophyd device, built at its first use
+
+    The proxy is registered in the namespace in place of the device: the
+    device and its signals are only created when one of its attributes is
+    accessed, e.g. ``rp_M1.rx`` in the command line or ``read``/``stage``
+    when a plan uses it. Once built, the device replaces the proxy in the
+    namespace, and the proxy forwards everything to it.
+
+    Args:
+        name (str): the name of the device in the namespace
+        factory (callable): called without arguments, returns the device
+        name_space (dict, optional): the namespace where the device replaces
+                                     the proxy once built. Defaults to None.
+    """
+    __slots__ = ('_lazy_name', '_lazy_factory', '_lazy_device', '_lazy_name_space', '_lazy_lock')
+
+    def __init__(self, name:str, factory, name_space:dict=None):
+        object.__setattr__(self, '_lazy_name', name)
+        object.__setattr__(self, '_lazy_factory', factory)
+        object.__setattr__(self, '_lazy_device', None)
+        object.__setattr__(self, '_lazy_name_space', name_space)
+        object.__setattr__(self, '_lazy_lock', threading.Lock())
+
+    @property
+    def built(self)->bool:
+        """True if the device was created"""
+        return self._lazy_device is not None
+
+    def build(self):
+        """Create the device if needed and return it"""
+        device = self._lazy_device
+        if device is not None:
+            return device
+        with self._lazy_lock:
+            if self._lazy_device is None:
+                device = self._lazy_factory()
+                object.__setattr__(self, '_lazy_device', device)
+                object.__setattr__(self, '_lazy_factory', None)
+                name_space = self._lazy_name_space
+                if name_space is not None and name_space.get(self._lazy_name) is self:
+                    name_space[self._lazy_name] = device
+                logger.debug(f"Built the device {self._lazy_name}")
+        return self._lazy_device
+
+    def __getattr__(self, key):
+        if key.startswith('_lazy_'):
+            raise AttributeError(key)
+        return getattr(self.build(), key)
+
+    def __setattr__(self, key, value):
+        setattr(self.build(), key, value)
+
+    def __delattr__(self, key):
+        delattr(self.build(), key)
+
+    def __dir__(self):
+        return dir(self.build())
+
+    def __repr__(self):
+        if self._lazy_device is None:
+            return f"LazyDevice('{self._lazy_name}')"
+        return repr(self._lazy_device)
+
+
+def build_devices(name_space:dict)->list:
+    """Build all the :class:`LazyDevice` of a namespace
+
+    Returns:
+        list: the devices that were built
+    """
+    built = []
+    for value in list(name_space.values()):
+        if isinstance(value, LazyDevice) and not value.built:
+            built.append(value.build())
+    return built
@@ -0,0 +1,392 @@
+import os
+import shutil
+import logging
+import threading
+from collections import deque
+
+from bluesky import plan_patterns
+from bluesky.preprocessors import plan_mutator, baseline_wrapper
+from raypyng_bluesky.preprocessor import SupplementalDataRaypyng, trigger_sim
+
+from .rml_utils import rml_key
+from .cache import exported_files
+from .engine import SimulationEngineBase, submit_simulation, submit_energy_scan
+from .timing import hold_spans, release_spans
+from .detectors import source_element
+
+logger = logging.getLogger(__name__)
+
+# plan patterns whose trajectory is known when the run is opened
+LOOKAHEAD_PATTERNS = ('inner_product', 'inner_list_product', 'outer_product', 'outer_list_product')
+
+
+def rml_parameter(motor):
+    """Return the rml parameter moved by a raypyng motor
+
+    Args:
+        motor: an ophyd object
+
+    Returns:
+        the ParamElement of the rml file, None if ``motor`` is not a raypyng axis
+    """
+    if not hasattr(motor, 'raypyng'):
+        return None
+    return getattr(getattr(motor, 'setpoint', None), 'axis', None)
+
+
+def plan_points(md:dict, plan_args)->list:
+    """Compute the setpoints of a plan from the metadata of its start document
+
+    The motors are recorded with their ``repr`` in the metadata, the
+    objects are looked up in the arguments of the plan. The relative plans
+    (``rel_scan``, ``rel_list_scan``, ...) are offset by the position the
+    motors have in the rml file.
+
+    Args:
+        md (dict): the metadata of the ``open_run`` message
+        plan_args (list): the positional arguments of the plan
+
+    Returns:
+        list: for each point a list of (rml parameter, value), or None if the
+              trajectory of the plan is not known or not all the motors are raypyng axes
+    """
+    pattern = md.get('plan_pattern')
+    if pattern not in LOOKAHEAD_PATTERNS or md.get('plan_pattern_module') != plan_patterns.__name__:
+        return None
+    motors = {repr(arg): arg for arg in plan_args if hasattr(arg, 'raypyng')}
+    kwargs = dict(md['plan_pattern_args'])
+    kwargs['args'] = [motors.get(arg, arg) if isinstance(arg, str) else arg for arg in kwargs['args']]
+    if isinstance(kwargs.get('snake_axes'), str):
+        # list_grid_scan records the repr of snake_axes: True, False or a list of motors
+        snake_axes = kwargs['snake_axes']
+        if snake_axes in ('True', 'False'):
+            kwargs['snake_axes'] = snake_axes == 'True'
+        else:
+            kwargs['snake_axes'] = [motor for name, motor in motors.items() if name in snake_axes]
+    try:
+        cycler = getattr(plan_patterns, pattern)(**kwargs)
+    except Exception as e:
+        logger.debug(f"Could not compute the trajectory of the plan: {e}")
+        return None
+    params = {motor: rml_parameter(motor) for motor in cycler.keys}
+    if any(param is None for param in params.values()):
+        return None
+    offsets = {motor: 0. for motor in params}
+    if md.get('plan_name', '').startswith('rel'):
+        offsets = {motor: float(param.cdata) for motor, param in params.items()}
+    return [[(params[motor], offsets[motor]+value) for motor, value in point.items()] for point in cycler]
+
+
+class LookAheadSimulationEngine(SimulationEngineBase):
+    """Simulation engine that simulates the points of a scan in advance
+
+    The points passed to :meth:`prefetch` are submitted at once to the wrapped
+    engine, each in its own sub-folder of ``path`` (or in a worker folder of
+    ``workspace``, reused from point to point). When the trigger detector
+    asks to simulate a point that was prefetched, the engine waits for its
+    future and copies the results, otherwise the simulation is delegated
+    to the wrapped engine. To run in parallel the wrapped engine must
+    implement ``submit`` (e.g. :class:`PooledSimulationEngine` or
+    :class:`NumpySimulationEngine`), see :func:`submits_in_background`.
+
+    When the points only change the photon energy of the source (e.g.
+    ``scan([det], rp_Dipole.en, 500, 1500, 101)``) and the wrapped engine
+    simulates energy scans in a single pass (see :func:`submit_energy_scan`),
+    all the points are submitted as one simulation, regardless of ``window``.
+
+    :meth:`cancel` cancels the points that are not simulated yet, e.g. when
+    the scan is paused, and :meth:`resume` submits them again.
+
+    The points are prefetched for the simulation folder of one trigger
+    detector. The triggers of the other RunEngines attached to the twin (see
+    :meth:`TwinOphydDevices.attach`), e.g. a ``%ct`` during the scan, are
+    delegated to the wrapped engine, and a scan started by one of them
+    replaces the prefetched points.
+
+    The timing spans of a prefetched point (see :func:`hold_spans`) are
+    recorded when the trigger detector uses it, so the :class:`TimingDevice`
+    gives the engine load, trace and export times of each point. The
+    spans of the points that are never used are dropped.
+
+    Args:
+        engine: the simulation engine
+        window (int, optional): maximum number of points simulated ahead of the scan.
+                                If None all the points are submitted at once. Defaults to None.
+        export_format (str, optional): the exported format. Defaults to 'RawRaysOutgoing'.
+        workspace (ScratchWorkspace, optional): if not None the points are simulated in its
+                                                worker folders. Defaults to None.
+    """
+    lookahead_folder = 'lookahead'
+
+    def __init__(self, engine, window:int=None, export_format='RawRaysOutgoing', workspace=None):
+        if window is not None and window < 1:
+            raise ValueError(f"window must be at least 1, not {window}")
+        self.engine = engine
+        self.window = window
+        self.export_format = export_format
+        self.workspace = workspace
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+        self._futures = {}
+        self._points = deque()
+        self._count = 0
+        self._path = None
+        self._rml = None
+        self._exports_list = []
+        self._setup = False
+
+    def setup_simulation(self):
+        return self.engine.setup_simulation()
+
+    def prefetch(self, path:str, rml, exports_list, points):
+        """Submit the simulations of ``points``
+
+        The rml file is modified to compute each point and restored before returning.
+
+        Args:
+            path (str): the simulation folder of the trigger detector
+            rml (RMLFile): the rml file
+            exports_list (list): list of the exported objects
+            points (list): for each point a list of (rml parameter, value)
+        """
+        self.clear()
+        with self._lock:
+            if not self._setup:
+                # raypyng-bluesky sets the engine up at the first trigger, after the run is opened
+                self.engine.setup_simulation()
+                self._setup = True
+            self._path = path
+            self._rml = rml
+            self._exports_list = sorted(set(exports_list))
+            if not self._submit_energy_scan(points):
+                self._points.extend(points)
+                self._submit_points()
+
+    def simulate(self, path, rml, exports_list):
+        """Copy the results of a prefetched point, or simulate it
+
+        Args:
+            path (str): the path to the temporary folder
+            rml (RMLFile): the instance of the RMLFile class used to save the rml file
+            exports_list (list): list of the exported objects
+        """
+        with self._lock:
+            entry, count = None, None
+            key = None
+            if self._futures and path == self._path:
+                # not the triggers of the other RunEngines
+                key = rml_key(rml, exports_list, self.export_format)
+            if key in self._futures:
+                entry = self._futures[key]
+                entry[2] -= 1
+                count = entry[2]
+                if count == 0:
+                    del self._futures[key]
+                    self._submit_points()
+        if entry is None:
+            self.misses += 1
+            return self.engine.simulate(path, rml, exports_list)
+        folder, future = entry[:2]
+        try:
+            future.result()
+            release_spans(folder)
+            self.hits += 1
+            # raypyng-bluesky removes the folder at the end of each run
+            if not os.path.exists(path):
+                os.makedirs(path)
+            for fn in exported_files(folder, exports_list):
+                shutil.copyfile(os.path.join(folder, fn), os.path.join(path, fn))
+        finally:
+            if count == 0:
+                self._release(folder, future)
+
+    def clear(self, path:str=None):
+        """Cancel the pending simulations and remove their folders
+
+        Args:
+            path (str, optional): if not None, only if the points were prefetched
+                                  for this simulation folder. Defaults to None.
+        """
+        with self._lock:
+            if path is not None and path != self._path:
+                return
+            for folder, future, *_ in self._futures.values():
+                future.cancel()
+                self._release(folder, future)
+            self._futures.clear()
+            self._points.clear()
+            if self._path is not None and self.workspace is None:
+                shutil.rmtree(os.path.join(self._path, self.lookahead_folder), ignore_errors=True)
+
+    def cancel(self, path:str=None)->int:
+        """Cancel the points that are not simulated yet, :meth:`resume` submits them again
+
+        Args:
+            path (str, optional): if not None, only if the points were prefetched
+                                  for this simulation folder. Defaults to None.
+
+        Returns:
+            int: the number of cancelled simulations
+        """
+        with self._lock:
+            if path is not None and path != self._path:
+                return 0
+            points = []
+            for key, (folder, future, count, point) in list(self._futures.items()):
+                if future.done() and not future.cancelled() and future.exception() is None:
+                    continue
+                future.cancel()
+                self._release(folder, future)
+                del self._futures[key]
+                points.extend([point]*count)
+            self._points.extendleft(reversed(points))
+            return len(points)
+
+    def resume(self, path:str=None):
+        """Submit the points cancelled by :meth:`cancel`, and those not submitted yet
+
+        Args:
+            path (str, optional): if not None, only if the points were prefetched
+                                  for this simulation folder. Defaults to None.
+        """
+        with self._lock:
+            if not self._points or (path is not None and path != self._path):
+                return
+            points = list(self._points)
+            self._points.clear()
+            if not self._submit_energy_scan(points):
+                self._points.extend(points)
+                self._submit_points()
+
+    def stats(self)->dict:
+        """Return the number of triggers served from prefetched points (hits) or not (misses)
+
+        Returns:
+            dict: hits, misses and pending simulations
+        """
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'pending': len(self._futures)+len(self._points)}
+
+    def shutdown(self):
+        self.clear()
+        if hasattr(self.engine, 'shutdown'):
+            self.engine.shutdown()
+
+    def _submit_points(self):
+        while self._points and (self.window is None or len(self._futures) < self.window):
+            point = self._points.popleft()
+            saved = [(param, param.cdata) for param, value in point]
+            try:
+                for param, value in point:
+                    param.cdata = str(value)
+                key = rml_key(self._rml, self._exports_list, self.export_format)
+                if key in self._futures:
+                    # the same simulation is triggered more than once
+                    self._futures[key][2] += 1
+                    continue
+                if self.workspace is not None:
+                    folder = self.workspace.acquire()
+                else:
+                    folder = os.path.join(self._path, self.lookahead_folder, str(self._count))
+                self._count += 1
+                hold_spans(folder)
+                future = submit_simulation(self.engine, folder, self._rml, self._exports_list)
+                self._futures[key] = [folder, future, 1, point]
+            finally:
+                for param, cdata in saved:
+                    param.cdata = cdata
+
+    def _submit_energy_scan(self, points)->bool:
+        try:
+            param = source_element(self._rml).photonEnergy
+        except (ValueError, AttributeError):
+            return False
+        if not all(len(point) == 1 and point[0][0] is param for point in points):
+            return False
+        energies, keys, counts = [], [], {}
+        saved = param.cdata
+        try:
+            for (_, energy), in points:
+                param.cdata = str(energy)
+                key = rml_key(self._rml, self._exports_list, self.export_format)
+                if key not in counts:
+                    energies.append(energy)
+                    keys.append(key)
+                counts[key] = counts.get(key, 0)+1
+        finally:
+            param.cdata = saved
+        if self.workspace is not None:
+            folders = [self.workspace.acquire() for _ in energies]
+        else:
+            folders = [os.path.join(self._path, self.lookahead_folder, str(self._count+i)) for i in range(len(energies))]
+        for folder in folders:
+            hold_spans(folder)
+        futures = submit_energy_scan(self.engine, folders, self._rml, self._exports_list, param, energies)
+        if futures is None:
+            for folder in folders:
+                release_spans(folder, record=False)
+            if self.workspace is not None:
+                for folder in folders:
+                    self.workspace.release(folder)
+            return False
+        self._count += len(energies)
+        for key, folder, future, energy in zip(keys, folders, futures, energies):
+            self._futures[key] = [folder, future, counts[key], [(param, energy)]]
+        return True
+
+    def _release(self, folder, future):
+        # a cancelled simulation may still be running: drop its spans once it is done
+        future.add_done_callback(lambda f: release_spans(folder, record=False))
+        if self.workspace is None:
+            shutil.rmtree(folder, ignore_errors=True)
+            return
+        # and release its folder
+        future.add_done_callback(lambda f: self.workspace.release(folder))
+
+
+def lookahead_wrapper(plan, trigger_detector, engine:LookAheadSimulationEngine, plan_args):
+    """Prefetch the points of ``plan`` when the run is opened
+
+    Args:
+        plan (bluesky.plan): the plan, already wrapped by ``trigger_sim``
+        trigger_detector (RaypyngTriggerDetector): the trigger detector
+        engine (LookAheadSimulationEngine): the engine of the trigger detector
+        plan_args (list): the positional arguments of the plan
+    """
+    def prefetch_at_open_run(msg):
+        if msg.command == 'open_run' and trigger_detector.exports_list:
+            points = plan_points(msg.kwargs, plan_args)
+            if points:
+                engine.prefetch(trigger_detector.path, trigger_detector.rml,
+                                trigger_detector.exports_list, points)
+        elif msg.command == 'close_run':
+            engine.clear(trigger_detector.path)
+        return None, None
+
+    return (yield from plan_mutator(plan, prefetch_at_open_run))
+
+
+class SupplementalDataLookAhead(SupplementalDataRaypyng):
+    """Supplemental data for raypyng, prefetching the points of the scans
+
+    Args:
+        trigger_detector (RaypyngTriggerDetector): The detector to trigger raypyng
+        engine (LookAheadSimulationEngine): the engine of the trigger detector
+    """
+    def __init__(self, *args, trigger_detector, engine:LookAheadSimulationEngine, **kwargs):
+        super().__init__(*args, trigger_detector=trigger_detector, **kwargs)
+        self.engine = engine
+
+    def __call__(self, plan):
+        # trigger_sim looks for the detectors in the frame of the plan,
+        # read the arguments before wrapping it
+        try:
+            plan_args = plan.gi_frame.f_locals.get('args', ())
+        except AttributeError:
+            plan_args = ()
+        plan = trigger_sim(plan, self.trigger_detector)
+        plan = lookahead_wrapper(plan, self.trigger_detector, self.engine, plan_args)
+        plan = baseline_wrapper(plan, self.baseline)
+        return (yield from plan)
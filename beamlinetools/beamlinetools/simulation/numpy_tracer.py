@@ -0,0 +1,1145 @@
+import threading
+from contextlib import contextmanager
+from concurrent.futures import Future, CancelledError
+from collections import OrderedDict
+from multiprocessing import resource_tracker
+
+import numpy as np
+
+from .engine import SimulationEngineBase, chain_future
+from .rml_utils import canonical_value, hash_parameters
+from .rml_model import load_rml
+from .rays import RayFileWriter, ray_file, text_ray_file, postprocess_rays
+from .shared_rays import SharedRayWriter, shared_ray_file, shared_bundles, new_segment_prefix, unlink_segments
+from .timing import TimingRecorder, record_spans, span
+
+# h*c in eV*mm, lambda[mm] = HC/E[eV]
+HC = 12398.419843320026e-7
+
+RAY_DTYPE = np.dtype([('o', 'f8', (3,)),   # position [mm]
+                      ('d', 'f8', (3,)),   # direction (unit vector)
+                      ('en', 'f8'),        # photon energy [eV]
+                      ('pl', 'f8'),        # path length [mm]
+                      ('s', 'f8', (4,)),   # stokes parameters
+                      ('tag', 'i8')])      # index of the energy in a single-pass energy scan
+
+EXPORT_COLUMNS = ('OX', 'OY', 'OZ', 'DX', 'DY', 'DZ', 'EN', 'PL', 'S0', 'S1', 'S2', 'S3')
+
+
+def rot_x(a:float)->np.ndarray:
+    """Rotation matrix around the x axis, angle in radians"""
+    c, s = np.cos(a), np.sin(a)
+    return np.array([[1, 0, 0], [0, c, -s], [0, s, c]])
+
+
+def rot_y(a:float)->np.ndarray:
+    """Rotation matrix around the y axis, angle in radians"""
+    c, s = np.cos(a), np.sin(a)
+    return np.array([[c, 0, s], [0, 1, 0], [-s, 0, c]])
+
+
+def rot_z(a:float)->np.ndarray:
+    """Rotation matrix around the z axis, angle in radians"""
+    c, s = np.cos(a), np.sin(a)
+    return np.array([[c, -s, 0], [s, c, 0], [0, 0, 1]])
+
+
+def grating_angles(energy:float, line_density:float, order:int, cff:float):
+    """Grazing angles of a plane grating in constant cff mount
+
+    Solves ``cos(beta) = cff*cos(alpha)`` and
+    ``sin(alpha) + sin(beta) = order*line_density*lambda``,
+    with alpha and beta measured from the normal.
+
+    Args:
+        energy (float): photon energy [eV]
+        line_density (float): line density [lines/mm]
+        order (int): diffraction order
+        cff (float): the c factor
+
+    Returns:
+        tuple: grazing incidence and grazing exit angles [rad]
+    """
+    a = order*line_density*HC/energy
+    if cff == 1 or a == 0:
+        raise ValueError("cff=1 and zero order are not supported in constant cff mount")
+    qa = ((cff**2-1)/a)**2
+    qb = 2*(cff**2+1)
+    qc = a**2-4
+    cos_alpha = np.sqrt((-qb+np.sqrt(qb**2-4*qa*qc))/(2*qa))
+    return np.arcsin(cos_alpha), np.arcsin(cff*cos_alpha)
+
+
+class NumpyElement():
+    """Base class of the elements traced by :class:`NumpyBeamline`
+
+    Rays reach the element expressed in the outgoing beam frame of the
+    previous element (``z`` along the central ray, ``x`` horizontal and
+    ``y`` vertical), and leave it in its own outgoing beam frame, with
+    the origin at the center of the element.
+
+    Args:
+        oe (ObjectElement): the ``<object>`` of the rml file
+    """
+    distance_param = 'distancePreceding'
+
+    def __init__(self, oe):
+        self.name = str(oe['name'])
+        self.type = str(oe['type'])
+        self.params = {}
+        for param in oe.children():
+            self.params[str(param['id'])] = (param.cdata.strip(), str(param.get_attribute('enabled')) != 'F')
+
+    def value(self, key:str, default:float=0., enabled_only:bool=True)->float:
+        """Return the value of a parameter as float
+
+        Args:
+            key (str): the id of the parameter
+            default (float, optional): returned if the parameter is missing,
+                                       disabled or not a number. Defaults to 0.
+            enabled_only (bool, optional): if False disabled parameters are read too,
+                                           RAY-UI stores there the values it calculated.
+                                           Defaults to True.
+        """
+        if key not in self.params:
+            return default
+        cdata, enabled = self.params[key]
+        if enabled_only and not enabled:
+            return default
+        try:
+            return float(cdata)
+        except ValueError:
+            return default
+
+    @property
+    def tuned(self)->bool:
+        """True if the element follows the photon energy of the source, e.g. a monochromator"""
+        return False
+
+    def key(self)->list:
+        """Json-serializable description of everything the tracing of this element depends on"""
+        return [self.type, sorted((k, canonical_value(cdata), enabled) for k, (cdata, enabled) in self.params.items())]
+
+    @property
+    def distance(self)->float:
+        """Distance from the previous element [mm]"""
+        return self.value(self.distance_param, enabled_only=False)
+
+    def propagate(self, rays):
+        """Move the origin of the frame to the center of this element"""
+        rays['o'][:, 2] -= self.distance
+
+    def trace(self, rays, rng):
+        """Trace the rays through the element
+
+        Args:
+            rays (np.ndarray): rays in the frame of the previous element, see RAY_DTYPE
+            rng (np.random.Generator): the random generator
+
+        Returns:
+            np.ndarray: the surviving rays in the outgoing frame of the element
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def move_to_plane(rays):
+        """Move the rays to the plane z=0, updating the path length"""
+        t = -rays['o'][:, 2]/rays['d'][:, 2]
+        rays['o'] += t[:, None]*rays['d']
+        rays['pl'] += t
+        return rays
+
+
+class Dipole(NumpyElement):
+    """Bending magnet source
+
+    Positions are gaussian (sourceWidth and sourceHeight are sigmas in mm),
+    the horizontal divergence is uniform over horDiv [mrad], and the vertical
+    divergence is gaussian with the energy dependent natural opening angle,
+    cut at +/- verEbeamDiv/2 [mrad]. Only the ``Values`` energy distribution
+    is supported, with a white band or gaussian energy spread.
+
+    In a single-pass energy scan the rays are generated around several photon
+    energies, each ray tagged with the index of its energy, and the elements
+    following the photon energy (see :meth:`NumpyElement.tuned`) are traced
+    :meth:`tuned_to` the energy of each tag.
+    """
+    _tuned_energy = None
+
+    def photon_energy(self)->float:
+        if self._tuned_energy is not None:
+            return self._tuned_energy
+        return self.value('photonEnergy')
+
+    @contextmanager
+    def tuned_to(self, energy:float):
+        """Context in which :meth:`photon_energy` returns ``energy``"""
+        self._tuned_energy = energy
+        try:
+            yield
+        finally:
+            self._tuned_energy = None
+
+    def energy_spread(self, energy=None):
+        spread = self.value('energySpread')
+        if self.value('energySpreadUnit', 1) == 1:
+            spread = spread*(self.photon_energy() if energy is None else energy)/100
+        return spread
+
+    def generate(self, n:int, rng, energies=None, tags=None)->np.ndarray:
+        """Generate ``n`` rays
+
+        Args:
+            n (int): number of rays
+            rng (np.random.Generator): the random generator
+            energies (np.ndarray, optional): the photon energies of a single-pass energy scan. Defaults to None.
+            tags (np.ndarray, optional): for each ray the index of its energy in ``energies``. Defaults to None.
+
+        Returns:
+            np.ndarray: the rays, see RAY_DTYPE
+        """
+        rays = np.zeros(n, dtype=RAY_DTYPE)
+        rays['o'][:, 0] = rng.normal(0, self.value('sourceWidth'), n)
+        rays['o'][:, 1] = rng.normal(0, self.value('sourceHeight'), n)
+        if energies is None:
+            rays['en'] = self.energies(n, rng)
+        else:
+            rays['tag'] = tags
+            rays['en'] = self.energies(n, rng, np.asarray(energies, dtype=float)[tags])
+
+        gamma = self.value('electronEnergy', 1.7)/0.51099895e-3
+        critical_energy = 2218.3*self.value('electronEnergy', 1.7)**3/self.value('bendingRadius', 4.35)
+        sigma_v = 0.57/gamma*(critical_energy/rays['en'])**0.43
+        cut = self.value('verEbeamDiv')*1e-3/2
+        ver = rng.normal(0, 1, n)*sigma_v
+        if cut > 0:
+            ver = np.clip(ver, -cut, cut)
+        hor = rng.uniform(-0.5, 0.5, n)*self.value('horDiv')*1e-3
+        rays['d'][:, 0] = np.tan(hor)
+        rays['d'][:, 1] = np.tan(ver)
+        rays['d'][:, 2] = 1
+        rays['d'] /= np.linalg.norm(rays['d'], axis=1)[:, None]
+        rays['s'][:, 0] = 1
+        rays['s'][:, 1] = 1
+        return rays
+
+    def energies(self, n:int, rng, energy=None)->np.ndarray:
+        if energy is None:
+            energy = self.photon_energy()
+        spread = self.energy_spread(energy)
+        if self.value('energySpreadType') == 0:
+            return energy+rng.uniform(-0.5, 0.5, n)*spread
+        return rng.normal(energy, spread, n)
+
+    def trace(self, rays, rng):
+        return rays
+
+
+class Slit(NumpyElement):
+    """Rectangular or elliptical aperture, with optional central beamstop"""
+    def trace(self, rays, rng):
+        self.propagate(rays)
+        rays = self.move_to_plane(rays)
+        x, y = rays['o'][:, 0], rays['o'][:, 1]
+        keep = self.inside(x, y, self.value('totalWidth'), self.value('totalHeight'), self.value('geometricalShape'))
+        if self.value('centralBeamstop') > 0:
+            keep &= ~self.inside(x, y, self.value('totalWidthStop'), self.value('totalHeightStop'),
+                                 self.value('centralBeamstop')-1)
+        return rays[keep]
+
+    @staticmethod
+    def inside(x, y, width, height, shape):
+        if shape == 0:
+            return (np.abs(x) <= width/2) & (np.abs(y) <= height/2)
+        return (x/(width/2))**2+(y/(height/2))**2 <= 1
+
+
+class ImagePlane(NumpyElement):
+    """Image plane perpendicular to the beam"""
+    distance_param = 'distanceImagePlane'
+
+    def trace(self, rays, rng):
+        self.propagate(rays)
+        return self.move_to_plane(rays)
+
+
+class Mirror(NumpyElement):
+    """Base class for the reflecting elements
+
+    The surface is described in the mirror frame (normal along ``y``,
+    ``z`` along the mirror length) by the implicit function :meth:`surface`.
+    Intersections are found with a few vectorized Newton iterations starting
+    from the tangent plane. Misalignments (translations in mm, rotations in urad)
+    and gaussian slope errors (urad rms) are taken into account, reflectivity is not.
+    """
+    newton_iterations = 8
+
+    def grazing_angles(self):
+        """Grazing angles of incidence and exit [rad]"""
+        theta = np.radians(self.value('grazingIncAngle', enabled_only=False))
+        return theta, theta
+
+    def surface(self, p):
+        return p[:, 1]
+
+    def gradient(self, p):
+        g = np.zeros_like(p)
+        g[:, 1] = 1
+        return g
+
+    def outgoing_directions(self, d, n, rays):
+        """Specular reflection"""
+        return d-2*np.einsum('ij,ij->i', d, n)[:, None]*n
+
+    def misalignment(self):
+        translation = np.array([self.value('translationXerror'),
+                                self.value('translationYerror'),
+                                self.value('translationZerror')])
+        rotation = (rot_z(self.value('rotationZerror')*1e-6) @
+                    rot_y(self.value('rotationYerror')*1e-6) @
+                    rot_x(self.value('rotationXerror')*1e-6))
+        return translation, rotation
+
+    def intersect(self, o, d):
+        t = -o[:, 1]/d[:, 1]
+        for _ in range(self.newton_iterations):
+            p = o+t[:, None]*d
+            t = t-self.surface(p)/np.einsum('ij,ij->i', self.gradient(p), d)
+        return t, o+t[:, None]*d
+
+    def trace(self, rays, rng):
+        self.propagate(rays)
+        theta_in, theta_out = self.grazing_angles()
+        azimuth = np.radians(self.value('azimuthalAngle', enabled_only=False))
+        to_mirror = rot_x(theta_in) @ rot_z(-azimuth)
+        to_beam = rot_z(azimuth) @ rot_x(theta_out)
+        translation, rotation = self.misalignment()
+        # from the incoming beam frame to the (misaligned) surface frame
+        m = rotation.T @ to_mirror
+        o = (rays['o'] @ to_mirror.T-translation) @ rotation
+        d = rays['d'] @ m.T
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t, p = self.intersect(o, d)
+        keep = np.isfinite(t) & (t > 0)
+        keep &= (np.abs(p[:, 0]) <= self.value('totalWidth')/2) & (np.abs(p[:, 2]) <= self.value('totalLength')/2)
+        rays, t, p, d = rays[keep], t[keep], p[keep], d[keep]
+        n = self.gradient(p)
+        n /= np.linalg.norm(n, axis=1)[:, None]
+        n = self.slope_errors(n, rng)
+        d = self.outgoing_directions(d, n, rays)
+        keep = np.isfinite(d).all(axis=1)
+        rays, t, p, d = rays[keep], t[keep], p[keep], d[keep]
+        # back to the outgoing beam frame
+        rays['pl'] += t
+        rays['o'] = (p @ rotation.T+translation) @ to_beam.T
+        rays['d'] = d @ (to_beam @ rotation).T
+        return rays
+
+    def slope_errors(self, n, rng):
+        sag = self.value('slopeErrorSag')*1e-6
+        mer = self.value('slopeErrorMer')*1e-6
+        if self.value('slopeError', 1) != 0 or (sag == 0 and mer == 0):
+            return n
+        n = n.copy()
+        n[:, 0] += rng.normal(0, sag, len(n))
+        n[:, 2] += rng.normal(0, mer, len(n))
+        return n/np.linalg.norm(n, axis=1)[:, None]
+
+
+class PlaneMirror(Mirror):
+    """Plane mirror, in an SX700 mount the grazing angle follows the grating"""
+    newton_iterations = 0
+    grating = None
+
+    def key(self)->list:
+        # in an SX700 mount the angle depends on the grating downstream
+        if self.grating is not None:
+            return super().key()+[self.grating.key()]
+        return super().key()
+
+    @property
+    def tuned(self)->bool:
+        return self.grating is not None and not self.params.get('grazingIncAngle', ('', True))[1]
+
+    def grazing_angles(self):
+        if self.tuned:
+            alpha, beta = self.grating.grazing_angles()
+            theta = (alpha+beta)/2
+            return theta, theta
+        return super().grazing_angles()
+
+
+class Cylinder(Mirror):
+    """Cylinder, curved along x (bendingRadius=1, short radius) or along z (long radius)"""
+    def __init__(self, oe):
+        super().__init__(oe)
+        self.radius = self.value('radius', enabled_only=False)
+        self.sagittal = self.value('bendingRadius', 1) == 1
+
+    def surface(self, p):
+        r = self.radius
+        u = p[:, 0] if self.sagittal else p[:, 2]
+        return u**2+(p[:, 1]-r)**2-r**2
+
+    def gradient(self, p):
+        g = np.zeros_like(p)
+        g[:, 0 if self.sagittal else 2] = 2*(p[:, 0] if self.sagittal else p[:, 2])
+        g[:, 1] = 2*(p[:, 1]-self.radius)
+        return g
+
+
+class Toroid(Mirror):
+    """Toroid with meridional radius ``longRadius`` and sagittal radius ``shortRadius``"""
+    def __init__(self, oe):
+        super().__init__(oe)
+        self.long_radius = self.value('longRadius', enabled_only=False)
+        self.short_radius = self.value('shortRadius', enabled_only=False)
+
+    def surface(self, p):
+        big, small = self.long_radius, self.short_radius
+        q = np.sqrt((p[:, 1]-big)**2+p[:, 2]**2)
+        return (q-(big-small))**2+p[:, 0]**2-small**2
+
+    def gradient(self, p):
+        big, small = self.long_radius, self.short_radius
+        q = np.sqrt((p[:, 1]-big)**2+p[:, 2]**2)
+        k = 2*(q-(big-small))/q
+        g = np.empty_like(p)
+        g[:, 0] = 2*p[:, 0]
+        g[:, 1] = k*(p[:, 1]-big)
+        g[:, 2] = k*p[:, 2]
+        return g
+
+
+class Ellipsoid(Mirror):
+    """Ellipsoid defined by the entrance and exit arms at the design angle
+
+    ``figureRotation`` = 1 (plane) gives an elliptical cylinder, otherwise an
+    ellipsoid of revolution around the focal axis. A grazing angle different
+    from the design one tilts the surface with respect to the beam.
+    """
+    def __init__(self, oe):
+        super().__init__(oe)
+        p = self.value('entranceArmLength', enabled_only=False)
+        q = self.value('exitArmLength', enabled_only=False)
+        theta = np.radians(self.value('designGrazingIncAngle', enabled_only=False))
+        self.f1 = np.array([0, p*np.sin(theta), -p*np.cos(theta)])
+        self.f2 = np.array([0, q*np.sin(theta), q*np.cos(theta)])
+        self.half_axis = (p+q)/2
+        self.cylinder = self.value('figureRotation', 1) == 1
+
+    def _vectors(self, p):
+        v1, v2 = p-self.f1, p-self.f2
+        if self.cylinder:
+            v1[:, 0] = 0
+            v2[:, 0] = 0
+        return v1, v2
+
+    def surface(self, p):
+        v1, v2 = self._vectors(p)
+        return np.linalg.norm(v1, axis=1)+np.linalg.norm(v2, axis=1)-2*self.half_axis
+
+    def gradient(self, p):
+        v1, v2 = self._vectors(p)
+        return v1/np.linalg.norm(v1, axis=1)[:, None]+v2/np.linalg.norm(v2, axis=1)[:, None]
+
+
+class PlaneGrating(Mirror):
+    """Plane grating in constant cff mount, grooves along x
+
+    The angles are calculated for the photon energy of the source.
+    Only the geometry of the diffraction is traced, the efficiency is not.
+    """
+    newton_iterations = 0
+    source = None
+
+    @property
+    def tuned(self)->bool:
+        return self.source is not None
+
+    def mount_energy(self)->float:
+        if self.source is not None:
+            return self.source.photon_energy()
+        return self.value('designEnergyMounting')
+
+    def grazing_angles(self):
+        return grating_angles(self.mount_energy(), self.value('lineDensity'),
+                              self.value('orderDiffraction', 1), self.value('cFactor'))
+
+    def outgoing_directions(self, d, n, rays):
+        # the component of the wave vector along the grating vector changes by
+        # order*lineDensity*lambda, the normal component is recalculated
+        k = self.value('orderDiffraction', 1)*self.value('lineDensity')*HC/rays['en']
+        g = np.array([0., 0., 1.])-n[:, 2][:, None]*n
+        g /= np.linalg.norm(g, axis=1)[:, None]
+        tangential = d-np.einsum('ij,ij->i', d, n)[:, None]*n-k[:, None]*g
+        with np.errstate(invalid='ignore'):
+            normal = np.sqrt(1-np.einsum('ij,ij->i', tangential, tangential))
+        return tangential+normal[:, None]*n
+
+
+ELEMENT_TYPES = {'Dipole': Dipole,
+                 'Toroid': Toroid,
+                 'PlaneMirror': PlaneMirror,
+                 'PlaneGrating': PlaneGrating,
+                 'Cylinder': Cylinder,
+                 'Slit': Slit,
+                 'Ellipsoid': Ellipsoid,
+                 'ImagePlane': ImagePlane}
+
+
+class NumpyBeamline():
+    """Vectorized NumPy ray tracer of an rml file
+
+    The supported element types are listed in ``ELEMENT_TYPES``. Rays are
+    generated and traced in batches of ``batch_size`` rays, so that the
+    memory used does not depend on the total number of rays.
+
+    Args:
+        rml (RMLFile): the rml file
+    """
+    def __init__(self, rml):
+        self.elements = []
+        for oe in rml.beamline.children():
+            cls = ELEMENT_TYPES.get(str(oe['type']))
+            if cls is None:
+                raise ValueError(f"The element type '{oe['type']}' of '{oe['name']}' is not supported by the numpy tracer")
+            self.elements.append(cls(oe))
+        if not isinstance(self.elements[0], Dipole):
+            raise ValueError("The first element of the beamline must be the source")
+        self.source = self.elements[0]
+        for i, element in enumerate(self.elements):
+            if isinstance(element, PlaneGrating):
+                element.source = self.source
+                if i > 0 and isinstance(self.elements[i-1], PlaneMirror) and self.elements[i-1].value('systemMount') == 1:
+                    self.elements[i-1].grating = element
+
+    def element_names(self)->list:
+        return [element.name for element in self.elements]
+
+    def element_keys(self, nrays:int, batch_size:int, seed=None, energies=None)->list:
+        """Keys of the rays leaving each element
+
+        The key of an element depends on its parameters and on the key of
+        the previous element, hence on the whole beamline upstream.
+
+        Args:
+            nrays (int): number of rays
+            batch_size (int): number of rays traced at once
+            seed (optional): seed of the random generator
+            energies (list, optional): the photon energies of a single-pass energy scan. Defaults to None.
+
+        Returns:
+            list: the key of each element
+        """
+        key = hash_parameters(nrays, batch_size, seed)
+        if energies is not None:
+            key = hash_parameters(key, [float(e) for e in energies])
+        keys = []
+        for element in self.elements:
+            key = hash_parameters(key, element.key())
+            keys.append(key)
+        return keys
+
+    def trace(self, nrays:int=None, exports=(), batch_size:int=100000, seed=None, bundle_cache=None, energies=None):
+        """Trace the rays, yielding the exported rays batch by batch
+
+        Each element uses its own random generator, derived from the seed,
+        the batch and the position of the element, so the rays leaving an
+        element do not depend on the elements downstream. With a
+        ``bundle_cache`` the rays leaving each element are cached, and
+        the tracing restarts after the last element whose rays are cached.
+
+        With ``energies`` all the points of an energy scan are traced at once:
+        ``nrays`` rays are generated around each energy, tagged with its index
+        (field ``tag``), and the elements following the photon energy are traced
+        once per tag, tuned to its energy, see :meth:`trace_element`.
+
+        Args:
+            nrays (int, optional): number of rays, if None numberRays of the source is used. Defaults to None.
+            exports (list, optional): names of the elements whose outgoing rays are yielded. Defaults to ().
+            batch_size (int, optional): number of rays traced at once. Defaults to 100000.
+            seed (optional): seed of the random generator, for reproducible results. Defaults to None.
+            bundle_cache (RayBundleCache, optional): cache of the rays leaving each element. Defaults to None.
+            energies (list, optional): the photon energies of a single-pass energy scan. Defaults to None.
+
+        Yields:
+            dict: for each batch, element name -> outgoing rays of the element
+        """
+        if nrays is None:
+            nrays = int(self.source.value('numberRays'))
+        total = nrays*len(energies) if energies is not None else nrays
+        entropy = np.random.SeedSequence(seed).entropy
+        exports = set(exports)
+        exported = [i for i, e in enumerate(self.elements) if e.name in exports]
+        last = max(exported, default=len(self.elements)-1)
+        keys = self.element_keys(nrays, batch_size, seed, energies) if bundle_cache is not None else None
+        for b, start in enumerate(range(0, total, batch_size)):
+            batch = {}
+            first, rays = 0, None
+            if bundle_cache is not None:
+                first, rays, batch = bundle_cache.lookup(keys[:last+1], b, {i: self.elements[i].name for i in exported})
+            if rays is None:
+                n = min(batch_size, total-start)
+                tags = np.arange(start, start+n)//nrays if energies is not None else None
+                rays = self.source.generate(n, np.random.default_rng([entropy, b, 0]), energies, tags)
+            for i in range(first, last+1):
+                element = self.elements[i]
+                rays = self.trace_element(element, rays, np.random.default_rng([entropy, b, i]), energies)
+                if bundle_cache is not None:
+                    bundle_cache.put((keys[i], b), rays)
+                if element.name in exports:
+                    batch[element.name] = rays.copy()
+            yield batch
+
+    def trace_element(self, element:NumpyElement, rays, rng, energies=None):
+        """Trace the rays through ``element``
+
+        In a single-pass energy scan the rays are grouped by tag, and an element
+        following the photon energy traces each group tuned to the energy of the tag.
+
+        Args:
+            element (NumpyElement): the element
+            rays (np.ndarray): rays in the frame of the previous element, see RAY_DTYPE
+            rng (np.random.Generator): the random generator of the element
+            energies (list, optional): the photon energies of a single-pass energy scan. Defaults to None.
+
+        Returns:
+            np.ndarray: the surviving rays in the outgoing frame of the element
+        """
+        if energies is None or not element.tuned:
+            return element.trace(rays, rng)
+        traced = []
+        for tag, group in enumerate(split_by_tag(rays, len(energies))):
+            if len(group):
+                with self.source.tuned_to(energies[tag]):
+                    traced.append(element.trace(group, rng))
+        return np.concatenate(traced) if traced else rays
+
+
+def split_by_tag(rays, n_tags:int, table=None)->list:
+    """Bin rays by their tag, see :meth:`NumpyBeamline.trace`
+
+    The rays are cut at the cumulated histogram of the tags. The source
+    generates the tags in increasing order and the elements keep the order
+    of the rays, so the groups are views; the rays are sorted only if needed.
+
+    Args:
+        rays (np.ndarray): the rays, see RAY_DTYPE
+        n_tags (int): the number of tags
+        table (np.ndarray, optional): rows to split instead of the rays, one per ray. Defaults to None.
+
+    Returns:
+        list: for each tag the rays (or the rows of ``table``) with that tag
+    """
+    tags = rays['tag']
+    counts = np.bincount(tags, minlength=n_tags)
+    values = rays if table is None else table
+    if np.any(tags[1:] < tags[:-1]):
+        values = values[np.argsort(tags, kind='stable')]
+    return np.split(values, np.cumsum(counts)[:-1])
+
+
+class RayBundleCache():
+    """In-memory cache of the rays leaving each element of a beamline
+
+    The rays are stored per batch with the keys of
+    :meth:`NumpyBeamline.element_keys`. When a scan only moves an element
+    downstream, the rays leaving the upstream elements are found in the
+    cache and only the remaining part of the beamline is traced.
+    Bundles are evicted least-recently-used first when ``max_size`` is exceeded.
+
+    Args:
+        max_size (int, optional): maximum size of the cached rays in bytes. Defaults to 512 MB.
+    """
+    def __init__(self, max_size:int=512*1024**2):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.elements_traced = 0
+        self.elements_skipped = 0
+        self._lock = threading.Lock()
+        self._bundles = OrderedDict()
+
+    def __len__(self):
+        return len(self._bundles)
+
+    def get(self, key):
+        """Return a copy of the cached rays, or None"""
+        with self._lock:
+            rays = self._bundles.get(key)
+            if rays is None:
+                return None
+            self._bundles.move_to_end(key)
+            return rays.copy()
+
+    def put(self, key, rays):
+        """Store a copy of ``rays``, the rays leaving a traced element"""
+        self.elements_traced += 1
+        if rays.nbytes > self.max_size:
+            return
+        with self._lock:
+            if key in self._bundles:
+                self._bundles.move_to_end(key)
+                return
+            self._bundles[key] = rays.copy()
+            self.size += rays.nbytes
+            while self.size > self.max_size:
+                self.size -= self._bundles.popitem(last=False)[1].nbytes
+
+    def lookup(self, keys:list, batch:int, exported:dict):
+        """Find the last element whose outgoing rays are cached
+
+        Args:
+            keys (list): the keys of the elements to trace
+            batch (int): the index of the batch
+            exported (dict): index -> name of the exported elements, the rays of those
+                             upstream of the restart point must be cached too
+
+        Returns:
+            tuple: index of the first element to trace, its incoming rays (None to
+                   trace from the source) and name -> rays of the exported elements already traced
+        """
+        with self._lock:
+            for i in range(len(keys)-1, -1, -1):
+                used = [(keys[i], batch)]+[(keys[j], batch) for j in exported if j < i]
+                if any(key not in self._bundles for key in used):
+                    continue
+                for key in used:
+                    self._bundles.move_to_end(key)
+                self.hits += 1
+                self.elements_skipped += i+1
+                cached = {name: self._bundles[(keys[j], batch)].copy() for j, name in exported.items() if j <= i}
+                return i+1, self._bundles[(keys[i], batch)].copy(), cached
+            self.misses += 1
+        return 0, None, {}
+
+    def stats(self)->dict:
+        """Return hits, misses, traced and skipped elements and size of the cache
+
+        Returns:
+            dict: the statistics of the cache
+        """
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'elements_traced': self.elements_traced,
+                'elements_skipped': self.elements_skipped,
+                'bundles': len(self._bundles),
+                'size': self.size}
+
+    def clear(self):
+        """Remove all the cached rays"""
+        with self._lock:
+            self._bundles.clear()
+            self.size = 0
+
+
+def write_raw_rays(f, name:str, rays, header:bool=False):
+    """Write rays in the RAY-UI RawRaysOutgoing csv format
+
+    Args:
+        f (file): file opened in text mode
+        name (str): name of the exported element
+        rays (np.ndarray): the rays, see RAY_DTYPE
+        header (bool, optional): write the header lines. Defaults to False.
+    """
+    if header:
+        f.write(f"# {name} RawRaysOutgoing\n")
+        f.write("\t".join(f"{name}_{c}" for c in EXPORT_COLUMNS)+"\n")
+    np.savetxt(f, ray_table(rays), delimiter='\t', fmt='%.10g')
+
+
+def ray_table(rays)->np.ndarray:
+    """Return the rays as a table with the columns EXPORT_COLUMNS"""
+    return np.column_stack((rays['o'], rays['d'], rays['en'], rays['pl'], rays['s']))
+
+
+def _open_writers(path:str, exports_list, export_format, binary:bool, shared_memory, nrays:int)->dict:
+    if shared_memory:
+        prefix = shared_memory if isinstance(shared_memory, str) else None
+        return {exp: SharedRayWriter(shared_ray_file(path, exp, export_format), EXPORT_COLUMNS, nrays, prefix)
+                for exp in exports_list}
+    if binary:
+        return {exp: RayFileWriter(ray_file(path, exp, export_format), EXPORT_COLUMNS) for exp in exports_list}
+    writers = {exp: open(text_ray_file(path, exp, export_format), 'w') for exp in exports_list}
+    for exp, f in writers.items():
+        write_raw_rays(f, exp, np.zeros(0, dtype=RAY_DTYPE), header=True)
+    return writers
+
+
+def _abort_writers(writers:dict, binary:bool, shared_memory:bool):
+    for writer in writers.values():
+        if binary or shared_memory:
+            writer.abort()
+        else:
+            writer.close()
+
+
+def _close_writers(path:str, rml_file:str, writers:dict, export_format, binary:bool, shared_memory:bool)->list:
+    # close the exports of one simulation folder and post-process them,
+    # return the names of the shared memory segments
+    from raypyng.postprocessing import PostProcess
+    for writer in writers.values():
+        writer.close()
+    if shared_memory:
+        for exp, writer in writers.items():
+            postprocess_rays(path, exp, rml_file, export_format, rays=writer.table())
+            writer.release()
+        return [writer.name for writer in writers.values()]
+    if binary:
+        for exp in writers:
+            postprocess_rays(path, exp, rml_file, export_format)
+        return []
+    pp = PostProcess()
+    for exp in writers:
+        pp.postprocess_RawRays(exported_element=exp,
+                               exported_object=export_format,
+                               dir_path=path,
+                               sim_number='',
+                               rml_filename=rml_file)
+    return []
+
+
+def run_numpy_simulation(path:str, rml_file:str, exports_list, batch_size:int=100000, seed=None,
+                         export_format='RawRaysOutgoing', bundle_cache=None, binary=True, shared_memory=False,
+                         cancelled=None):
+    """Trace ``rml_file`` with :class:`NumpyBeamline` and export like RAY-UI does
+
+    For each exported element the rays are written into ``path``, either
+    in the binary ``<element>-RawRaysOutgoing.npy`` (see :class:`RayFileWriter`)
+    or in the csv ``<element>-RawRaysOutgoing.csv`` of RAY-UI, together
+    with the post-processed ``<element>_analyzed_rays.dat``. With ``shared_memory``
+    the rays are written into shared memory instead (see :class:`SharedRayWriter`),
+    and only ``<element>-RawRaysOutgoing.shm.json`` describes them in ``path``.
+
+    Args:
+        path (str): the simulation folder
+        rml_file (str): the rml file to simulate
+        exports_list (list): list of the exported objects
+        batch_size (int, optional): number of rays traced at once. Defaults to 100000.
+        seed (optional): seed of the random generator. Defaults to None.
+        export_format (str, optional): the exported format. Defaults to 'RawRaysOutgoing'.
+        bundle_cache (RayBundleCache, optional): cache of the rays leaving each element. Defaults to None.
+        binary (bool, optional): write the binary files instead of the csv files. Defaults to True.
+        shared_memory (bool or str, optional): write the rays into shared memory, a str is the prefix
+                                               of the names of the segments. Defaults to False.
+        cancelled (callable, optional): called before each batch, if it returns True the
+                                        simulation stops with :class:`CancelledError`. Defaults to None.
+
+    Returns:
+        list: the names of the shared memory segments, to be published with
+              :meth:`SharedBundleRegistry.publish` in the process reading them
+    """
+    with span('engine_load', path=path):
+        beamline = NumpyBeamline(load_rml(rml_file))
+    nrays = int(beamline.source.value('numberRays'))
+    writers = _open_writers(path, exports_list, export_format, binary, shared_memory, nrays)
+    try:
+        with span('trace', path=path):
+            for batch in beamline.trace(exports=exports_list, batch_size=batch_size, seed=seed,
+                                        bundle_cache=bundle_cache):
+                _check_cancelled(cancelled)
+                for exp, rays in batch.items():
+                    if binary or shared_memory:
+                        writers[exp].write(ray_table(rays))
+                    else:
+                        write_raw_rays(writers[exp], exp, rays)
+    except BaseException:
+        _abort_writers(writers, binary, shared_memory)
+        raise
+    with span('export', path=path):
+        return _close_writers(path, rml_file, writers, export_format, binary, shared_memory)
+
+
+def run_numpy_energy_scan(paths, rml_files, exports_list, energies, batch_size:int=100000, seed=None,
+                          export_format='RawRaysOutgoing', bundle_cache=None, binary=True, shared_memory=False,
+                          cancelled=None):
+    """Trace all the points of an energy scan at once, see :meth:`NumpyBeamline.trace`
+
+    The rays of all the energies are traced in a single pass, and the
+    exported rays are binned by energy (see :func:`split_by_tag`) into
+    the folder of each energy, as if each energy had been simulated by
+    :func:`run_numpy_simulation` with its own rml file.
+    The timing spans of the scan are recorded for the folder of the first energy.
+
+    Args:
+        paths (list): the simulation folder of each energy
+        rml_files (list): the rml file of each energy, they differ only by the photon energy of the source
+        exports_list (list): list of the exported objects
+        energies (list): the photon energies [eV]
+        batch_size (int, optional): number of rays traced at once. Defaults to 100000.
+        seed (optional): seed of the random generator. Defaults to None.
+        export_format (str, optional): the exported format. Defaults to 'RawRaysOutgoing'.
+        bundle_cache (RayBundleCache, optional): cache of the rays leaving each element. Defaults to None.
+        binary (bool, optional): write the binary files instead of the csv files. Defaults to True.
+        shared_memory (bool or str, optional): write the rays into shared memory, a str is the prefix
+                                               of the names of the segments. Defaults to False.
+        cancelled (callable, optional): see :func:`run_numpy_simulation`. Defaults to None.
+
+    Returns:
+        list: the names of the shared memory segments, see :func:`run_numpy_simulation`
+    """
+    with span('engine_load', path=paths[0]):
+        beamline = NumpyBeamline(load_rml(rml_files[0]))
+    nrays = int(beamline.source.value('numberRays'))
+    writers = [_open_writers(path, exports_list, export_format, binary, shared_memory, nrays) for path in paths]
+    try:
+        with span('trace', path=paths[0]):
+            for batch in beamline.trace(exports=exports_list, batch_size=batch_size, seed=seed,
+                                        bundle_cache=bundle_cache, energies=energies):
+                _check_cancelled(cancelled)
+                for exp, rays in batch.items():
+                    for tag, table in enumerate(split_by_tag(rays, len(energies), ray_table(rays))):
+                        if not len(table):
+                            continue
+                        if binary or shared_memory:
+                            writers[tag][exp].write(table)
+                        else:
+                            np.savetxt(writers[tag][exp], table, delimiter='\t', fmt='%.10g')
+    except BaseException:
+        for w in writers:
+            _abort_writers(w, binary, shared_memory)
+        raise
+    bundles = []
+    with span('export', path=paths[0]):
+        for path, rml_file, w in zip(paths, rml_files, writers):
+            bundles.extend(_close_writers(path, rml_file, w, export_format, binary, shared_memory))
+    return bundles
+
+
+def _check_cancelled(cancelled):
+    if cancelled is not None and cancelled():
+        raise CancelledError("The simulation was cancelled")
+
+
+# each process of the pool of NumpySimulationEngine has its own bundle cache
+_process_bundle_cache = None
+
+
+def _run_in_process(path, rml_file, exports_list, bundle_cache_size=None, run=run_numpy_simulation, **kwargs):
+    global _process_bundle_cache
+    if bundle_cache_size and _process_bundle_cache is None:
+        _process_bundle_cache = RayBundleCache(bundle_cache_size)
+    # the spans are returned to the parent process, see record_spans
+    with TimingRecorder() as recorder:
+        bundles = run(path, rml_file, exports_list, bundle_cache=_process_bundle_cache, **kwargs)
+    return recorder.spans, bundles
+
+
+def _publish(future, prefix=None):
+    # runs even if the chained future was cancelled, so that no bundle is left behind
+    if not future.cancelled() and future.exception() is None:
+        shared_bundles.publish(future.result()[1])
+    elif prefix is not None:
+        # the process failed or was terminated before handing over its segments
+        unlink_segments(prefix)
+
+
+class NumpySimulationEngine(SimulationEngineBase):
+    """Simulation engine tracing with NumPy, without RAY-UI
+
+    Useful on computers without a RAY-UI licence or X server, and as a
+    fast and deterministic (when ``seed`` is set) stand-in for RAY-UI.
+
+    The rays leaving each element are kept in a :class:`RayBundleCache`, so
+    when only some elements change between two simulations the tracing
+    restarts at the first element that changed.
+
+    :meth:`cancel` stops the simulations traced in this process at their
+    next batch of rays, and terminates the processes of ``max_workers``.
+    With ``shared_memory`` the segments of each simulation of the processes
+    are named by this process, so that it removes the segments of the
+    simulations that failed or were terminated, see :func:`unlink_segments`.
+
+    Args:
+        batch_size (int, optional): number of rays traced at once. Defaults to 100000.
+        seed (optional): seed of the random generator, if None every simulation
+                         uses fresh random rays, except for the rays taken from the
+                         bundle cache. Defaults to None.
+        max_workers (int, optional): if larger than 1 simulations submitted with
+                                     ``submit`` run in parallel processes. Defaults to 1.
+        bundle_cache_size (int, optional): maximum size in bytes of the cache of the rays
+                                           leaving each element, per process. If 0 or None
+                                           the whole beamline is always traced. Defaults to 512 MB.
+        binary (bool, optional): export the rays in binary ``.npy`` files instead of
+                                 the csv files of RAY-UI. Defaults to True.
+        shared_memory (bool, optional): export the rays in shared memory instead of files: the
+                                        detectors attach them without copying, and they are released
+                                        at the end of each point, see :class:`SharedRaysPreprocessor`.
+                                        Defaults to False.
+        energy_scans (bool, optional): simulate all the points of a scan of the photon energy of the
+                                       source in a single pass, see :meth:`submit_energy_scan`. Defaults to False.
+    """
+    def __init__(self, batch_size:int=100000, seed=None, max_workers:int=1, bundle_cache_size:int=512*1024**2,
+                 binary:bool=True, shared_memory:bool=False, energy_scans:bool=False):
+        self.batch_size = batch_size
+        self.seed = seed
+        self.max_workers = max_workers
+        self.bundle_cache_size = bundle_cache_size
+        self.binary = binary
+        self.shared_memory = shared_memory
+        self.energy_scans = energy_scans
+        self.bundle_cache = RayBundleCache(bundle_cache_size) if bundle_cache_size else None
+        self._executor = None
+        # the futures of the processes with the prefix of their segments, and the number of calls to cancel
+        self._futures = {}
+        self._generation = 0
+
+    @property
+    def seed(self):
+        """The seed of the random generator, see :func:`seed_simulations`"""
+        return self._seed
+
+    @seed.setter
+    def seed(self, seed):
+        self._seed = seed
+        # entropy of the batches of submit_batch
+        self._entropy = None if seed is None else np.random.SeedSequence(seed).entropy
+
+    def run(self, path, rml_file, exports_list):
+        shared_bundles.publish(run_numpy_simulation(path, rml_file, exports_list, batch_size=self.batch_size,
+                                                    seed=self.seed, bundle_cache=self.bundle_cache, binary=self.binary,
+                                                    shared_memory=self.shared_memory, cancelled=self._cancelled()))
+
+    def submit(self, path, rml, exports_list):
+        if self.max_workers <= 1:
+            return super().submit(path, rml, exports_list)
+        return self._submit(path, rml, exports_list, self.seed)
+
+    def submit_batch(self, path, rml, exports_list, batch:int):
+        """Submit a simulation whose random rays depend on ``batch``
+
+        Batches with different numbers are independent, and reproducible
+        when ``seed`` is set. If ``seed`` is None each call draws fresh
+        random rays.
+
+        Args:
+            path (str): the simulation folder
+            rml (RMLFile): the rml file
+            exports_list (list): list of the exported objects
+            batch (int): the number of the batch
+
+        Returns:
+            Future: resolved once the results are exported in ``path``
+        """
+        entropy = self._entropy if self._entropy is not None else np.random.SeedSequence().entropy
+        seed = [entropy, batch]
+        if self.max_workers > 1:
+            return self._submit(path, rml, exports_list, seed)
+        rml_file = self.write_rml(path, rml)
+        future = Future()
+        try:
+            future.set_result(shared_bundles.publish(run_numpy_simulation(
+                path, rml_file, list(exports_list), batch_size=self.batch_size, seed=seed,
+                bundle_cache=self.bundle_cache, binary=self.binary, shared_memory=self.shared_memory,
+                cancelled=self._cancelled())))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def submit_energy_scan(self, paths, rml, exports_list, param, energies)->list:
+        """Submit the points of an energy scan as a single simulation, see :func:`run_numpy_energy_scan`
+
+        Args:
+            paths (list): the simulation folder of each energy
+            rml (RMLFile): the rml file
+            exports_list (list): list of the exported objects
+            param (ParamElement): the photon energy of the source in ``rml``
+            energies (list): the photon energies [eV]
+
+        With ``max_workers`` larger than 1 the energies are split into one
+        single-pass simulation per worker.
+
+        Returns:
+            list: for each energy a future resolved once its results are exported,
+                  the energies simulated together share the same future
+        """
+        saved = param.cdata
+        rml_files = []
+        try:
+            for path, energy in zip(paths, energies):
+                param.cdata = str(energy)
+                rml_files.append(self.write_rml(path, rml))
+        finally:
+            param.cdata = saved
+        energies = [float(energy) for energy in energies]
+        kwargs = dict(batch_size=self.batch_size, seed=self.seed, binary=self.binary, shared_memory=self.shared_memory)
+        if self.max_workers <= 1:
+            future = Future()
+            try:
+                future.set_result(shared_bundles.publish(run_numpy_energy_scan(
+                    list(paths), rml_files, list(exports_list), energies, bundle_cache=self.bundle_cache,
+                    cancelled=self._cancelled(), **kwargs)))
+            except Exception as e:
+                future.set_exception(e)
+            return [future]*len(paths)
+        futures = []
+        for chunk in np.array_split(np.arange(len(paths)), min(self.max_workers, len(paths))):
+            future = self._submit_files([paths[i] for i in chunk], [rml_files[i] for i in chunk], list(exports_list),
+                                        run=run_numpy_energy_scan, energies=[energies[i] for i in chunk], **kwargs)
+            futures.extend([future]*len(chunk))
+        return futures
+
+    def _submit(self, path, rml, exports_list, seed):
+        rml_file = self.write_rml(path, rml)
+        return self._submit_files(path, rml_file, list(exports_list), batch_size=self.batch_size,
+                                  seed=seed, binary=self.binary, shared_memory=self.shared_memory)
+
+    def _submit_files(self, path, rml_file, exports_list, **kwargs):
+        if self._executor is None:
+            from concurrent.futures import ProcessPoolExecutor
+            if self.shared_memory:
+                # the processes inherit the resource tracker of this process instead of starting
+                # their own, which would remove their segments when they exit
+                resource_tracker.ensure_running()
+            self._executor = ProcessPoolExecutor(self.max_workers)
+        prefix = None
+        if kwargs.get('shared_memory'):
+            prefix = kwargs['shared_memory'] = new_segment_prefix()
+        future = self._executor.submit(_run_in_process, path, rml_file, exports_list,
+                                       bundle_cache_size=self.bundle_cache_size, **kwargs)
+        self._futures[future] = prefix
+        future.add_done_callback(lambda f: self._futures.pop(f, None))
+        future.add_done_callback(lambda f: _publish(f, prefix))
+        return chain_future(future, lambda result: record_spans(result[0]))
+
+    def cancel(self)->int:
+        """Cancel the submitted simulations
+
+        The simulations traced in this process stop at their next batch of rays.
+        The processes are terminated, and started again at the next submission.
+
+        Returns:
+            int: the number of cancelled simulations of the processes
+        """
+        self._generation += 1
+        executor, self._executor = self._executor, None
+        if executor is None:
+            return 0
+        futures = dict(self._futures)
+        cancelled = sum(future.cancel() for future in futures)
+        running = [future for future in futures if not future.done()]
+        # ProcessPoolExecutor cannot interrupt a running job: terminate its processes
+        processes = list((getattr(executor, '_processes', None) or {}).values())
+        executor.shutdown(wait=False, cancel_futures=True)
+        if running:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.join(5)
+            # the segments the terminated processes created after their futures failed
+            for future in running:
+                if futures[future] is not None:
+                    unlink_segments(futures[future])
+        return cancelled+len(running)
+
+    def _cancelled(self):
+        # True once cancel is called
+        generation = self._generation
+        return lambda: self._generation != generation
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
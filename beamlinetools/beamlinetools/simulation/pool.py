@@ -0,0 +1,322 @@
+import os
+import queue
+import logging
+import itertools
+import threading
+from concurrent.futures import Future, CancelledError
+
+from .engine import SimulationEngineBase
+from .rays import convert_raw_rays, postprocess_rays, text_ray_file
+from .timing import span
+
+logger = logging.getLogger(__name__)
+
+
+class RayUIWorker():
+    """A long-lived instance of RAY-UI, hidden with xvfb.
+
+    The RAY-UI process is started once and reused for every simulation:
+    each job only loads the rml file, traces and exports.
+
+    Args:
+        worker_id (int): the id of the worker
+        ray_ui_location (str, optional): the location of the RAY-UI installation folder.
+                                         If None it is detected automatically. Defaults to None.
+        export_format (str, optional): the exported format. Defaults to 'RawRaysOutgoing'.
+        binary (bool, optional): convert the csv files exported by RAY-UI into binary
+                                 ``.npy`` files, see :func:`convert_raw_rays`. Defaults to True.
+    """
+    def __init__(self, worker_id:int, ray_ui_location:str=None, export_format='RawRaysOutgoing', binary:bool=True):
+        self.worker_id = worker_id
+        self.ray_ui_location = ray_ui_location
+        self.export_format = export_format
+        self.binary = binary
+        self.runner = None
+        self.api = None
+
+    def start(self):
+        """Start the RAY-UI process"""
+        from raypyng.runner import RayUIRunner, RayUIAPI
+        self.runner = RayUIRunner(ray_path=self.ray_ui_location, hide=True)
+        self.runner.run()
+        self.api = RayUIAPI(self.runner)
+
+    def is_alive(self)->bool:
+        """Health check of the worker
+
+        Returns:
+            bool: True if the RAY-UI process is running
+        """
+        return self.runner is not None and self.runner.isrunning
+
+    def stop(self):
+        """Quit RAY-UI, kill it if it does not answer"""
+        if self.runner is None:
+            return
+        try:
+            self.api.quit()
+        except Exception:
+            self.runner.kill()
+        self.runner = None
+        self.api = None
+
+    def kill(self):
+        """Kill the RAY-UI process, e.g. to interrupt a trace. It is restarted before the next job"""
+        runner = self.runner
+        if runner is not None:
+            runner.kill()
+
+    def restart(self):
+        """Stop and start the RAY-UI process"""
+        self.stop()
+        self.start()
+
+    def run(self, path:str, rml_file:str, exports_list):
+        """Simulate ``rml_file`` and export the results into ``path``
+
+        Args:
+            path (str): the simulation folder
+            rml_file (str): the rml file to simulate
+            exports_list (list): list of the exported objects
+        """
+        from raypyng.postprocessing import PostProcess
+        with span('engine_load', path=path, worker=self.worker_id):
+            self.api.load(rml_file)
+        with span('trace', path=path, worker=self.worker_id):
+            self.api.trace(analyze=False)
+        with span('export', path=path, worker=self.worker_id):
+            self.api.save(rml_file)
+            pp = PostProcess()
+            for exp in exports_list:
+                self.api.export(exp, self.export_format, path, '')
+                if self.binary:
+                    # the csv file is parsed only once, then removed
+                    convert_raw_rays(path, exp, self.export_format)
+                    os.remove(text_ray_file(path, exp, self.export_format))
+                    postprocess_rays(path, exp, rml_file, self.export_format)
+                    continue
+                pp.postprocess_RawRays(exported_element=exp,
+                                       exported_object=self.export_format,
+                                       dir_path=path,
+                                       sim_number='',
+                                       rml_filename=rml_file)
+
+
+class RayUIWorkerPool():
+    """A pool of long-lived RAY-UI workers.
+
+    Each worker has its own queue and thread. Jobs are dispatched either
+    to the worker with less pending jobs (``'least_loaded'``) or to each
+    worker in turn (``'round_robin'``). A health check periodically
+    respawns the idle workers whose RAY-UI process died, and a job
+    failing because of a crashed worker is retried after respawning it.
+    :meth:`cancel` drops the queued jobs and kills the busy workers.
+
+    Args:
+        n_workers (int, optional): number of workers. If None the number of cpus is used. Defaults to None.
+        ray_ui_location (str, optional): the location of the RAY-UI installation folder. Defaults to None.
+        dispatch (str, optional): 'least_loaded' or 'round_robin'. Defaults to 'least_loaded'.
+        health_check_interval (float, optional): seconds between two health checks,
+                                                 if None no health check is done. Defaults to 10.
+        max_retries (int, optional): how many times a failed job is retried. Defaults to 1.
+        worker_class (optional): the class of the workers, it must implement the
+                                 interface of :class:`RayUIWorker`. Defaults to RayUIWorker.
+    """
+    dispatch_modes = ('least_loaded', 'round_robin')
+
+    def __init__(self, n_workers:int=None, ray_ui_location:str=None, dispatch='least_loaded',
+                 health_check_interval:float=10., max_retries:int=1, worker_class=RayUIWorker):
+        if dispatch not in self.dispatch_modes:
+            raise ValueError(f"dispatch must be one of {self.dispatch_modes}, not '{dispatch}'")
+        if n_workers is None:
+            n_workers = os.cpu_count()
+        self.dispatch = dispatch
+        self.max_retries = max_retries
+        self.health_check_interval = health_check_interval
+        self.workers = [worker_class(i, ray_ui_location=ray_ui_location) for i in range(n_workers)]
+        self.restarts = [0]*n_workers
+        self.jobs_done = [0]*n_workers
+        self._pending = [0]*n_workers
+        # the future of the job running on each worker, and of the jobs killed by cancel
+        self._running = [None]*n_workers
+        self._killed = set()
+        self._locks = [threading.Lock() for _ in range(n_workers)]
+        self._queues = [queue.Queue() for _ in range(n_workers)]
+        self._round_robin = itertools.cycle(range(n_workers))
+        self._dispatch_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = [threading.Thread(target=self._worker_loop, args=(i,), daemon=True) for i in range(n_workers)]
+        for t in self._threads:
+            t.start()
+        if health_check_interval is not None:
+            threading.Thread(target=self._health_loop, daemon=True).start()
+
+    def __len__(self):
+        return len(self.workers)
+
+    def submit(self, path:str, rml_file:str, exports_list)->Future:
+        """Queue a simulation on one of the workers
+
+        Args:
+            path (str): the simulation folder
+            rml_file (str): the rml file to simulate
+            exports_list (list): list of the exported objects
+
+        Returns:
+            Future: resolved once the results are exported in ``path``
+        """
+        if self._stop.is_set():
+            raise RuntimeError("The pool has been shut down")
+        future = Future()
+        with self._dispatch_lock:
+            index = self._select_worker()
+            self._pending[index] += 1
+        self._queues[index].put((future, (path, rml_file, list(exports_list))))
+        return future
+
+    def check_health(self)->list:
+        """Respawn the idle workers that are not alive
+
+        Returns:
+            list: the ids of the respawned workers
+        """
+        respawned = []
+        for index, worker in enumerate(self.workers):
+            if not self._locks[index].acquire(blocking=False):
+                # busy workers are checked when the job is done
+                continue
+            try:
+                if not worker.is_alive():
+                    self._restart(index)
+                    respawned.append(worker.worker_id)
+            except Exception as e:
+                logger.warning(f"Could not respawn worker {worker.worker_id}: {e}")
+            finally:
+                self._locks[index].release()
+        return respawned
+
+    def cancel(self)->int:
+        """Cancel the queued jobs and kill the workers running a job
+
+        The killed workers are restarted before their next job, the
+        futures of their jobs raise :class:`CancelledError`.
+
+        Returns:
+            int: the number of cancelled jobs
+        """
+        cancelled = 0
+        for q in self._queues:
+            with q.mutex:
+                jobs = [job for job in q.queue if job is not None]
+            cancelled += sum(future.cancel() for future, args in jobs)
+        for index, worker in enumerate(self.workers):
+            future = self._running[index]
+            if future is not None and not future.done():
+                self._killed.add(future)
+                worker.kill()
+                cancelled += 1
+        return cancelled
+
+    def stats(self)->dict:
+        """Return the state of the workers
+
+        Returns:
+            dict: pending jobs, jobs done, restarts and health of each worker
+        """
+        return {w.worker_id: {'pending': self._pending[i],
+                              'jobs_done': self.jobs_done[i],
+                              'restarts': self.restarts[i],
+                              'alive': w.is_alive()} for i, w in enumerate(self.workers)}
+
+    def shutdown(self):
+        """Stop the threads and quit all the workers"""
+        self._stop.set()
+        for q in self._queues:
+            q.put(None)
+        for t in self._threads:
+            t.join()
+        for worker in self.workers:
+            worker.stop()
+
+    def _select_worker(self)->int:
+        if self.dispatch == 'round_robin':
+            return next(self._round_robin)
+        return min(range(len(self.workers)), key=lambda i: self._pending[i])
+
+    def _restart(self, index):
+        self.restarts[index] += 1
+        self.workers[index].restart()
+
+    def _worker_loop(self, index):
+        worker = self.workers[index]
+        with self._locks[index]:
+            try:
+                worker.start()
+            except Exception as e:
+                logger.warning(f"Could not start worker {worker.worker_id}: {e}")
+        while True:
+            job = self._queues[index].get()
+            if job is None:
+                return
+            future, args = job
+            if future.set_running_or_notify_cancel():
+                with self._locks[index]:
+                    self._running[index] = future
+                    try:
+                        self._run_job(index, future, args)
+                    finally:
+                        self._running[index] = None
+                        self._killed.discard(future)
+            with self._dispatch_lock:
+                self._pending[index] -= 1
+
+    def _run_job(self, index, future, args):
+        worker = self.workers[index]
+        for attempt in range(self.max_retries+1):
+            try:
+                if not worker.is_alive():
+                    self._restart(index)
+                result = worker.run(*args)
+            except Exception as e:
+                if future in self._killed:
+                    future.set_exception(CancelledError(f"Worker {worker.worker_id} was killed"))
+                    return
+                logger.warning(f"Worker {worker.worker_id} failed (attempt {attempt+1}): {e}")
+                if attempt == self.max_retries:
+                    future.set_exception(e)
+                    return
+                try:
+                    self._restart(index)
+                except Exception:
+                    pass
+            else:
+                self.jobs_done[index] += 1
+                future.set_result(result)
+                return
+
+    def _health_loop(self):
+        while not self._stop.wait(self.health_check_interval):
+            self.check_health()
+
+
+class PooledSimulationEngine(SimulationEngineBase):
+    """Simulation engine that runs the simulations on a :class:`RayUIWorkerPool`
+
+    Args:
+        pool (RayUIWorkerPool): the pool of workers
+    """
+    def __init__(self, pool:RayUIWorkerPool):
+        self.pool = pool
+
+    def run(self, path, rml_file, exports_list):
+        return self.pool.submit(path, rml_file, exports_list).result()
+
+    def submit(self, path, rml, exports_list):
+        rml_file = self.write_rml(path, rml)
+        return self.pool.submit(path, rml_file, exports_list)
+
+    def cancel(self)->int:
+        return self.pool.cancel()
+
+    def shutdown(self):
+        self.pool.shutdown()
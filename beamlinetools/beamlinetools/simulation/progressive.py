@@ -0,0 +1,192 @@
+import os
+import math
+import shutil
+import logging
+from concurrent.futures import ThreadPoolExecutor, CancelledError, wait
+
+import numpy as np
+
+from .rays import RayFileWriter, RayTable, load_rays, ray_file, postprocess_rays
+from .detectors import detector_statistics, write_statistics, source_element, simulated_source_flux
+from .engine import SimulationEngineBase, submit_batch
+
+logger = logging.getLogger(__name__)
+
+
+def relative_error(values)->float:
+    """Relative standard error of the mean of independent estimates of a signal
+
+    Args:
+        values (list): the estimates, at least two
+
+    Returns:
+        float: std/sqrt(n)/|mean|, inf if it cannot be estimated
+    """
+    values = np.asarray(values, dtype=float)
+    if len(values) < 2 or not np.all(np.isfinite(values)):
+        return np.inf
+    error = np.std(values, ddof=1)/np.sqrt(len(values))
+    mean = abs(np.mean(values))
+    if mean == 0:
+        return 0. if error == 0 else np.inf
+    return float(error/mean)
+
+
+def merge_rays(filename:str, tables, chunk_size:int=1000000)->str:
+    """Concatenate ray tables into a single columnar ``.npy`` file
+
+    Args:
+        filename (str): the ``.npy`` file
+        tables (list): the :class:`RayTable` to merge, with the same columns
+        chunk_size (int, optional): number of rays copied at once. Defaults to 1000000.
+
+    Returns:
+        str: the name of the ``.npy`` file
+    """
+    columns = tables[0].columns
+    with RayFileWriter(filename, columns) as writer:
+        for table in tables:
+            for chunk in table.chunks(columns, chunk_size):
+                writer.write(np.column_stack([chunk[c] for c in columns]))
+    return filename
+
+
+class ProgressiveSimulationEngine(SimulationEngineBase):
+    """Simulation engine adding rays until a target statistical precision
+
+    Each simulation is split into independent batches of ``batch_rays``
+    rays, submitted in parallel to the wrapped engine. After each round the
+    relative Monte Carlo error of ``signal`` is estimated from the spread of
+    the batches, and more batches are submitted, as many as the error
+    suggests, until it is below ``tolerance`` or ``max_rays`` is reached. The
+    batches are then merged into a single ray file per exported element, and
+    the signals are written into the statistics file, with the error as ``mc_error``.
+
+    To run the batches in parallel the wrapped engine must implement
+    ``submit`` (e.g. :class:`PooledSimulationEngine` or :class:`NumpySimulationEngine`
+    with ``max_workers>1``). Put it inside the cache, the batches of the
+    same simulation must not be served from the cache.
+
+    Args:
+        engine: the simulation engine
+        tolerance (float, optional): target relative error. Defaults to 0.01.
+        signal (str, optional): the signal whose error is checked, see :func:`detector_statistics`.
+                                Defaults to 'intensity'.
+        detector (str, optional): the detector whose error is checked, if None the largest
+                                  error of all the exported detectors. Defaults to None.
+        batch_rays (int, optional): number of rays of each batch. Defaults to 10000.
+        max_rays (int, optional): maximum number of rays, if None ``numberRays`` of the source.
+                                  Defaults to None.
+        batches_per_round (int, optional): minimum number of batches submitted at once. Defaults to 4.
+        export_format (str, optional): the exported format. Defaults to 'RawRaysOutgoing'.
+    """
+    batches_folder = 'batches'
+
+    def __init__(self, engine, tolerance:float=0.01, signal:str='intensity', detector:str=None,
+                 batch_rays:int=10000, max_rays:int=None, batches_per_round:int=4,
+                 export_format='RawRaysOutgoing'):
+        self.engine = engine
+        self.tolerance = tolerance
+        self.signal = signal
+        self.detector = detector
+        self.batch_rays = batch_rays
+        self.max_rays = max_rays
+        self.batches_per_round = max(2, batches_per_round)
+        self.export_format = export_format
+        self.rays_traced = 0
+        self.simulations = 0
+        self._executor = ThreadPoolExecutor(thread_name_prefix='progressive')
+        # the number of calls to cancel
+        self._generation = 0
+
+    @property
+    def precision(self)->tuple:
+        """The settings deciding how many rays are traced, see :func:`simulation_precision`"""
+        return (self.tolerance, self.signal, self.detector, self.batch_rays, self.max_rays)
+
+    def setup_simulation(self):
+        return self.engine.setup_simulation()
+
+    def submit(self, path, rml, exports_list):
+        rml_file = self.write_rml(path, rml)
+        return self._executor.submit(self._refine, path, rml_file, sorted(set(exports_list)))
+
+    def run(self, path, rml_file, exports_list):
+        return self._refine(path, rml_file, sorted(set(exports_list)))
+
+    def stats(self)->dict:
+        """Return the number of simulations and of rays traced
+
+        Returns:
+            dict: simulations, rays traced and mean number of rays per simulation
+        """
+        return {'simulations': self.simulations,
+                'rays_traced': self.rays_traced,
+                'mean_rays': self.rays_traced/self.simulations if self.simulations else 0}
+
+    def cancel(self)->int:
+        """Stop submitting the batches of the running simulations
+
+        The batches already submitted are cancelled by the wrapped engine.
+
+        Returns:
+            int: 0, the batches are counted by the wrapped engine
+        """
+        self._generation += 1
+        return 0
+
+    def shutdown(self):
+        self._executor.shutdown()
+        if hasattr(self.engine, 'shutdown'):
+            self.engine.shutdown()
+
+    def _refine(self, path, rml_file, exports_list):
+        from raypyng.rml import RMLFile
+        rml = RMLFile(rml_file)
+        source = source_element(rml)
+        flux, number_rays = float(source.photonFlux.cdata), int(float(source.numberRays.cdata))
+        max_batches = max(2, (self.max_rays or number_rays)//self.batch_rays)
+        source.numberRays.cdata = str(self.batch_rays)
+        folders, values = [], {exp: [] for exp in exports_list}
+        n, error = self.batches_per_round, np.inf
+        generation = self._generation
+        try:
+            while True:
+                futures = []
+                for batch in range(len(folders), min(len(folders)+n, max_batches)):
+                    if self._generation != generation:
+                        raise CancelledError("The simulation was cancelled")
+                    folder = os.path.join(path, self.batches_folder, str(batch))
+                    folders.append(folder)
+                    futures.append((folder, submit_batch(self.engine, folder, rml, exports_list, batch)))
+                wait([future for folder, future in futures])
+                for folder, future in futures:
+                    future.result()
+                    for exp in exports_list:
+                        rays = load_rays(folder, exp, self.export_format)
+                        # the flux computed by the simulation, e.g. by RAY-UI at the photon energy of a Dipole
+                        flux = simulated_source_flux(folder, exp, (flux, self.batch_rays))[0]
+                        values[exp].append(detector_statistics(rays, (flux, self.batch_rays))[self.signal])
+                checked = [self.detector] if self.detector is not None else exports_list
+                error = max((relative_error(values[exp]) for exp in checked), default=0.)
+                if error <= self.tolerance or len(folders) >= max_batches:
+                    break
+                # the error decreases as 1/sqrt(number of batches)
+                needed = math.ceil(len(folders)*(error/self.tolerance)**2) if np.isfinite(error) else 2*len(folders)
+                n = max(self.batches_per_round, needed-len(folders))
+            total = len(folders)*self.batch_rays
+            source.numberRays.cdata = str(total)
+            source.photonFlux.cdata = str(flux)
+            rml.write(rml_file)
+            for exp in exports_list:
+                tables = [load_rays(folder, exp, self.export_format) for folder in folders]
+                merged = merge_rays(ray_file(path, exp, self.export_format), tables)
+                postprocess_rays(path, exp, rml_file, self.export_format)
+                statistics = detector_statistics(RayTable(merged), (flux, total))
+                statistics['mc_error'] = relative_error(values[exp]) if exp in checked else np.nan
+                write_statistics(path, exp, statistics)
+            self.simulations += 1
+            self.rays_traced += total
+            logger.debug(f"{len(folders)} batches of {self.batch_rays} rays, relative error {error:.3g}")
+        finally:
+            shutil.rmtree(os.path.join(path, self.batches_folder), ignore_errors=True)
@@ -0,0 +1,290 @@
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def ray_file(path:str, element:str, export_format='RawRaysOutgoing')->str:
+    """Return the name of the binary ray file of an exported element
+
+    Args:
+        path (str): the simulation folder
+        element (str): the exported element
+        export_format (str, optional): the exported format. Defaults to 'RawRaysOutgoing'.
+
+    Returns:
+        str: ``<path>/<element>-<export_format>.npy``
+    """
+    return os.path.join(path, f"{element}-{export_format}.npy")
+
+
+def text_ray_file(path:str, element:str, export_format='RawRaysOutgoing')->str:
+    """Return the name of the csv file exported by RAY-UI"""
+    return os.path.join(path, f"{element}-{export_format}.csv")
+
+
+class RayFileWriter():
+    """Write rays, batch by batch, into a columnar ``.npy`` file
+
+    The file contains a single record whose fields are the columns
+    (``OX``, ``OY``, ``EN``, ...), each one an array with all the rays, so that
+    every column is contiguous on disk and can be memory-mapped on its own.
+    The columns are first written into temporary files, and assembled when
+    the writer is closed, so the memory used does not depend on the number of rays.
+
+    Args:
+        filename (str): the ``.npy`` file
+        columns (list): the names of the columns
+    """
+    def __init__(self, filename:str, columns):
+        self.filename = filename
+        self.columns = list(columns)
+        self.nrays = 0
+        self._files = [open(f"{filename}.{i}.tmp", 'wb') for i in range(len(self.columns))]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, table):
+        """Append rays
+
+        Args:
+            table (np.ndarray): array of shape (number of rays, number of columns)
+        """
+        table = np.asarray(table, dtype='<f8')
+        for i, f in enumerate(self._files):
+            np.ascontiguousarray(table[:, i]).tofile(f)
+        self.nrays += table.shape[0]
+
+    def close(self):
+        """Assemble the columns into the ``.npy`` file"""
+        for f in self._files:
+            f.close()
+        dtype = np.dtype([(c, '<f8', (self.nrays,)) for c in self.columns])
+        header = {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': (1,)}
+        with open(self.filename+'.tmp', 'wb') as out:
+            np.lib.format.write_array_header_1_0(out, header)
+            for f in self._files:
+                with open(f.name, 'rb') as column:
+                    while True:
+                        chunk = column.read(16*1024**2)
+                        if not chunk:
+                            break
+                        out.write(chunk)
+        os.replace(self.filename+'.tmp', self.filename)
+        self._remove_columns()
+
+    def abort(self):
+        """Remove the temporary files"""
+        for f in self._files:
+            f.close()
+        self._remove_columns()
+
+    def _remove_columns(self):
+        for f in self._files:
+            if os.path.exists(f.name):
+                os.remove(f.name)
+
+
+class RayTable():
+    """Read-only, memory-mapped view of a columnar ray file
+
+    ``table['OX']`` returns a memory-mapped array of one column: only the
+    columns that are used are read from disk, and nothing is copied.
+
+    Args:
+        filename (str): the ``.npy`` file written by :class:`RayFileWriter`
+    """
+    def __init__(self, filename:str):
+        self.filename = filename
+        self._data = np.load(filename, mmap_mode='r')
+        self.columns = self._data.dtype.names
+        self.nrays = self._data.dtype[0].shape[0] if self.columns else 0
+
+    def __len__(self):
+        return self.nrays
+
+    def __contains__(self, column):
+        return column in self.columns
+
+    def __getitem__(self, column:str)->np.ndarray:
+        return self._data[column][0]
+
+    def chunks(self, columns, chunk_size:int):
+        """Read some columns, ``chunk_size`` rays at a time
+
+        The chunks are read from the file, not through the memory map, so
+        the memory used does not depend on the number of rays.
+
+        Args:
+            columns (list): the columns to read
+            chunk_size (int): number of rays per chunk
+
+        Yields:
+            dict: column -> values of the chunk
+        """
+        offsets = {c: self._data.offset+self._data.dtype.fields[c][1] for c in columns}
+        with open(self.filename, 'rb') as f:
+            for start in range(0, self.nrays, chunk_size):
+                count = min(chunk_size, self.nrays-start)
+                chunk = {}
+                for c in columns:
+                    f.seek(offsets[c]+8*start)
+                    chunk[c] = np.fromfile(f, dtype='<f8', count=count)
+                yield chunk
+
+
+def convert_raw_rays(path:str, element:str, export_format='RawRaysOutgoing', chunk_size:int=100000)->str:
+    """Convert the csv file exported by RAY-UI into a columnar ``.npy`` file
+
+    The csv file is parsed once, in chunks of ``chunk_size`` rays. The
+    columns are named as in RAY-UI, without the prefix ``<element>_``.
+
+    Args:
+        path (str): the simulation folder
+        element (str): the exported element
+        export_format (str, optional): the exported format. Defaults to 'RawRaysOutgoing'.
+        chunk_size (int, optional): number of rays parsed at once. Defaults to 100000.
+
+    Returns:
+        str: the name of the ``.npy`` file
+    """
+    import pandas as pd
+    csv = text_ray_file(path, element, export_format)
+    with open(csv) as f:
+        f.readline()
+        names = f.readline().rstrip('\n').split('\t')
+    columns = [name[len(element)+1:] if name.startswith(element+'_') else name for name in names]
+    with RayFileWriter(ray_file(path, element, export_format), columns) as writer:
+        for chunk in pd.read_csv(csv, sep='\t', skiprows=2, header=None, names=names,
+                                 dtype=float, chunksize=chunk_size):
+            writer.write(chunk.to_numpy())
+    return writer.filename
+
+
+_tables = OrderedDict()
+_tables_lock = threading.Lock()
+# number of ray files kept open by load_rays
+max_open_tables = 32
+
+
+def load_rays(path:str, element:str, export_format='RawRaysOutgoing')->RayTable:
+    """Return the rays exported for ``element`` in ``path``
+
+    If only the csv file exported by RAY-UI exists, it is converted with
+    :func:`convert_raw_rays` first. The tables are shared: all the
+    detectors reading the same export use the same memory-mapped file.
+    Rays exported in shared memory (see :class:`SharedRayWriter`) are
+    attached without copying, and released at the end of the point.
+
+    Args:
+        path (str): the simulation folder
+        element (str): the exported element
+        export_format (str, optional): the exported format. Defaults to 'RawRaysOutgoing'.
+
+    Returns:
+        RayTable or SharedRayTable: the rays
+    """
+    from .shared_rays import shared_ray_file, load_shared_rays
+    filename = ray_file(path, element, export_format)
+    shared = shared_ray_file(path, element, export_format)
+    if os.path.exists(shared) and (not os.path.exists(filename) or os.path.getmtime(shared) >= os.path.getmtime(filename)):
+        rays = load_shared_rays(path, element, export_format)
+        if rays is not None:
+            return rays
+        if not os.path.exists(filename):
+            raise FileNotFoundError(f"The shared rays of {element} in {path} were already released")
+    csv = text_ray_file(path, element, export_format)
+    with _tables_lock:
+        if os.path.exists(csv) and (not os.path.exists(filename) or os.path.getmtime(csv) > os.path.getmtime(filename)):
+            convert_raw_rays(path, element, export_format)
+        st = os.stat(filename)
+        key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        entry = _tables.get(filename)
+        if entry is None or entry[0] != key:
+            entry = (key, RayTable(filename))
+            _tables[filename] = entry
+        _tables.move_to_end(filename)
+        while len(_tables) > max_open_tables:
+            _tables.popitem(last=False)
+    return entry[1]
+
+
+def fwhm(values)->float:
+    """Full width at half maximum of a distribution, same algorithm as raypyng
+
+    Below 100 values the standard deviation is used, otherwise the width of
+    the region of a histogram above half of its maximum, increasing the
+    number of bins until the width is positive.
+
+    Args:
+        values (np.ndarray): the values
+
+    Returns:
+        float: the fwhm
+    """
+    values = np.asarray(values)
+    if values.shape[0] < 100:
+        return 2*np.sqrt(2*np.log(2))*np.std(values)
+    for bins in [30, 300, 3000, 30000, 300000]:
+        y, edges = np.histogram(values, bins=bins)
+        x = (edges[1:]+edges[:-1])/2
+        above = np.flatnonzero(y > y.max()/2)
+        # same indices as raypyng, shifted by one bin
+        width = x[above[-1]-1]-x[above[0]-1]
+        if width > 0:
+            return width
+    return 2*np.sqrt(2*np.log(2))*np.std(values)
+
+
+def postprocess_rays(path:str, element:str, rml_filename:str, export_format='RawRaysOutgoing', rays=None):
+    """Write ``<element>_analyzed_rays.dat`` from the binary rays
+
+    Same quantities as ``PostProcess.postprocess_RawRays`` of raypyng, that
+    parses the csv file instead, so that the detectors of raypyng-bluesky
+    can read the results of the binary exports. The rays are reduced
+    in chunks, see :func:`ray_statistics`. When no ray survived only the
+    source flux and the photon energy are set, the other values are 0 as
+    in raypyng. Errors reading the rays or the rml file are raised.
+
+    Args:
+        path (str): the simulation folder
+        element (str): the exported element
+        rml_filename (str): the simulated rml file
+        export_format (str, optional): the exported format. Defaults to 'RawRaysOutgoing'.
+        rays (RayTable, optional): the rays, if None they are loaded with :func:`load_rays`. Defaults to None.
+    """
+    from raypyng.postprocessing import PostProcess, RayProperties
+    from .reductions import ray_statistics
+    pp = PostProcess()
+    ray_properties = RayProperties()
+    if rays is None:
+        rays = load_rays(path, element, export_format)
+    source_photon_flux, source_n_rays = pp.extract_nrays_from_source(rml_filename)
+    energy = pp.extract_energy_from_source(rml_filename)
+    bw_source = pp.extract_bw_from_source(rml_filename)
+    ray_properties['PhotonEnergy'] = energy
+    ray_properties['SourcePhotonFlux'] = source_photon_flux
+    if len(rays) > 0:
+        reduced = ray_statistics(rays, ('OX', 'OY', 'EN'))
+        ray_properties['NumberRaysSurvived'] = len(rays)
+        ray_properties['PercentageRaysSurvived'] = len(rays)/float(source_n_rays)*100
+        photon_flux = source_photon_flux/100*ray_properties['PercentageRaysSurvived']
+        bw = reduced['EN']['fwhm']
+        ray_properties['PhotonFlux'] = photon_flux
+        ray_properties['Bandwidth'] = bw
+        ray_properties['HorizontalFocusFWHM'] = reduced['OX']['fwhm']
+        ray_properties['VerticalFocusFWHM'] = reduced['OY']['fwhm']
+        ray_properties['EnergyPerMilPerBw'] = pp._energy_permil_perbw(bw, bw_source)
+        ray_properties['FluxPerMilPerBwPerc'] = pp._flux_permil_perbw(bw, bw_source, ray_properties['PercentageRaysSurvived'])
+        ray_properties['FluxPerMilPerBwAbs'] = pp._flux_permil_perbw(bw, bw_source, ray_properties['PhotonFlux'])
+        ray_properties['AXUVCurrentAmp'] = pp.axuv_diode.convert_photons_to_amp(energy, photon_flux)
+        ray_properties['GaAsPCurrentAmp'] = pp.gaasp_diode.convert_photons_to_amp(energy, photon_flux)
+    ray_properties.save(os.path.join(path, element+'_analyzed_rays.dat'))
@@ -0,0 +1,208 @@
+import numpy as np
+
+# number of rays read at once by reduce_rays
+CHUNK_SIZE = 1000000
+
+# 2*sqrt(2*ln(2)), fwhm of a gaussian in units of sigma
+FWHM_SIGMA = 2*np.sqrt(2*np.log(2))
+
+
+class Moments():
+    """Streaming count, mean, variance, minimum and maximum of a column
+
+    Chunks are combined with the parallel algorithm of Chan et al., so
+    the result does not depend on the chunk size.
+
+    Args:
+        column (str): the name of the column
+    """
+    def __init__(self, column:str):
+        self.columns = (column,)
+        self.count = 0
+        self.mean = 0.
+        self.m2 = 0.
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, chunk:dict):
+        """Add a chunk of rays, a dict column -> values"""
+        values = chunk[self.columns[0]]
+        n = len(values)
+        if n == 0:
+            return
+        mean = float(np.mean(values))
+        m2 = float(np.sum((values-mean)**2))
+        delta = mean-self.mean
+        total = self.count+n
+        self.mean += delta*n/total
+        self.m2 += m2+delta**2*self.count*n/total
+        self.count = total
+        self.min = min(self.min, float(np.min(values)))
+        self.max = max(self.max, float(np.max(values)))
+
+    @property
+    def variance(self)->float:
+        return self.m2/self.count if self.count else np.nan
+
+    @property
+    def std(self)->float:
+        return np.sqrt(self.variance)
+
+
+class Histogram():
+    """Streaming 1D or 2D histogram with an adaptive range
+
+    The range is taken from the first chunk, and doubled whenever a value
+    falls outside of it, merging pairs of neighbouring bins: the histogram
+    is built in a single pass, without knowing the range in advance.
+
+    Args:
+        *columns (str): one or two column names
+        bins (int or tuple, optional): number of bins along each axis, it must be even.
+                                       Defaults to 30000 in 1D, 512 in 2D.
+        range (list, optional): initial (min, max) along each axis, it is extended if needed.
+                                Defaults to None.
+    """
+    def __init__(self, *columns, bins=None, range=None):
+        if len(columns) not in (1, 2):
+            raise ValueError("Only 1D and 2D histograms are supported")
+        if bins is None:
+            bins = 30000 if len(columns) == 1 else 512
+        bins = np.broadcast_to(bins, len(columns)).astype(int)
+        if np.any(bins % 2):
+            raise ValueError("The number of bins must be even")
+        self.columns = columns
+        self.bins = tuple(bins)
+        self.counts = np.zeros(self.bins, dtype=np.int64)
+        self._lo = [None]*len(columns)
+        self._width = [None]*len(columns)
+        if range is not None:
+            for axis, (lo, hi) in enumerate(np.reshape(range, (len(columns), 2))):
+                self._set_range(axis, lo, hi)
+
+    @property
+    def edges(self)->list:
+        """Edges of the bins along each axis"""
+        return [lo+width*np.arange(n+1) if lo is not None else None
+                for lo, width, n in zip(self._lo, self._width, self.bins)]
+
+    def update(self, chunk:dict):
+        """Add a chunk of rays, a dict column -> values"""
+        values = [np.asarray(chunk[c], dtype=float) for c in self.columns]
+        if len(values[0]) == 0:
+            return
+        indices = []
+        for axis, v in enumerate(values):
+            lo, hi = float(np.min(v)), float(np.max(v))
+            if self._lo[axis] is None:
+                self._set_range(axis, lo, hi)
+            while lo < self._lo[axis]:
+                self._expand(axis, left=True)
+            while hi >= self._lo[axis]+self._width[axis]*self.bins[axis]:
+                self._expand(axis, left=False)
+            index = ((v-self._lo[axis])/self._width[axis]).astype(np.int64)
+            indices.append(np.clip(index, 0, self.bins[axis]-1))
+        flat = np.ravel_multi_index(indices, self.bins)
+        self.counts += np.bincount(flat, minlength=self.counts.size).reshape(self.bins)
+
+    def fwhm(self, steps=(30, 300, 3000, 30000))->float:
+        """Full width at half maximum of a 1D histogram
+
+        Same steps as raypyng: the occupied range is divided into 30
+        bins, then 300, ... until the width of the region above half of the
+        maximum is positive. The bins are those of the histogram, so the
+        width can differ from raypyng by about one bin.
+
+        Returns:
+            float: the fwhm, nan if it cannot be estimated
+        """
+        if len(self.columns) != 1:
+            raise ValueError("The fwhm is defined for 1D histograms")
+        occupied = np.flatnonzero(self.counts)
+        if len(occupied) == 0:
+            return np.nan
+        counts = self.counts[occupied[0]:occupied[-1]+1]
+        for n in steps:
+            group = max(1, len(counts)//n)
+            coarse = np.add.reduceat(counts, np.arange(0, len(counts), group))
+            above = np.flatnonzero(coarse > coarse.max()/2)
+            width = (above[-1]-above[0])*group*self._width[0]
+            if width > 0:
+                return width
+            if group == 1:
+                break
+        return np.nan
+
+    def _set_range(self, axis, lo, hi):
+        width = (hi-lo)/self.bins[axis]
+        if width <= 0:
+            width = max(abs(lo), 1.)*1e-12
+        self._lo[axis] = lo
+        # slightly larger, so that hi falls in the last bin
+        self._width[axis] = width*(1+1e-9)
+
+    def _expand(self, axis, left:bool):
+        n = self.bins[axis]
+        counts = np.moveaxis(self.counts, axis, 0)
+        merged = counts[0::2]+counts[1::2]
+        expanded = np.zeros_like(counts)
+        if left:
+            expanded[n//2:] = merged
+            self._lo[axis] -= self._width[axis]*n
+        else:
+            expanded[:n//2] = merged
+        self._width[axis] *= 2
+        self.counts = np.moveaxis(expanded, 0, axis)
+
+
+def reduce_rays(rays, reducers, chunk_size:int=CHUNK_SIZE):
+    """Feed all the ``reducers`` with a single pass over ``rays``
+
+    Only the columns used by the reducers are read, ``chunk_size`` rays at
+    a time, so that the memory used does not depend on the number of rays.
+
+    Args:
+        rays (RayTable or dict): the rays, see :func:`load_rays`
+        reducers (list): objects with the attribute ``columns`` and the method ``update(chunk)``
+        chunk_size (int, optional): number of rays read at once. Defaults to 1000000.
+
+    Returns:
+        list: the reducers
+    """
+    columns = sorted({c for reducer in reducers for c in reducer.columns})
+    if hasattr(rays, 'chunks'):
+        chunks = rays.chunks(columns, chunk_size)
+    else:
+        chunks = ({c: np.asarray(rays[c][start:start+chunk_size]) for c in columns}
+                  for start in range(0, len(rays), chunk_size))
+    for chunk in chunks:
+        for reducer in reducers:
+            reducer.update(chunk)
+    return reducers
+
+
+def ray_statistics(rays, columns=('OX', 'OY', 'EN'), chunk_size:int=CHUNK_SIZE)->dict:
+    """Number of rays, moments and fwhm of some columns, computed in a single pass
+
+    Below 100 rays the fwhm is estimated from the standard deviation, as raypyng does.
+
+    Args:
+        rays (RayTable): the rays, see :func:`load_rays`
+        columns (list, optional): the columns to analyze. Defaults to ('OX', 'OY', 'EN').
+        chunk_size (int, optional): number of rays read at once. Defaults to 1000000.
+
+    Returns:
+        dict: ``nrays`` and, for each column, a dict with mean, std, min, max and fwhm
+    """
+    moments = {c: Moments(c) for c in columns}
+    histograms = {c: Histogram(c) for c in columns}
+    reduce_rays(rays, list(moments.values())+list(histograms.values()), chunk_size)
+    statistics = {'nrays': len(rays)}
+    for c in columns:
+        m = moments[c]
+        width = FWHM_SIGMA*m.std if m.count < 100 else histograms[c].fwhm()
+        if m.count >= 100 and not width > 0:
+            width = FWHM_SIGMA*m.std
+        statistics[c] = {'mean': m.mean if m.count else np.nan, 'std': m.std,
+                         'min': m.min, 'max': m.max, 'fwhm': width}
+    return statistics
@@ -0,0 +1,123 @@
+import time
+
+import numpy as np
+
+from ophyd import Device, SignalRO, Component as Cpt
+
+
+def scale_intensity(intensity, current, nominal_current:float=300.):
+    """Scale intensities simulated at ``nominal_current`` to the ring current ``current``
+
+    The flux is proportional to the ring current. Both arguments can be
+    arrays, e.g. the twin intensities of a run and the ring currents
+    recorded at the same times.
+
+    Args:
+        intensity (float or array): the intensities at the nominal current [ph/s]
+        current (float or array): the ring current [mA]
+        nominal_current (float, optional): the ring current of ``intensity`` [mA]. Defaults to 300.
+
+    Returns:
+        float or array: the intensities at ``current``
+    """
+    return np.asarray(intensity)*np.asarray(current)/nominal_current
+
+
+class RingCurrentScaling():
+    """Scale the intensities of the twin by the current of the storage ring
+
+    The results of the simulations stay at the nominal current (see
+    :class:`TwinDetectorDevice`), cached and shared by all the points: the
+    intensity is scaled each time it is read, so the readings of the twin
+    follow the ring current, including the steps of the top-up injections,
+    without simulating again.
+
+    With ``bunches`` only the current of these bunches of the fill pattern is
+    used, e.g. for a detector gated on the camshaft bunch.
+
+    Args:
+        accelerator: a device with a ``current`` signal [mA] and, with ``bunches``, a ``fill``
+                     signal with the current of each bunch [mA], e.g. a
+                     :class:`DetailedAccelerator` or a :class:`ReplayedAccelerator`
+        bunches (optional): index, list of indices, slice or mask of the bunches in ``fill``.
+                            Defaults to None.
+    """
+    def __init__(self, accelerator, bunches=None):
+        self.accelerator = accelerator
+        self.bunches = bunches
+
+    def current(self)->float:
+        """Return the ring current seen by the detectors [mA]"""
+        if self.bunches is None:
+            return float(self.accelerator.current.get())
+        fill = np.asarray(self.accelerator.fill.get(), dtype=float)
+        return float(np.sum(fill[self.bunches]))
+
+    def scale(self, intensity, nominal_current:float, current=None):
+        """Scale intensities simulated at ``nominal_current``, see :func:`scale_intensity`
+
+        Args:
+            intensity (float or array): the intensities at the nominal current [ph/s]
+            nominal_current (float): the ring current of ``intensity`` [mA]
+            current (float or array, optional): the ring current, if None the current
+                                                one is read. Defaults to None.
+
+        Returns:
+            float or array: the intensities at ``current``
+        """
+        if current is None:
+            current = self.current()
+        return scale_intensity(intensity, current, nominal_current)
+
+
+class ReplayedSignal(SignalRO):
+    """Signal of a :class:`ReplayedAccelerator`, its value is the recorded one at this time"""
+    def get(self, **kwargs):
+        return self.parent.replayed_value(self.attr_name)
+
+
+class ReplayedAccelerator(Device):
+    """Stand-in for the :class:`DetailedAccelerator` replaying a recorded ring current and fill pattern
+
+    The records are replayed in real time from the creation of the device,
+    or from :meth:`restart`: each signal keeps the last recorded value
+    until the next record, like a monitored PV. Use it with
+    :class:`RingCurrentScaling` to compare the twin with past runs, or when
+    the machine PVs are not available.
+
+    Args:
+        times (array): the times of the records [s]
+        currents (array): the ring current at each record [mA]
+        fills (array, optional): the current of each bunch at each record [mA],
+                                 one row per record. Defaults to None.
+        loop (bool, optional): start again at the end of the records, otherwise the
+                               last values are kept. Defaults to True.
+    """
+    current = Cpt(ReplayedSignal, kind='hinted')
+    fill = Cpt(ReplayedSignal, kind='config')
+
+    def __init__(self, times, currents, fills=None, *, loop:bool=True, name='accelerator', **kwargs):
+        super().__init__(name=name, **kwargs)
+        times = np.asarray(times, dtype=float)
+        self._times = times-times[0]
+        self._values = {'current': np.asarray(currents, dtype=float),
+                        'fill': None if fills is None else np.asarray(fills, dtype=float)}
+        self.loop = loop
+        self.restart()
+
+    def restart(self):
+        """Replay the records from the beginning"""
+        self._start = time.time()
+
+    def replayed_value(self, signal:str):
+        """Return the recorded value of ``signal`` at this time of the replay"""
+        values = self._values[signal]
+        if values is None:
+            raise ValueError(f"No {signal} was recorded")
+        elapsed = time.time()-self._start
+        duration = self._times[-1]
+        if self.loop and duration > 0:
+            elapsed %= duration
+        index = max(np.searchsorted(self._times, elapsed, side='right')-1, 0)
+        value = values[index]
+        return value if np.ndim(value) else float(value)
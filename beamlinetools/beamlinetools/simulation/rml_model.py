@@ -0,0 +1,302 @@
+import re
+import weakref
+import threading
+from xml.sax.saxutils import escape, unescape
+
+from raypyng.xmltools.dictionaries import sanitizeName
+
+_TAG = re.compile(r'<[^>]*>')
+_ATTRIBUTE = re.compile(r'([^\s=]+)="([^"]*)"')
+
+
+class RMLTemplate():
+    """Pre-tokenised text of an rml file
+
+    The text is split into static chunks and the text of the leaf elements
+    (the ``<param>`` values, or their ``<x>``, ``<y>``, ``<z>`` children):
+    ``parts`` holds the static chunks at even indices and the values at odd
+    indices. Writing a new point only patches the values that changed and
+    joins the parts, instead of serializing the whole tree.
+
+    ``index`` maps ``(element name, param id)`` (and ``(element name, param id, child)``
+    for vector parameters) to the slot of the value, see :meth:`get` and :meth:`set`.
+    When ``sources`` is not None, the template is bound to the elements of a
+    raypyng ``RMLFile`` (see :func:`rml_template`) and their ``cdata`` is
+    copied before writing. Only the text of the elements is tracked: after
+    changing the attributes or the structure of the tree, call :meth:`refresh`.
+    """
+    __slots__ = ('parts', 'index', 'sources', '_rml', '__weakref__')
+
+    def __init__(self, parts:list, index:dict, sources:list=None, rml=None):
+        self.parts = parts
+        self.index = index
+        self.sources = sources
+        self._rml = rml
+
+    def __len__(self):
+        return len(self.parts)//2
+
+    def get(self, slot:int)->str:
+        """Return the text of a slot"""
+        return self.parts[2*slot+1]
+
+    def set(self, slot:int, value:str):
+        """Set the text of a slot"""
+        self.parts[2*slot+1] = value
+
+    def slot(self, element:str, param:str, child:str=None)->int:
+        """Return the slot of a parameter, see ``index``"""
+        return self.index[(element, param) if child is None else (element, param, child)]
+
+    def sync(self)->int:
+        """Copy the text of the bound elements into the template
+
+        Returns:
+            int: the number of values that changed
+        """
+        if self.sources is None:
+            return 0
+        parts = self.parts
+        changed = 0
+        for i, source in enumerate(self.sources, 1):
+            cdata = source.cdata
+            if parts[2*i-1] != cdata:
+                parts[2*i-1] = cdata
+                changed += 1
+        return changed
+
+    def refresh(self):
+        """Tokenise the bound rml file again, after a change of its structure"""
+        if self._rml is not None:
+            parts, index, sources = _tokenize_tree(self._rml)
+            self.parts, self.index, self.sources = parts, index, sources
+
+    def xml(self)->str:
+        """Return the text of the rml file"""
+        self.sync()
+        return ''.join(self.parts)
+
+    def write(self, filename:str):
+        """Write the rml file, patching only the values that changed"""
+        text = self.xml()
+        with open(filename, 'w') as f:
+            f.write(text)
+
+
+class CompactElement():
+    """Element of a :class:`CompactRML`
+
+    Provides the part of the interface of the raypyng xml elements used by
+    the simulation engines: ``children()``, ``name()``, ``original_name()``,
+    ``attributes()``, ``get_attribute(key)``, ``element[key]``, ``cdata`` and
+    access to the children by name (by ``id`` or ``name`` for the beamline and
+    the objects). The attribute values are sanitized like in raypyng.
+    """
+    __slots__ = ('_name', '_attributes', '_children', '_template', '_slot', '_name_attribute')
+
+    def __init__(self, name:str, attributes:dict, template:RMLTemplate, name_attribute:str=None):
+        self._name = name
+        self._attributes = attributes
+        self._children = []
+        self._template = template
+        self._slot = None
+        self._name_attribute = name_attribute
+
+    def children(self)->list:
+        return self._children
+
+    def name(self)->str:
+        return sanitizeName(self._name)
+
+    def original_name(self)->str:
+        return self._name
+
+    def attributes(self)->dict:
+        return self._attributes
+
+    def get_attribute(self, key:str):
+        value = self._attributes.get(key)
+        return sanitizeName(value) if value is not None else None
+
+    def __getitem__(self, key):
+        return self.get_attribute(key)
+
+    @property
+    def cdata(self)->str:
+        if self._slot is None:
+            return ''
+        text = self._template.get(self._slot).strip()
+        return unescape(text) if '&' in text else text
+
+    @cdata.setter
+    def cdata(self, value):
+        if self._slot is None:
+            raise AttributeError(f"The element <{self._name}> has no text")
+        self._template.set(self._slot, escape(str(value)))
+
+    def __getattr__(self, key):
+        if key.startswith('__') or key in CompactElement.__slots__:
+            raise AttributeError(key)
+        if self._name_attribute is not None:
+            matching = [c for c in self._children if c.get_attribute(self._name_attribute) == key]
+        else:
+            matching = [c for c in self._children if c.name() == key]
+        if not matching:
+            raise AttributeError(f"'{self._name}' has no attribute '{key}'")
+        return matching[0] if len(matching) == 1 else matching
+
+    def __repr__(self):
+        return f"CompactElement(name = {self._name}, attributes = {self._attributes}, cdata = {self.cdata})"
+
+
+# children of these elements are looked up by an attribute, like in raypyng
+_NAME_ATTRIBUTES = {'beamline': 'name', 'object': 'id'}
+
+
+class CompactRML(RMLTemplate):
+    """Lightweight rml file, loaded without building the raypyng tree
+
+    The text is tokenised once (see :class:`RMLTemplate`), and the elements
+    are :class:`CompactElement` objects whose ``cdata`` is stored in the
+    template, so modifying a parameter and writing the file only patches
+    its text. It can be used where the engines expect an ``RMLFile``,
+    see :func:`load_rml`.
+
+    Args:
+        filename (str): the rml file
+    """
+    __slots__ = ('filename', 'root', 'beamline')
+
+    def __init__(self, filename:str):
+        with open(filename) as f:
+            text = f.read()
+        super().__init__([], {})
+        self.filename = filename
+        self.root = _tokenize_text(text, self)
+        self.beamline = self.root.lab.beamline
+
+    @property
+    def template(self)->str:
+        return self.filename
+
+    def __repr__(self):
+        return f"CompactRML('{self.filename}')"
+
+
+def load_rml(filename:str)->CompactRML:
+    """Load an rml file as a :class:`CompactRML`"""
+    return CompactRML(filename)
+
+
+_templates = weakref.WeakKeyDictionary()
+_templates_lock = threading.Lock()
+
+
+def rml_template(rml)->RMLTemplate:
+    """Return the template of an rml file, created at the first call
+
+    Args:
+        rml (RMLFile or CompactRML): the rml file
+
+    Returns:
+        RMLTemplate: the template bound to the elements of ``rml``
+    """
+    if isinstance(rml, RMLTemplate):
+        return rml
+    with _templates_lock:
+        template = _templates.get(rml)
+        if template is None:
+            parts, index, sources = _tokenize_tree(rml)
+            template = RMLTemplate(parts, index, sources, rml)
+            _templates[rml] = template
+    return template
+
+
+def write_rml_file(rml, filename:str):
+    """Write ``rml`` into ``filename`` through its template, see :func:`rml_template`"""
+    if not isinstance(rml, RMLTemplate) and not hasattr(rml, '_root'):
+        # not a raypyng RMLFile
+        return rml.write(filename)
+    rml_template(rml).write(filename)
+
+
+def _tokenize_tree(rml):
+    # same text as raypyng.xmltools.serialize, with the leaf elements as slots
+    parts, sources, index = [''], [], {}
+    path = []
+
+    def static(text):
+        parts[-1] += text
+
+    def visit(element, indent):
+        static(indent+'<'+element.original_name())
+        if element.attributes():
+            static(' '+' '.join(k+'="'+v+'"' for k, v in element.attributes().original().items()))
+        static('>')
+        children = element.children()
+        if children:
+            static('\n')
+            path.append(element)
+            for child in children:
+                visit(child, indent+'    ')
+            path.pop()
+            static(indent+(element.cdata or ''))
+        else:
+            _add_slot(index, path, element, len(sources))
+            parts.append(element.cdata)
+            sources.append(element)
+            parts.append('')
+        static('</'+element.original_name()+'>\n')
+
+    root = rml._root
+    static('\n' if root.children() else '')
+    for child in root.children():
+        visit(child, '')
+    static(root.cdata or '')
+    parts[0] = parts[0].lstrip()
+    parts[-1] = parts[-1].rstrip()
+    return parts, index, sources
+
+
+def _tokenize_text(text:str, template:RMLTemplate)->CompactElement:
+    parts, index = template.parts, template.index
+    root = CompactElement(None, {}, template)
+    stack = [root]
+    opened = []
+    position = 0
+    parts.append('')
+    for match in _TAG.finditer(text):
+        tag = match.group()
+        if tag.startswith('<?') or tag.startswith('<!'):
+            continue
+        if tag.startswith('</'):
+            element = stack.pop()
+            start = opened.pop()
+            if not element._children:
+                # leaf element: its text becomes a slot
+                parts[-1] += text[position:start]
+                element._slot = len(parts)//2
+                _add_slot(index, stack, element, element._slot)
+                parts.append(text[start:match.start()])
+                parts.append('')
+                position = match.start()
+            continue
+        name = tag[1:-1].split(None, 1)[0].rstrip('/')
+        attributes = dict(_ATTRIBUTE.findall(tag))
+        element = CompactElement(name, attributes, template, _NAME_ATTRIBUTES.get(name))
+        stack[-1]._children.append(element)
+        if not tag.endswith('/>'):
+            stack.append(element)
+            opened.append(match.end())
+    parts[-1] += text[position:]
+    return root
+
+
+def _add_slot(index, path, element, slot):
+    # path: the ancestors of element
+    key = str(element.get_attribute('id') or element.name())
+    if path and path[-1].original_name() == 'object':
+        index[(str(path[-1].get_attribute('name')), key)] = slot
+    elif len(path) >= 2 and path[-2].original_name() == 'object':
+        param = path[-1]
+        index[(str(path[-2].get_attribute('name')), str(param.get_attribute('id') or param.name()), key)] = slot
@@ -0,0 +1,107 @@
+import hashlib
+import json
+
+
+def canonical_value(cdata:str)->str:
+    """Return a canonical string representation of a parameter value
+
+    Numbers are normalised, so that for instance ``2``, ``2.0`` and ``2e0``
+    are considered the same value.
+
+    Args:
+        cdata (str): the text of a ``<param>`` element
+
+    Returns:
+        str: the canonical representation of the value
+    """
+    cdata = (cdata or "").strip()
+    try:
+        return repr(float(cdata))
+    except ValueError:
+        return cdata
+
+
+def is_enabled(param)->bool:
+    """Check if a ``<param>`` of an rml file is enabled
+
+    Args:
+        param (ParamElement): the parameter to check
+
+    Returns:
+        bool: True if the parameter is enabled
+    """
+    enabled = param.get_attribute('enabled')
+    return enabled is None or str(enabled) == 'T'
+
+
+def param_value(param)->str:
+    """Return the canonical value of a ``<param>``, including its children
+
+    Vector parameters (e.g. ``worldPosition``) store their value in
+    ``<x>``, ``<y>``, ``<z>`` children, in this case the values are joined.
+
+    Args:
+        param (ParamElement): the parameter
+
+    Returns:
+        str: the canonical value
+    """
+    children = param.children()
+    if children:
+        return ",".join(c.name()+"="+canonical_value(c.cdata) for c in children)
+    return canonical_value(param.cdata)
+
+
+def element_parameters(oe)->list:
+    """Return the enabled parameters of an optical element
+
+    Args:
+        oe (ObjectElement): an ``<object>`` of the beamline
+
+    Returns:
+        list: list of ``(param id, canonical value)`` tuples
+    """
+    return [(str(param['id']), param_value(param)) for param in oe.children() if is_enabled(param)]
+
+
+def enabled_parameters(rml)->list:
+    """Return all the enabled parameters of an rml file, in beamline order
+
+    Args:
+        rml (RMLFile): the rml file
+
+    Returns:
+        list: list of ``(element name, element type, parameters)`` tuples,
+              where parameters is the output of :func:`element_parameters`
+    """
+    return [(str(oe['name']), str(oe['type']), element_parameters(oe)) for oe in rml.beamline.children()]
+
+
+def hash_parameters(*args)->str:
+    """Return a sha256 hex digest of a json-serializable description
+
+    Args:
+        *args: json-serializable objects to hash
+
+    Returns:
+        str: the hex digest
+    """
+    payload = json.dumps(args, separators=(',', ':'))
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def rml_key(rml, exports_list=(), export_format='RawRaysOutgoing')->str:
+    """Content-addressed key of a simulation
+
+    The key depends on every enabled parameter of the rml file, on the
+    list of the exported elements and on the exported format.
+
+    Args:
+        rml (RMLFile): the rml file
+        exports_list (list, optional): the exported elements. Defaults to ().
+        export_format (str, optional): the export format. Defaults to 'RawRaysOutgoing'.
+
+    Returns:
+        str: the key
+    """
+    return hash_parameters(enabled_parameters(rml), sorted(set(exports_list)), export_format)
@@ -0,0 +1,362 @@
+import time
+import heapq
+import logging
+import itertools
+import threading
+from contextlib import contextmanager
+from concurrent.futures import Future, InvalidStateError
+
+from bluesky.preprocessors import plan_mutator
+
+from .engine import SimulationEngineBase, submit_simulation, submit_batch, submit_energy_scan
+from .rml_model import load_rml
+
+logger = logging.getLogger(__name__)
+
+# the priority classes, from the most to the least urgent
+PRIORITY_CLASSES = ('interactive', 'batch')
+
+# the run submitting simulations from the current thread, see SchedulerPreprocessor
+_context = threading.local()
+
+
+def _check_priority(priority:str):
+    if priority not in PRIORITY_CLASSES:
+        raise ValueError(f"priority must be one of {PRIORITY_CLASSES}, not '{priority}'")
+
+
+class ScheduledRun():
+    """The run, and its priority class, of the simulations submitted by a RunEngine
+
+    Args:
+        priority (str): one of PRIORITY_CLASSES
+    """
+    def __init__(self, priority:str):
+        _check_priority(priority)
+        self.priority = priority
+        # known once the RunEngine opened the run
+        self.uid = None
+
+
+def current_run()->ScheduledRun:
+    """Return the run submitting simulations from this thread, None outside of a run"""
+    return getattr(_context, 'run', None)
+
+
+@contextmanager
+def scheduled_run(run:ScheduledRun):
+    """Submit the simulations of this thread for ``run``, e.g. in a thread started by the RunEngine"""
+    previous = current_run()
+    _context.run = run
+    try:
+        yield
+    finally:
+        _context.run = previous
+
+
+def _engine_slots(engine)->int:
+    # the workers of the pool or of the processes of the engine, or of an engine it wraps
+    while engine is not None:
+        pool = getattr(engine, 'pool', None)
+        if pool is not None:
+            return len(pool)
+        if getattr(engine, 'max_workers', None):
+            return engine.max_workers
+        engine = getattr(engine, 'engine', None)
+    return 1
+
+
+class _Job():
+    __slots__ = ('priority', 'run', 'work', 'future', 'submitted')
+
+    def __init__(self, priority, run, work):
+        self.priority = priority
+        self.run = run
+        self.work = work
+        self.future = Future()
+        self.submitted = time.time()
+
+
+class SimulationScheduler(SimulationEngineBase):
+    """Simulation engine queuing the simulations by priority class in front of another engine
+
+    The simulations are queued with the priority class of the run that
+    submits them (see :class:`SchedulerPreprocessor`): ``interactive``
+    simulations, e.g. the ``%ct`` of the magics, jump ahead of the queued
+    ``batch`` simulations, e.g. the prefetched points of a long scan.
+    ``max_running`` simulations run at the same time, and ``interactive_slots``
+    of them are kept for the interactive simulations, so that these never wait
+    for a slot taken by a batch simulation. Running simulations are not interrupted.
+
+    The rml file is saved when a simulation is submitted, and submitted to the
+    wrapped engine once the simulation leaves the queue (see :func:`submit_simulation`),
+    e.g. to the processes of a :class:`NumpySimulationEngine`. A simulation keeps
+    its slot until the future of the wrapped engine is done, and cancelling the
+    future returned by the scheduler cancels that one. Put the
+    scheduler right in front of the backend, inside the cache and the look-ahead
+    engine, so that the simulations served by those never wait in the queue.
+
+    Args:
+        engine: the simulation engine
+        max_running (int, optional): number of simulations running at the same time, if None
+                                     the number of workers of the engine. Defaults to None.
+        interactive_slots (int, optional): slots that batch simulations cannot use, at most
+                                           ``max_running-1``. Defaults to 1.
+    """
+    def __init__(self, engine, max_running:int=None, interactive_slots:int=1):
+        self.engine = engine
+        self.max_running = max_running if max_running is not None else _engine_slots(engine)
+        if self.max_running < 1:
+            raise ValueError(f"max_running must be at least 1, not {self.max_running}")
+        self.interactive_slots = max(0, min(interactive_slots, self.max_running-1))
+        self._condition = threading.Condition()
+        self._queue = []
+        self._count = itertools.count()
+        self._running = {priority: 0 for priority in PRIORITY_CLASSES}
+        self._stats = {priority: {'submitted': 0, 'done': 0, 'cancelled': 0, 'total_wait': 0., 'max_wait': 0.}
+                       for priority in PRIORITY_CLASSES}
+        self._stop = False
+        self._threads = [threading.Thread(target=self._worker_loop, daemon=True, name=f'scheduler-{i}')
+                         for i in range(self.max_running)]
+        for t in self._threads:
+            t.start()
+
+    def setup_simulation(self):
+        return self.engine.setup_simulation()
+
+    def submit(self, path, rml, exports_list):
+        """Queue a simulation of the current state of ``rml``
+
+        Returns:
+            Future: resolved once the results are exported in ``path``
+        """
+        rml_file = self.write_rml(path, rml)
+        return self._enqueue(lambda: submit_simulation(self.engine, path, load_rml(rml_file), list(exports_list)))
+
+    def submit_batch(self, path, rml, exports_list, batch:int):
+        """Like :meth:`submit`, see :func:`submit_batch`"""
+        rml_file = self.write_rml(path, rml)
+        return self._enqueue(lambda: submit_batch(self.engine, path, load_rml(rml_file), list(exports_list), batch))
+
+    def run(self, path, rml_file, exports_list):
+        return self._enqueue(lambda: submit_simulation(self.engine, path, load_rml(rml_file),
+                                                       list(exports_list))).result()
+
+    @property
+    def energy_scans(self)->bool:
+        """True if the wrapped engine simulates energy scans in a single pass"""
+        return getattr(self.engine, 'energy_scans', False)
+
+    def submit_energy_scan(self, paths, rml, exports_list, param, energies)->list:
+        """Queue all the points of an energy scan as one simulation, see :func:`submit_energy_scan`"""
+        from .detectors import source_element
+        rml_file = self.write_rml(paths[0], rml)
+
+        def work():
+            saved = load_rml(rml_file)
+            return _gather(submit_energy_scan(self.engine, list(paths), saved, list(exports_list),
+                                              source_element(saved).photonEnergy, list(energies)))
+        return [self._enqueue(work)]*len(paths)
+
+    def cancel(self, uid:str=None, priority:str=None)->int:
+        """Cancel the queued simulations of a run or of a priority class
+
+        Args:
+            uid (str, optional): the uid of the run, if None all the runs. Defaults to None.
+            priority (str, optional): the priority class, if None all of them. Defaults to None.
+
+        Returns:
+            int: the number of cancelled simulations
+        """
+        cancelled = 0
+        with self._condition:
+            kept = []
+            for entry in self._queue:
+                job = entry[-1]
+                if job.future.cancelled():
+                    # cancelled by the caller, e.g. the look-ahead engine
+                    self._stats[job.priority]['cancelled'] += 1
+                elif ((uid is None or (job.run is not None and job.run.uid == uid)) and
+                        (priority is None or job.priority == priority) and job.future.cancel()):
+                    self._stats[job.priority]['cancelled'] += 1
+                    cancelled += 1
+                else:
+                    kept.append(entry)
+            heapq.heapify(kept)
+            self._queue = kept
+            self._condition.notify_all()
+        return cancelled
+
+    def stats(self)->dict:
+        """Return, for each priority class, the queue depth and the wait in the queue
+
+        Returns:
+            dict: queued, running, submitted, done and cancelled simulations,
+                  mean and maximum wait in seconds, by priority class
+        """
+        with self._condition:
+            queued = {priority: 0 for priority in PRIORITY_CLASSES}
+            for entry in self._queue:
+                if not entry[-1].future.cancelled():
+                    queued[entry[-1].priority] += 1
+            stats = {}
+            for priority, s in self._stats.items():
+                started = s['done']+self._running[priority]
+                stats[priority] = {'queued': queued[priority],
+                                   'running': self._running[priority],
+                                   'submitted': s['submitted'],
+                                   'done': s['done'],
+                                   'cancelled': s['cancelled'],
+                                   'mean_wait': s['total_wait']/started if started else 0.,
+                                   'max_wait': s['max_wait']}
+        return stats
+
+    def shutdown(self):
+        """Cancel the queued simulations, stop the threads and shut the wrapped engine down"""
+        self.cancel()
+        with self._condition:
+            self._stop = True
+            self._condition.notify_all()
+        for t in self._threads:
+            t.join()
+        if hasattr(self.engine, 'shutdown'):
+            self.engine.shutdown()
+
+    def _enqueue(self, work)->Future:
+        run = current_run()
+        priority = run.priority if run is not None else 'batch'
+        job = _Job(priority, run, work)
+        with self._condition:
+            if self._stop:
+                raise RuntimeError("The scheduler has been shut down")
+            heapq.heappush(self._queue, (PRIORITY_CLASSES.index(priority), next(self._count), job))
+            self._stats[priority]['submitted'] += 1
+            self._condition.notify()
+        return job.future
+
+    def _next_job(self):
+        while self._queue:
+            job = self._queue[0][-1]
+            if job.future.cancelled():
+                # cancelled by the caller, e.g. the look-ahead engine
+                heapq.heappop(self._queue)
+                self._stats[job.priority]['cancelled'] += 1
+                continue
+            if sum(self._running.values()) >= self.max_running:
+                return None
+            if job.priority != 'interactive' and self._running[job.priority] >= self.max_running-self.interactive_slots:
+                return None
+            heapq.heappop(self._queue)
+            return job
+        return None
+
+    def _worker_loop(self):
+        while True:
+            with self._condition:
+                job = self._next_job()
+                while job is None:
+                    if self._stop:
+                        return
+                    self._condition.wait()
+                    job = self._next_job()
+                if job.future.cancelled():
+                    self._stats[job.priority]['cancelled'] += 1
+                    continue
+                self._running[job.priority] += 1
+                wait = time.time()-job.submitted
+                self._stats[job.priority]['total_wait'] += wait
+                self._stats[job.priority]['max_wait'] = max(self._stats[job.priority]['max_wait'], wait)
+            # the thread only submits the job, the slot is released once the simulation is done
+            try:
+                future = job.work()
+            except Exception as e:
+                future = Future()
+                future.set_exception(e)
+            job.future.add_done_callback(lambda f, future=future: future.cancel() if f.cancelled() else None)
+            future.add_done_callback(lambda future, job=job: self._job_done(job, future))
+
+    def _job_done(self, job, future):
+        if future.cancelled():
+            job.future.cancel()
+        elif not job.future.cancelled():
+            try:
+                if future.exception() is not None:
+                    job.future.set_exception(future.exception())
+                else:
+                    job.future.set_result(future.result())
+            except InvalidStateError:
+                # cancelled by another thread in the meantime
+                pass
+        with self._condition:
+            self._running[job.priority] -= 1
+            self._stats[job.priority]['done'] += 1
+            self._condition.notify_all()
+
+
+def _gather(futures)->Future:
+    # a future resolved once all the futures are done, with the first exception if any
+    gathered = Future()
+    pending = set(futures)
+    lock = threading.Lock()
+
+    def done(future):
+        with lock:
+            pending.discard(future)
+            if pending or gathered.done():
+                return
+        errors = [f.exception() for f in futures if not f.cancelled() and f.exception() is not None]
+        try:
+            if any(f.cancelled() for f in futures):
+                gathered.cancel()
+            elif errors:
+                gathered.set_exception(errors[0])
+            else:
+                gathered.set_result(None)
+        except InvalidStateError:
+            pass
+    gathered.add_done_callback(lambda g: [f.cancel() for f in futures] if g.cancelled() else None)
+    for future in set(futures):
+        future.add_done_callback(done)
+    return gathered
+
+
+class SchedulerPreprocessor():
+    """RunEngine preprocessor giving a priority class to the simulations of its runs
+
+    The simulations submitted during a plan are queued by the :class:`SimulationScheduler`
+    with ``priority``, and can be cancelled with the uid of their run. The run is
+    known to the thread of the RunEngine, and to the simulation thread of the
+    :class:`TwinTriggerDetector`: each RunEngine must run its plans in its own
+    event loop. The run starts with the plan, and after each ``close_run``, so that
+    the points prefetched by the look-ahead when the run is opened already belong
+    to it: it must come after the supplemental data of the twin, that reads the
+    frame of the plan, :meth:`TwinOphydDevices.attach` appends it after it.
+
+    Args:
+        priority (str, optional): one of PRIORITY_CLASSES. Defaults to 'batch'.
+    """
+    def __init__(self, priority:str='batch'):
+        _check_priority(priority)
+        self.priority = priority
+
+    def __call__(self, plan):
+        def tag(msg):
+            if msg.command == 'open_run':
+                def opened():
+                    run = current_run()
+                    run.uid = yield msg
+                    return run.uid
+                return opened(), None
+            if msg.command == 'close_run':
+                def closed():
+                    ret = yield msg
+                    _context.run = ScheduledRun(self.priority)
+                    return ret
+                return closed(), None
+            return None, None
+
+        _context.run = ScheduledRun(self.priority)
+        try:
+            return (yield from plan_mutator(plan, tag))
+        finally:
+            _context.run = None
@@ -0,0 +1,81 @@
+import secrets
+import logging
+
+from bluesky.preprocessors import plan_mutator
+
+from .engine import seed_simulations
+
+logger = logging.getLogger(__name__)
+
+# key of the seed in the metadata of the start document
+SEED_KEY = 'twin_seed'
+
+
+def new_seed()->int:
+    """Draw a random seed for a run"""
+    return secrets.randbits(32)
+
+
+class CommonRandomNumbersPreprocessor():
+    """RunEngine preprocessor tracing all the points of a run with the same random rays
+
+    With common random numbers the engines of the twin are seeded for the
+    whole run (see :func:`seed_simulations`), so the source draws the same
+    rays at every point: the differences between two points come from the
+    parameters that changed, not from the Monte Carlo noise, and a smooth
+    scan needs much fewer rays. The :class:`NumpySimulationEngine` also
+    generates the source bundle once and takes it from its bundle cache at
+    the following points.
+
+    The seed is recorded in the start document as ``twin_seed``. With
+    ``seed=None`` each run draws a new seed, pass the ``twin_seed`` of a run
+    as ``seed`` to trace it again with the same rays. The seed is set when
+    the plan starts and after each ``close_run``, so that the points
+    prefetched by the look-ahead when the run is opened use it, and the
+    previous seeds are restored when the plan ends. RAY-UI cannot be seeded:
+    the runs then keep fresh random rays and no seed is recorded.
+
+    Args:
+        trigger_detector (TwinTriggerDetector): the trigger detector of the twin
+        seed (int, optional): the seed of every run, if None a new seed is drawn for each run.
+                              Defaults to None.
+    """
+    def __init__(self, trigger_detector, seed:int=None):
+        self.trigger_detector = trigger_detector
+        self.seed = seed
+        self._warned = False
+
+    def __call__(self, plan):
+        state = {'seed': None, 'previous': None}
+
+        def seed_run():
+            seed = self.seed if self.seed is not None else new_seed()
+            seeded = seed_simulations(self.trigger_detector.simulation_engine, seed)
+            if state['previous'] is None:
+                state['previous'] = seeded
+            state['seed'] = seed if seeded else None
+            if not seeded and not self._warned:
+                self._warned = True
+                logger.warning("No simulation engine of the twin can be seeded, "
+                               "the points of the run use fresh random rays")
+
+        def record_seed(msg):
+            if msg.command == 'open_run' and state['seed'] is not None and msg.kwargs.get(SEED_KEY) != state['seed']:
+                # plan_mutator processes the new message too
+                def opened():
+                    return (yield msg._replace(kwargs={**msg.kwargs, SEED_KEY: state['seed']}))
+                return opened(), None
+            if msg.command == 'close_run':
+                def closed():
+                    ret = yield msg
+                    seed_run()
+                    return ret
+                return closed(), None
+            return None, None
+
+        seed_run()
+        try:
+            return (yield from plan_mutator(plan, record_seed))
+        finally:
+            for engine, seed in state['previous'] or ():
+                engine.seed = seed
@@ -0,0 +1,197 @@
+import logging
+import warnings
+
+import numpy as np
+from ophyd import Signal
+from bluesky import Msg
+
+from .rml_utils import rml_key
+from .engine import submit_simulation
+from .detectors import source_flux
+from .batch import BatchEvaluator
+
+logger = logging.getLogger(__name__)
+
+# name of the event stream with the derivatives of the signals
+SENSITIVITY_STREAM = 'sensitivity'
+
+
+def sensitivity_configurations(n_params:int, central:bool=True)->list:
+    """List the configurations needed by the finite differences
+
+    Args:
+        n_params (int): number of parameters
+        central (bool, optional): central differences if True, otherwise forward. Defaults to True.
+
+    Returns:
+        list: (index of the moved parameter, sign of the step), ``(None, 0)`` for the
+              configuration with no parameter moved
+    """
+    configurations = [(None, 0)]
+    for i in range(n_params):
+        configurations.append((i, 1))
+        if central:
+            configurations.append((i, -1))
+    return configurations
+
+
+def configuration_positions(positions, steps, configurations)->list:
+    """Return the position of the motors in each configuration
+
+    Args:
+        positions (list): the current position of each motor
+        steps (list): the step of each motor
+        configurations (list): see :func:`sensitivity_configurations`
+
+    Returns:
+        list: for each configuration the position of each motor, see :meth:`BatchEvaluator.submit`
+    """
+    result = []
+    for index, sign in configurations:
+        position = [float(p) for p in positions]
+        if index is not None:
+            position[index] += sign*steps[index]
+        result.append(position)
+    return result
+
+
+def submit_configurations(engine, rml, params, steps, configurations, exports_list, folders)->list:
+    """Submit the simulations of all the configurations at once
+
+    .. deprecated::
+        :func:`sensitivity_scan` submits the configurations with a
+        :class:`BatchEvaluator`, use :func:`configuration_positions` and
+        :meth:`BatchEvaluator.submit` instead.
+
+    The rml file is modified to compute each configuration and restored
+    before returning. Configurations with the same simulation key (e.g. a
+    zero step) share one simulation.
+
+    Args:
+        engine: the simulation engine, it should implement ``submit`` to run in parallel
+        rml (RMLFile): the rml file
+        params (list): the rml parameters, see :func:`rml_parameter`
+        steps (list): the step of each parameter
+        configurations (list): see :func:`sensitivity_configurations`
+        exports_list (list): list of the exported objects
+        folders (list): the simulation folder of each configuration
+
+    Returns:
+        list: for each configuration (future, folder, source), see :func:`source_flux`.
+              Configurations sharing a simulation share the same future and folder.
+    """
+    warnings.warn("submit_configurations is deprecated, use configuration_positions "
+                  "and BatchEvaluator.submit instead", DeprecationWarning, stacklevel=2)
+    saved = [param.cdata for param in params]
+    submitted = {}
+    jobs = []
+    try:
+        for position, folder in zip(configuration_positions(saved, steps, configurations), folders):
+            for param, value in zip(params, position):
+                param.cdata = str(value)
+            key = rml_key(rml, exports_list)
+            if key not in submitted:
+                submitted[key] = (submit_simulation(engine, folder, rml, exports_list), folder, source_flux(rml))
+            jobs.append(submitted[key])
+    finally:
+        for param, value in zip(params, saved):
+            param.cdata = value
+    return jobs
+
+
+def finite_differences(values, configurations, steps)->np.ndarray:
+    """Compute the sensitivity matrix
+
+    Args:
+        values (array): the value of each signal (columns) for each configuration (rows)
+        configurations (list): see :func:`sensitivity_configurations`
+        steps (list): the step of each parameter
+
+    Returns:
+        np.ndarray: the derivative of each signal (rows) with respect to each parameter (columns)
+    """
+    values = np.asarray(values, dtype=float)
+    rows = {configuration: i for i, configuration in enumerate(configurations)}
+    matrix = np.zeros((values.shape[1], len(steps)))
+    for i, step in enumerate(steps):
+        if (i, -1) in rows:
+            matrix[:, i] = (values[rows[(i, 1)]]-values[rows[(i, -1)]])/(2*step)
+        else:
+            matrix[:, i] = (values[rows[(i, 1)]]-values[rows[(None, 0)]])/step
+    return matrix
+
+
+def sensitivity_scan(detectors, motors, steps, *, twin, central:bool=True, md:dict=None):
+    """Compute the derivatives of the detector signals with respect to the motors of the twin
+
+    All the configurations (the current position, and each motor moved by
+    ``+step`` and, with ``central``, by ``-step``) are submitted to the engine of
+    the twin at once by a :class:`BatchEvaluator`, so they are simulated in
+    parallel, and the motors are never moved. The result is a single run with two streams:
+
+    * ``primary``: one event per configuration, with the moved motor
+      (``sensitivity_motor``, empty for the current position), its offset
+      (``sensitivity_offset``) and the value of each signal
+    * ``sensitivity``: one event per motor with the derivative of each
+      signal, in the fields ``d_<signal>``
+
+    Args:
+        detectors (list): signals or devices of the twin detectors, e.g. ``[rp_DetectorAtFocus]``
+        motors (list): raypyng motors, e.g. ``[rp_M1.rx, rp_M1.ry, rp_KB1.tx]``
+        steps (float or list): the step of the finite differences, for all or for each motor
+        twin (TwinOphydDevices): the digital twin
+        central (bool, optional): central differences (2 simulations per motor) if True,
+                                  otherwise forward differences (1 per motor). Defaults to True.
+        md (dict, optional): metadata. Defaults to None.
+
+    Returns:
+        dict: the sensitivity matrix (signals x motors), and the names of the signals and motors
+    """
+    evaluator = BatchEvaluator(twin, motors, detectors, folder_name='sensitivity')
+    steps = list(np.broadcast_to(np.asarray(steps, dtype=float), (len(motors),)))
+    configurations = sensitivity_configurations(len(motors), central)
+    signal_names = [signal.name for signal in evaluator.signals]
+    motor_names = [motor.name for motor in motors]
+    _md = {'detectors': [det.name for det in detectors],
+           'motors': motor_names,
+           'num_points': len(configurations),
+           'num_intervals': len(configurations)-1,
+           'plan_args': {'detectors': list(map(repr, detectors)), 'motors': list(map(repr, motors)),
+                         'steps': [float(s) for s in steps], 'central': central},
+           'plan_name': 'sensitivity_scan',
+           'hints': {'dimensions': [(['sensitivity_offset'], 'primary')]}}
+    _md.update(md or {})
+
+    moved = Signal(name='sensitivity_motor', value='')
+    offset = Signal(name='sensitivity_offset', value=0.)
+    values = [Signal(name=name, value=0.) for name in signal_names]
+    derivatives = [Signal(name='d_'+name, value=0.) for name in signal_names]
+
+    jobs = []
+    try:
+        jobs = evaluator.submit(configuration_positions(evaluator.positions(), steps, configurations))
+        yield Msg('open_run', **_md)
+        yield from evaluator.wait(jobs)
+        results = evaluator.values(jobs)
+        for (index, sign), result in zip(configurations, results):
+            moved.put(motor_names[index] if index is not None else '')
+            offset.put(sign*steps[index] if index is not None else 0.)
+            for signal, value in zip(values, result):
+                signal.put(value)
+            yield Msg('create', name='primary')
+            for obj in [moved, offset]+values:
+                yield Msg('read', obj)
+            yield Msg('save')
+        matrix = finite_differences(results, configurations, steps)
+        for i, name in enumerate(motor_names):
+            moved.put(name)
+            for signal, value in zip(derivatives, matrix[:, i]):
+                signal.put(value)
+            yield Msg('create', name=SENSITIVITY_STREAM)
+            for obj in [moved]+derivatives:
+                yield Msg('read', obj)
+            yield Msg('save')
+        yield Msg('close_run')
+    finally:
+        evaluator.release(jobs)
+    return {'matrix': matrix, 'signals': signal_names, 'motors': motor_names}
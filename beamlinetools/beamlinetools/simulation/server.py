@@ -0,0 +1,299 @@
+import os
+import hmac
+import json
+import asyncio
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from .cache import exported_files
+from .engine import submit_simulation
+from .rml_model import load_rml
+from .workspace import ScratchWorkspace
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 12345
+
+
+async def read_message(reader:asyncio.StreamReader):
+    """Read a message: a line of json, followed by ``size`` bytes of payload
+
+    Args:
+        reader (asyncio.StreamReader): the stream
+
+    Returns:
+        tuple: the header (dict) and the payload (bytes), None at the end of the stream
+    """
+    line = await reader.readline()
+    if not line:
+        return None
+    header = json.loads(line)
+    payload = await reader.readexactly(header.get('size', 0))
+    return header, payload
+
+
+def encode_message(header:dict, payload:bytes=b'')->bytes:
+    """Encode a message, see :func:`read_message`"""
+    return json.dumps({**header, 'size': len(payload)}).encode()+b'\n'+payload
+
+
+def pack_files(folder:str, names)->tuple:
+    """Concatenate some files of ``folder``
+
+    Returns:
+        tuple: list of (name, size) and the content of the files
+    """
+    files, chunks = [], []
+    for name in names:
+        with open(os.path.join(folder, name), 'rb') as f:
+            chunks.append(f.read())
+        files.append((name, len(chunks[-1])))
+    return files, b''.join(chunks)
+
+
+def patch_rml(parts:list, delta)->str:
+    """Return the text of an rml file from the parts of its template and the values that changed
+
+    Args:
+        parts (list): the parts of an :class:`RMLTemplate`
+        delta (list): list of (slot, value)
+
+    Returns:
+        str: the text of the rml file
+    """
+    parts = list(parts)
+    for slot, value in delta:
+        parts[2*slot+1] = value
+    return ''.join(parts)
+
+
+def unpack_files(folder:str, files, payload:bytes):
+    """Write into ``folder`` the files packed with :func:`pack_files`
+
+    The names come from the other end of the connection: names that are
+    not plain file names (absolute, with a directory or ``..``) are rejected,
+    so that no file is written outside of ``folder``.
+
+    Raises:
+        ValueError: if a name is not a plain file name
+    """
+    for name, size in files:
+        if not name or name != os.path.basename(name) or name in (os.curdir, os.pardir) or os.path.isabs(name):
+            raise ValueError(f"Invalid file name {name!r}")
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    start = 0
+    for name, size in files:
+        with open(os.path.join(folder, name), 'wb') as f:
+            f.write(payload[start:start+size])
+        start += size
+
+
+class SimulationServer():
+    """Asyncio server running the simulations of many clients on one engine
+
+    The clients (see :class:`SimulationClient`) send batches of jobs, each
+    one an rml file and its exported elements, in a single message. The jobs
+    of all the clients go into one queue, and up to ``max_jobs`` of them are
+    given to the engine at the same time. The exported files of each job are
+    sent back to its client as soon as it is done.
+
+    Messages are a line of json followed by a binary payload of ``size`` bytes:
+
+    * client: ``{"type": "submit", "jobs": [{"id", "exports", "rml_size"}, ...]}``, payload the rml files
+    * client: ``{"type": "cancel", "ids": [...]}``, removes jobs that did not start yet
+    * server: ``{"type": "result", "id", "files": [[name, size], ...]}``, payload the files
+    * server: ``{"type": "error", "id", "error"}``
+
+    The workers of a :class:`SimulationDispatcher` are servers too, with some more messages:
+
+    * client: ``{"type": "hello", "heartbeat", "token"}``, the server answers
+      ``{"type": "hello", "slots"}`` and sends ``{"type": "heartbeat", "queued", "running"}``
+      every ``heartbeat`` seconds
+    * client: ``{"type": "base", "id"}``, payload the json list of the parts of an
+      :class:`RMLTemplate`, the base of the next jobs
+    * client: ``{"type": "submit", "jobs": [{"id", "exports", "base", "delta"}, ...]}``,
+      the rml files are the base with the (slot, value) of ``delta``, see :func:`patch_rml`
+
+    The protocol is not encrypted. With ``token`` the first message of a client
+    must be a ``hello`` with the same token, otherwise the server answers
+    ``{"type": "error", "id": null, "error"}`` and closes the connection. Listen on
+    other interfaces than the loopback only on a trusted network, and with a token.
+
+    Args:
+        engine: the simulation engine, e.g. a :class:`NumpySimulationEngine` with
+                ``max_workers>1``, a :class:`PooledSimulationEngine` or a :class:`FakeSimulationEngine`
+        host (str, optional): the address to listen on. Defaults to '127.0.0.1'.
+        port (int, optional): the port to listen on. Defaults to 12345.
+        max_jobs (int, optional): maximum number of jobs given to the engine at the same time.
+                                  Defaults to 4.
+        work_folder (str, optional): folder where the :class:`ScratchWorkspace` of the simulations
+                                     is created, if None on tmpfs. Each job runs in a reused worker
+                                     folder of the workspace. Defaults to None.
+        token (str, optional): the secret shared with the clients, if None the clients
+                               are not authenticated. Defaults to None.
+    """
+    # number of bases kept for each client
+    max_bases = 4
+
+    def __init__(self, engine, host:str='127.0.0.1', port:int=DEFAULT_PORT, max_jobs:int=4, work_folder:str=None,
+                 token:str=None):
+        self.engine = engine
+        self.host = host
+        self.port = port
+        self.max_jobs = max_jobs
+        self.work_folder = work_folder
+        self.token = token
+        self.jobs_done = 0
+        self.jobs_failed = 0
+        self.jobs_cancelled = 0
+        self.jobs_running = 0
+        self._server = None
+        self._queue = None
+        self._cancelled = set()
+        self.workspace = None
+        self._executor = ThreadPoolExecutor(max_jobs, thread_name_prefix='simulation-server')
+
+    async def start(self):
+        """Start listening, the port is updated if it was 0"""
+        self.workspace = ScratchWorkspace(self.work_folder)
+        self._queue = asyncio.Queue()
+        self._workers = [asyncio.ensure_future(self._worker()) for _ in range(self.max_jobs)]
+        self._server = await asyncio.start_server(self._handle_client, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"Simulation server listening on {self.host}:{self.port}")
+
+    async def serve(self):
+        """Start the server and serve until cancelled"""
+        await self.start()
+        try:
+            await self._server.serve_forever()
+        finally:
+            await self.stop()
+
+    async def stop(self):
+        """Stop the server and its workers"""
+        self._server.close()
+        for worker in self._workers:
+            worker.cancel()
+        self._executor.shutdown(wait=False)
+        self.workspace.close()
+
+    def run(self):
+        """Serve forever, blocking"""
+        asyncio.run(self.serve())
+
+    def stats(self)->dict:
+        """Return the number of jobs done, failed, cancelled and queued
+
+        Returns:
+            dict: the statistics of the server
+        """
+        return {'done': self.jobs_done,
+                'failed': self.jobs_failed,
+                'cancelled': self.jobs_cancelled,
+                'queued': self._queue.qsize() if self._queue is not None else 0}
+
+    async def _handle_client(self, reader, writer):
+        client = {'writer': writer, 'lock': asyncio.Lock(), 'closed': False, 'bases': OrderedDict()}
+        peer = writer.get_extra_info('peername')
+        logger.debug(f"Client connected: {peer}")
+        heartbeat = None
+        authenticated = self.token is None
+        try:
+            while True:
+                message = await read_message(reader)
+                if message is None:
+                    break
+                header, payload = message
+                if not authenticated:
+                    token = header.get('token') if header.get('type') == 'hello' else None
+                    if not isinstance(token, str) or not hmac.compare_digest(token.encode(), self.token.encode()):
+                        logger.warning(f"Client {peer} not authenticated, closing the connection")
+                        await self._send(client, encode_message({'type': 'error', 'id': None,
+                                                                 'error': "Authentication failed"}))
+                        break
+                    authenticated = True
+                if header['type'] == 'submit':
+                    start = 0
+                    for job in header['jobs']:
+                        if 'base' in job:
+                            base = client['bases'].get(job['base'])
+                            if base is None:
+                                await self._send(client, encode_message(
+                                    {'type': 'error', 'id': job['id'], 'error': f"Unknown base {job['base']}"}))
+                                continue
+                            rml = patch_rml(base, job['delta']).encode()
+                        else:
+                            rml = payload[start:start+job['rml_size']]
+                            start += job['rml_size']
+                        self._queue.put_nowait((client, job['id'], rml, job['exports']))
+                elif header['type'] == 'cancel':
+                    self._cancelled.update((id(client), job_id) for job_id in header['ids'])
+                elif header['type'] == 'base':
+                    client['bases'][header['id']] = json.loads(payload)
+                    while len(client['bases']) > self.max_bases:
+                        client['bases'].popitem(last=False)
+                elif header['type'] == 'hello':
+                    await self._send(client, encode_message({'type': 'hello', 'slots': self.max_jobs}))
+                    if header.get('heartbeat') and heartbeat is None:
+                        heartbeat = asyncio.ensure_future(self._heartbeat(client, header['heartbeat']))
+                else:
+                    logger.warning(f"Unknown message from {peer}: {header['type']}")
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            logger.debug(f"Connection with {peer} lost: {e}")
+        finally:
+            client['closed'] = True
+            if heartbeat is not None:
+                heartbeat.cancel()
+            self._cancelled = {job for job in self._cancelled if job[0] != id(client)}
+            writer.close()
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            client, job_id, rml, exports = await self._queue.get()
+            if client['closed'] or (id(client), job_id) in self._cancelled:
+                self._cancelled.discard((id(client), job_id))
+                self.jobs_cancelled += 1
+                continue
+            folder = self.workspace.acquire()
+            self.jobs_running += 1
+            try:
+                files, payload = await loop.run_in_executor(self._executor, self._simulate, folder, rml, exports)
+                message = encode_message({'type': 'result', 'id': job_id, 'files': files}, payload)
+                self.jobs_done += 1
+            except Exception as e:
+                logger.exception(f"Simulation {job_id} failed")
+                message = encode_message({'type': 'error', 'id': job_id, 'error': repr(e)})
+                self.jobs_failed += 1
+            finally:
+                self.jobs_running -= 1
+                self.workspace.release(folder)
+            await self._send(client, message)
+
+    async def _send(self, client, message:bytes):
+        if client['closed']:
+            return
+        async with client['lock']:
+            try:
+                client['writer'].write(message)
+                await client['writer'].drain()
+            except ConnectionError:
+                client['closed'] = True
+
+    async def _heartbeat(self, client, interval:float):
+        # sent by the event loop, also while the simulations keep the workers busy
+        while not client['closed']:
+            await self._send(client, encode_message({'type': 'heartbeat', 'queued': self._queue.qsize(),
+                                                     'running': self.jobs_running}))
+            await asyncio.sleep(interval)
+
+    def _simulate(self, folder, rml, exports):
+        rml_file = os.path.join(folder, 'client.rml')
+        with open(rml_file, 'wb') as f:
+            f.write(rml)
+        submit_simulation(self.engine, folder, load_rml(rml_file), exports).result()
+        return pack_files(folder, exported_files(folder, exports))
+
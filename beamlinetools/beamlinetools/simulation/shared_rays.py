@@ -0,0 +1,382 @@
+import os
+import json
+import atexit
+import secrets
+import logging
+import threading
+from multiprocessing import shared_memory
+
+import numpy as np
+from bluesky.preprocessors import plan_mutator
+
+from .rays import RayFileWriter, ray_file
+
+logger = logging.getLogger(__name__)
+
+
+def shared_ray_file(path:str, element:str, export_format='RawRaysOutgoing')->str:
+    """Return the name of the file describing the shared memory rays of an exported element
+
+    Args:
+        path (str): the simulation folder
+        element (str): the exported element
+        export_format (str, optional): the exported format. Defaults to 'RawRaysOutgoing'.
+
+    Returns:
+        str: ``<path>/<element>-<export_format>.shm.json``
+    """
+    return os.path.join(path, f"{element}-{export_format}.shm.json")
+
+
+def _attach(name:str)->shared_memory.SharedMemory:
+    return shared_memory.SharedMemory(name=name)
+
+
+def new_segment_prefix()->str:
+    """Return a new prefix for the names of the segments of a simulation, see :class:`SharedRayWriter`"""
+    return 'bt_'+secrets.token_hex(6)
+
+
+def unlink_segments(prefix:str)->int:
+    """Remove the segments whose name starts with ``prefix``, e.g. those of a terminated worker
+
+    The segments are listed in ``/dev/shm``. Where it does not exist the
+    segments are removed by the resource tracker when the process exits.
+
+    Returns:
+        int: the number of removed segments
+    """
+    if not os.path.isdir('/dev/shm'):
+        return 0
+    removed = 0
+    for name in os.listdir('/dev/shm'):
+        if not name.startswith(prefix):
+            continue
+        try:
+            shm = _attach(name)
+        except FileNotFoundError:
+            continue
+        try:
+            shm.unlink()
+            removed += 1
+        except FileNotFoundError:
+            pass
+        _close(shm)
+    return removed
+
+
+def _close(shm:shared_memory.SharedMemory):
+    try:
+        shm.close()
+    except BufferError:
+        # arrays still use the memory, it is unmapped when they are garbage collected
+        pass
+
+
+class SharedRayWriter():
+    """Write rays, batch by batch, into a named shared memory segment
+
+    Same interface as :class:`RayFileWriter`. The columns are contiguous in
+    the segment (column ``i`` starts at ``8*i*capacity``), so a
+    :class:`SharedRayTable` maps each of them without copying. When the writer is
+    closed, a small json file (see :func:`shared_ray_file`) describes the
+    segment. The segment is then owned by the process reading the rays, see
+    :class:`SharedBundleRegistry`: the writer only closes its own mapping.
+
+    The segments stay registered with the resource tracker, shared by the
+    processes of a :class:`NumpySimulationEngine` and the process that started
+    them, until the reading process removes them. The names start with
+    ``prefix``, chosen by the reading process, so that it can remove the
+    segments of a worker terminated before its simulation was done, see
+    :func:`unlink_segments`.
+
+    Args:
+        filename (str): the json file describing the segment
+        columns (list): the names of the columns
+        capacity (int): number of rays the segment is created for, it grows if needed
+        prefix (str, optional): the prefix of the names of the segments, if None a new one.
+                                Defaults to None.
+    """
+    def __init__(self, filename:str, columns, capacity:int, prefix:str=None):
+        self.filename = filename
+        self.prefix = prefix if prefix is not None else new_segment_prefix()
+        self.columns = list(columns)
+        self.nrays = 0
+        self.capacity = max(1, int(capacity))
+        self.shm = self._create(self.capacity)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    @property
+    def name(self)->str:
+        return self.shm.name
+
+    def _create(self, capacity):
+        return shared_memory.SharedMemory(name=f"{self.prefix}_{secrets.token_hex(4)}", create=True,
+                                          size=8*len(self.columns)*capacity)
+
+    def _column(self, shm, i, capacity, n)->np.ndarray:
+        return np.ndarray((n,), dtype='<f8', buffer=shm.buf, offset=8*i*capacity)
+
+    def write(self, table):
+        """Append rays
+
+        Args:
+            table (np.ndarray): array of shape (number of rays, number of columns)
+        """
+        table = np.asarray(table, dtype='<f8')
+        n = table.shape[0]
+        if self.nrays+n > self.capacity:
+            self._grow(max(2*self.capacity, self.nrays+n))
+        for i in range(len(self.columns)):
+            self._column(self.shm, i, self.capacity, self.nrays+n)[self.nrays:] = table[:, i]
+        self.nrays += n
+
+    def _grow(self, capacity):
+        shm = self._create(capacity)
+        for i in range(len(self.columns)):
+            self._column(shm, i, capacity, self.nrays)[:] = self._column(self.shm, i, self.capacity, self.nrays)
+        self.shm.close()
+        self.shm.unlink()
+        self.shm, self.capacity = shm, capacity
+
+    def descriptor(self)->dict:
+        """Return the description of the segment written into the json file"""
+        return {'name': self.shm.name, 'columns': self.columns, 'nrays': self.nrays, 'capacity': self.capacity}
+
+    def table(self)->'SharedRayTable':
+        """Return the rays written so far, without copying them"""
+        return SharedRayTable(self.descriptor(), self.shm)
+
+    def close(self):
+        """Write the json file describing the segment"""
+        with open(self.filename+'.tmp', 'w') as f:
+            json.dump(self.descriptor(), f)
+        os.replace(self.filename+'.tmp', self.filename)
+
+    def release(self):
+        """Close the mapping of this process, the segment is kept"""
+        _close(self.shm)
+
+    def abort(self):
+        """Remove the segment"""
+        _close(self.shm)
+        self.shm.unlink()
+
+
+class SharedRayTable():
+    """Read-only view of rays in a shared memory segment
+
+    Same interface as :class:`RayTable`: ``table['OX']`` returns one column,
+    mapped without copying.
+
+    Args:
+        descriptor (dict): see :meth:`SharedRayWriter.descriptor`
+        shm (SharedMemory): the segment
+    """
+    def __init__(self, descriptor:dict, shm:shared_memory.SharedMemory):
+        self.name = descriptor['name']
+        self.columns = tuple(descriptor['columns'])
+        self.nrays = descriptor['nrays']
+        self._capacity = descriptor['capacity']
+        self._index = {c: i for i, c in enumerate(self.columns)}
+        self._shm = shm
+
+    def __len__(self):
+        return self.nrays
+
+    def __contains__(self, column):
+        return column in self._index
+
+    def __getitem__(self, column:str)->np.ndarray:
+        array = np.ndarray((self.nrays,), dtype='<f8', buffer=self._shm.buf,
+                           offset=8*self._index[column]*self._capacity)
+        array.flags.writeable = False
+        return array
+
+    def chunks(self, columns, chunk_size:int):
+        """Read some columns, ``chunk_size`` rays at a time, see :meth:`RayTable.chunks`"""
+        arrays = {c: self[c] for c in columns}
+        for start in range(0, self.nrays, chunk_size):
+            yield {c: a[start:start+chunk_size] for c, a in arrays.items()}
+
+
+def write_shared_rays(filename:str, table)->str:
+    """Copy a ray table into a columnar ``.npy`` file, see :class:`RayFileWriter`"""
+    with RayFileWriter(filename, table.columns) as writer:
+        for chunk in table.chunks(table.columns, 1000000):
+            writer.write(np.column_stack([chunk[c] for c in table.columns]))
+    return filename
+
+
+class SharedBundleRegistry():
+    """Reference counts of the ray bundles in shared memory, in the process reading them
+
+    A bundle has one reference from the simulation that produced it, taken
+    by :meth:`publish`, and one for each :meth:`attach` by the detectors. When
+    a point ends (:meth:`end_point`) the references of the bundles read during
+    the point are released, and the segments left without references are
+    removed. The bundles published but never read are removed at the end of the run
+    (:meth:`end_run`), see :class:`SharedRaysPreprocessor`.
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._bundles = {}
+        self._attached = []
+
+    def __len__(self):
+        return len(self._bundles)
+
+    def publish(self, names):
+        """Take the reference of the simulations that produced the bundles ``names``"""
+        with self._lock:
+            for name in names:
+                if name in self._bundles:
+                    continue
+                try:
+                    self._bundles[name] = {'shm': _attach(name), 'refs': 1, 'table': None}
+                except FileNotFoundError:
+                    logger.warning(f"The shared ray bundle {name} does not exist")
+
+    def attach(self, descriptor:dict)->SharedRayTable:
+        """Return the rays of a bundle, with a reference released at the end of the point
+
+        Args:
+            descriptor (dict): see :meth:`SharedRayWriter.descriptor`
+
+        Raises:
+            FileNotFoundError: if the bundle was already removed
+        """
+        name = descriptor['name']
+        with self._lock:
+            entry = self._bundles.get(name)
+            if entry is None:
+                entry = {'shm': _attach(name), 'refs': 1, 'table': None}
+                self._bundles[name] = entry
+            if entry['table'] is None:
+                entry['table'] = SharedRayTable(descriptor, entry['shm'])
+            entry['refs'] += 1
+            self._attached.append(name)
+            return entry['table']
+
+    def release(self, name:str, count:int=1):
+        """Release references of a bundle, and remove it once it has none"""
+        with self._lock:
+            entry = self._bundles.get(name)
+            if entry is None:
+                return
+            entry['refs'] -= count
+            if entry['refs'] <= 0:
+                self._remove(name)
+
+    def end_point(self):
+        """Release the bundles read during the point"""
+        with self._lock:
+            attached, self._attached = self._attached, []
+            for name in set(attached):
+                # the readers, and the simulation, are done with the bundle
+                self.release(name, attached.count(name)+1)
+
+    def end_run(self):
+        """Remove all the bundles"""
+        with self._lock:
+            self._attached = []
+            for name in list(self._bundles):
+                self._remove(name)
+
+    def _remove(self, name):
+        entry = self._bundles.pop(name)
+        try:
+            entry['shm'].unlink()
+        except FileNotFoundError:
+            pass
+        _close(entry['shm'])
+
+
+# the bundles of this process
+shared_bundles = SharedBundleRegistry()
+atexit.register(shared_bundles.end_run)
+
+
+def load_shared_rays(path:str, element:str, export_format='RawRaysOutgoing')->SharedRayTable:
+    """Attach the rays in shared memory of an exported element, see :func:`shared_ray_file`
+
+    Returns:
+        SharedRayTable: the rays, None if the bundle was already removed
+    """
+    with open(shared_ray_file(path, element, export_format)) as f:
+        descriptor = json.load(f)
+    try:
+        return shared_bundles.attach(descriptor)
+    except FileNotFoundError:
+        return None
+
+
+def materialize_shared_rays(path:str, exports_list, export_format='RawRaysOutgoing')->list:
+    """Replace the rays in shared memory found in ``path`` with ``.npy`` files
+
+    Used before the results are kept longer than a point, e.g. in the :class:`SimulationCache`.
+
+    Returns:
+        list: the ``.npy`` files written
+    """
+    written = []
+    for exp in exports_list:
+        filename = shared_ray_file(path, exp, export_format)
+        if not os.path.exists(filename):
+            continue
+        table = load_shared_rays(path, exp, export_format)
+        if table is not None:
+            written.append(write_shared_rays(ray_file(path, exp, export_format), table))
+        os.remove(filename)
+    return written
+
+
+def uses_shared_memory(engine)->bool:
+    """True if ``engine``, or an engine it wraps, exports the rays in shared memory"""
+    while engine is not None:
+        if getattr(engine, 'shared_memory', False):
+            return True
+        engine = getattr(engine, 'engine', None)
+    return False
+
+
+class SharedRaysPreprocessor():
+    """RunEngine preprocessor releasing the ray bundles in shared memory
+
+    The bundles read during a point are released after each event of the
+    primary stream, the remaining ones at the end of the run, see
+    :class:`SharedBundleRegistry`.
+
+    Args:
+        registry (SharedBundleRegistry, optional): the bundles. Defaults to ``shared_bundles``.
+    """
+    def __init__(self, registry:SharedBundleRegistry=None):
+        self.registry = registry if registry is not None else shared_bundles
+
+    def __call__(self, plan):
+        registry = self.registry
+        stream = [None]
+
+        def release(msg):
+            def tracked():
+                result = yield msg
+                if msg.command == 'close_run':
+                    registry.end_run()
+                elif msg.command == 'create':
+                    stream[0] = msg.kwargs.get('name', 'primary')
+                elif msg.command == 'save' and stream[0] == 'primary':
+                    registry.end_point()
+                return result
+            if msg.command in ('close_run', 'create', 'save'):
+                return tracked(), None
+            return None, None
+
+        return (yield from plan_mutator(plan, release))
@@ -0,0 +1,295 @@
+import os
+import logging
+import threading
+from concurrent.futures import Future
+
+import numpy as np
+
+from .rml_utils import enabled_parameters, hash_parameters
+from .rays import load_rays
+from .detectors import (SIGNALS, detector_statistics, load_statistics, write_statistics, source_flux,
+                        simulated_source_flux)
+from .engine import SimulationEngineBase, submit_simulation, chain_future
+
+logger = logging.getLogger(__name__)
+
+
+def parameter_features(rml):
+    """Split the enabled parameters of an rml file into numbers and context
+
+    Args:
+        rml (RMLFile): the rml file
+
+    Returns:
+        tuple: a dict ``element.parameter`` -> float of the numeric parameters, and
+               the list of the other parameters (e.g. file names or vectors)
+    """
+    numeric, context = {}, []
+    for name, oe_type, params in enabled_parameters(rml):
+        for param_id, value in params:
+            try:
+                numeric[f"{name}.{param_id}"] = float(value)
+            except ValueError:
+                context.append([name, param_id, value])
+    return numeric, context
+
+
+class SurrogateModel():
+    """Gaussian process regression of the detector signals on the rml parameters
+
+    The training points are the parameters of past simulations and the
+    resulting signals. Only the parameters that changed between the
+    simulations are used as inputs, the model refuses to predict when
+    any other parameter has a different value. A squared exponential
+    kernel on the inputs scaled to [0, 1] is used, for each signal the length
+    scale and the noise (e.g. the Monte Carlo noise of the fwhm) are chosen
+    maximizing the marginal likelihood.
+
+    Args:
+        filename (str, optional): ``.npz`` file where the training points are stored,
+                                  loaded if it exists. Defaults to None.
+        max_points (int, optional): maximum number of training points, the oldest are dropped.
+                                    Defaults to 500.
+    """
+    length_scales = (0.05, 0.1, 0.2, 0.5, 1., 2.)
+    noise_levels = (1e-6, 1e-4, 1e-3, 1e-2, 0.1, 0.3, 1.)
+
+    def __init__(self, filename:str=None, max_points:int=500):
+        self.filename = filename
+        self.max_points = max_points
+        self.inputs = []
+        self.outputs = []
+        self.X = np.zeros((0, 0))
+        self.Y = np.zeros((0, 0))
+        self._lock = threading.Lock()
+        self._fit = None
+        if filename is not None and os.path.exists(filename):
+            self.load()
+
+    def __len__(self):
+        return self.X.shape[0]
+
+    def add(self, inputs:dict, outputs:dict):
+        """Add a training point
+
+        Args:
+            inputs (dict): parameter -> value
+            outputs (dict): signal -> value
+        """
+        with self._lock:
+            if not self.inputs:
+                self.inputs = sorted(inputs)
+                self.outputs = sorted(outputs)
+                self.X = np.zeros((0, len(self.inputs)))
+                self.Y = np.zeros((0, len(self.outputs)))
+            if sorted(inputs) != self.inputs or sorted(outputs) != self.outputs:
+                raise ValueError("The parameters or the signals do not match the ones of the model")
+            x = np.array([inputs[k] for k in self.inputs])
+            y = np.array([outputs[k] for k in self.outputs])
+            self.X = np.vstack((self.X, x))[-self.max_points:]
+            self.Y = np.vstack((self.Y, y))[-self.max_points:]
+            self._fit = None
+
+    def predict(self, inputs:dict):
+        """Predict the signals and their uncertainty
+
+        Args:
+            inputs (dict): parameter -> value
+
+        Returns:
+            tuple: two dicts signal -> predicted value and signal -> standard deviation,
+                   or None if the model cannot predict for ``inputs``
+        """
+        with self._lock:
+            if len(self) == 0 or sorted(inputs) != self.inputs:
+                return None
+            if self._fit is None:
+                self._fit = self._train()
+            active, lo, span, mu, sd, X, fits = self._fit
+            x = np.array([inputs[k] for k in self.inputs])
+            if not np.allclose(x[~active], lo[~active], rtol=1e-12, atol=0):
+                return None
+            x = (x[active]-lo[active])/span
+            d2 = np.sum((X-x)**2, axis=1)
+            mean, std = mu.copy(), sd.copy()
+            for i, (length, L, alpha) in enumerate(fits):
+                k = np.exp(-0.5*d2/length**2)
+                v = np.linalg.solve(L, k)
+                mean[i] += sd[i]*(k @ alpha)
+                std[i] *= np.sqrt(max(1-v @ v, 0.))
+        return dict(zip(self.outputs, mean)), dict(zip(self.outputs, std))
+
+    def save(self):
+        """Save the training points into ``filename``"""
+        if self.filename is None:
+            return
+        with self._lock:
+            folder = os.path.dirname(self.filename)
+            if folder and not os.path.exists(folder):
+                os.makedirs(folder)
+            with open(self.filename+'.tmp', 'wb') as f:
+                np.savez(f, X=self.X, Y=self.Y, inputs=np.array(self.inputs), outputs=np.array(self.outputs))
+            os.replace(self.filename+'.tmp', self.filename)
+
+    def load(self):
+        """Load the training points from ``filename``"""
+        with np.load(self.filename) as data:
+            self.X, self.Y = data['X'], data['Y']
+            self.inputs = [str(k) for k in data['inputs']]
+            self.outputs = [str(k) for k in data['outputs']]
+        self._fit = None
+
+    def _train(self):
+        lo, hi = self.X.min(axis=0), self.X.max(axis=0)
+        active = hi > lo
+        span = (hi-lo)[active]
+        X = (self.X[:, active]-lo[active])/span
+        mu = self.Y.mean(axis=0)
+        sd = self.Y.std(axis=0)
+        sd[sd == 0] = 1
+        Y = (self.Y-mu)/sd
+        d2 = np.sum((X[:, None, :]-X[None, :, :])**2, axis=2)
+        fits = []
+        for y in Y.T:
+            best = None
+            for length in self.length_scales:
+                for noise in self.noise_levels:
+                    K = np.exp(-0.5*d2/length**2)+noise*np.eye(len(X))
+                    try:
+                        L = np.linalg.cholesky(K)
+                    except np.linalg.LinAlgError:
+                        continue
+                    alpha = np.linalg.solve(L.T, np.linalg.solve(L, y))
+                    log_likelihood = -0.5*y @ alpha-np.sum(np.log(np.diag(L)))
+                    if best is None or log_likelihood > best[0]:
+                        best = (log_likelihood, length, L, alpha)
+            fits.append(best[1:])
+        return active, lo, span, mu, sd, X, fits
+
+
+class SurrogateSimulationEngine(SimulationEngineBase):
+    """Simulation engine answering with a surrogate model of past simulations
+
+    For each rml file and set of exported elements a :class:`SurrogateModel`
+    is stored in ``store_folder`` and grown with each simulation. When the
+    largest relative uncertainty of the predicted signals is below
+    ``threshold`` the prediction is used, otherwise the simulation is
+    done by ``engine`` and added to the model. The values are written
+    in the statistics files read by :class:`TwinDetectorDevice`.
+
+    Args:
+        engine: the simulation engine used when the uncertainty is too large
+        store_folder (str): folder where the models are stored
+        threshold (float, optional): maximum relative uncertainty of a prediction. Defaults to 0.05.
+        min_points (int, optional): number of simulations before predicting. Defaults to 5.
+        max_points (int, optional): maximum number of training points of each model. Defaults to 500.
+    """
+    def __init__(self, engine, store_folder:str, threshold:float=0.05, min_points:int=5, max_points:int=500):
+        self.engine = engine
+        self.store_folder = store_folder
+        self.threshold = threshold
+        self.min_points = min_points
+        self.max_points = max_points
+        self.predictions = 0
+        self.simulations = 0
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def setup_simulation(self):
+        return self.engine.setup_simulation()
+
+    def model(self, rml, exports_list)->SurrogateModel:
+        """Return the model of an rml file and exported elements
+
+        Args:
+            rml (RMLFile): the rml file
+            exports_list (list): list of the exported objects
+
+        Returns:
+            SurrogateModel: the model
+        """
+        numeric, context = parameter_features(rml)
+        key = hash_parameters(os.path.abspath(rml.template), sorted(set(exports_list)), context)
+        with self._lock:
+            if key not in self._models:
+                filename = os.path.join(self.store_folder, key[:16]+'.npz')
+                self._models[key] = SurrogateModel(filename, max_points=self.max_points)
+            return self._models[key]
+
+    def predict(self, rml, exports_list):
+        """Predict the signals of the exported elements
+
+        Args:
+            rml (RMLFile): the rml file
+            exports_list (list): list of the exported objects
+
+        Returns:
+            dict: element -> signal values with the relative ``uncertainty``,
+                  None if the uncertainty is larger than the threshold
+        """
+        model = self.model(rml, exports_list)
+        if len(model) < self.min_points:
+            return None
+        prediction = model.predict(parameter_features(rml)[0])
+        if prediction is None:
+            return None
+        mean, std = prediction
+        relative = [s/abs(mean[k]) if mean[k] != 0 else (0. if s == 0 else np.inf) for k, s in std.items()]
+        uncertainty = float(max(relative))
+        if uncertainty > self.threshold:
+            return None
+        results = {}
+        for name, value in mean.items():
+            element, signal = name.rsplit('.', 1)
+            results.setdefault(element, {'uncertainty': uncertainty, 'mc_error': np.nan})[signal] = float(value)
+        return results
+
+    def simulate(self, path, rml, exports_list):
+        return self.submit(path, rml, exports_list).result()
+
+    def submit(self, path, rml, exports_list):
+        exports_list = sorted(set(exports_list))
+        results = self.predict(rml, exports_list)
+        if results is not None:
+            self.predictions += 1
+            for exp, values in results.items():
+                write_statistics(path, exp, values)
+            future = Future()
+            future.set_result(None)
+            return future
+        self.simulations += 1
+        model = self.model(rml, exports_list)
+        inputs = parameter_features(rml)[0]
+        # the rml file may be modified before the simulation is done
+        source = source_flux(rml)
+        future = submit_simulation(self.engine, path, rml, exports_list)
+        return chain_future(future, lambda result: self._learn(path, source, exports_list, model, inputs))
+
+    def stats(self)->dict:
+        """Return the number of predictions and simulations
+
+        Returns:
+            dict: predictions, simulations and number of models
+        """
+        return {'predictions': self.predictions,
+                'simulations': self.simulations,
+                'models': len(self._models)}
+
+    def shutdown(self):
+        if hasattr(self.engine, 'shutdown'):
+            self.engine.shutdown()
+
+    def _learn(self, path, source, exports_list, model, inputs):
+        results = {}
+        for exp in exports_list:
+            # the wrapped engine may have written the statistics, e.g. the ProgressiveSimulationEngine
+            results[exp] = load_statistics(path, exp) or detector_statistics(load_rays(path, exp),
+                                                                             simulated_source_flux(path, exp, source))
+        outputs = {f"{exp}.{k}": values[k] for exp, values in results.items() for k in SIGNALS}
+        try:
+            model.add(inputs, outputs)
+            model.save()
+        except Exception as e:
+            logger.warning(f"Could not update the surrogate model: {e}")
+        for exp, values in results.items():
+            write_statistics(path, exp, values)
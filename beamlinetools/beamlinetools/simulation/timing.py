@@ -0,0 +1,145 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+# phases of a scan point, in order
+PHASES = ('rml_mutation', 'rml_serialization', 'engine_load', 'trace', 'export',
+          'result_parsing', 'document_emission')
+
+_recorders = []
+_recorders_lock = threading.Lock()
+# simulation folder -> spans held until the folder is used, see hold_spans
+_held = {}
+_held_lock = threading.Lock()
+if hasattr(os, 'register_at_fork'):
+    # a forked process, e.g. of NumpySimulationEngine, returns its spans to this one, which holds them
+    os.register_at_fork(after_in_child=_held.clear)
+
+
+class TimingRecorder():
+    """Collect the timing spans recorded while it is active
+
+    The simulation engines record their phases with :func:`span`, which is
+    a no-op when no recorder is active. Spans are dicts with ``name``,
+    ``start`` (epoch time in seconds), ``duration`` (seconds), ``thread`` and
+    the attributes given to :func:`span`, e.g. ``path``, the simulation
+    folder, for the spans of the engines.
+
+    Usage::
+
+        with TimingRecorder() as recorder:
+            RE(scan(...))
+        recorder.spans
+    """
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        with _recorders_lock:
+            _recorders.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with _recorders_lock:
+            _recorders.remove(self)
+
+    def add(self, span:dict):
+        with self._lock:
+            self.spans.append(span)
+
+    def totals(self)->dict:
+        """Return the total duration of the spans, by name"""
+        totals = {}
+        for s in self.spans:
+            totals[s['name']] = totals.get(s['name'], 0.)+s['duration']
+        return totals
+
+
+def recording()->bool:
+    """Return True if a :class:`TimingRecorder` is active, or if spans are held, see :func:`hold_spans`"""
+    return bool(_recorders or _held)
+
+
+def _held_folder(path):
+    # the held folder containing path, if any
+    while path:
+        if path in _held:
+            return path
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+    return None
+
+
+def record_spans(spans):
+    """Add spans, e.g. recorded in another process, to the active recorders
+
+    The spans whose ``path`` is in a folder passed to :func:`hold_spans` are kept until :func:`release_spans`.
+    """
+    recorded = []
+    with _held_lock:
+        for s in spans:
+            folder = _held_folder(os.path.normpath(s['path'])) if _held and s.get('path') else None
+            if folder is None:
+                recorded.append(s)
+            else:
+                _held[folder].append(s)
+    for recorder in list(_recorders):
+        for s in recorded:
+            recorder.add(s)
+
+
+def hold_spans(path:str):
+    """Keep the spans of the simulations in ``path`` until :func:`release_spans`
+
+    The spans of a simulation submitted in advance, e.g. by the
+    :class:`LookAheadSimulationEngine`, are then recorded when its results
+    are used, so they are attributed to the point that uses them. They keep
+    their own ``start``.
+
+    Args:
+        path (str): the simulation folder, the spans in its sub-folders are held too
+    """
+    with _held_lock:
+        _held.setdefault(os.path.normpath(path), [])
+
+
+def release_spans(path:str, record:bool=True)->list:
+    """Stop holding the spans of ``path``, see :func:`hold_spans`
+
+    Args:
+        path (str): the simulation folder
+        record (bool, optional): add the held spans to the active recorders,
+                                 otherwise they are dropped. Defaults to True.
+
+    Returns:
+        list: the held spans
+    """
+    with _held_lock:
+        spans = _held.pop(os.path.normpath(path), [])
+    if record:
+        record_spans(spans)
+    return spans
+
+
+@contextmanager
+def span(name:str, **attributes):
+    """Time a block of code and add it to the active recorders
+
+    Args:
+        name (str): the name of the span, e.g. one of PHASES
+        **attributes: other information about the span
+    """
+    if not recording():
+        yield
+        return
+    start = time.time()
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_spans([{'name': name, 'start': start, 'duration': time.perf_counter()-t0,
+                       'thread': threading.current_thread().name, **attributes}])
@@ -0,0 +1,250 @@
+import os
+import json
+import time
+import logging
+import threading
+
+from ophyd import Device, Signal, Component as Cpt
+from bluesky import Msg
+from bluesky.preprocessors import plan_mutator
+
+from .timing import TimingRecorder
+
+logger = logging.getLogger(__name__)
+
+# name of the event stream with the timings of each point
+TIMING_STREAM = 'timing'
+
+
+class TimingDevice(Device):
+    """The timings of the last point of a scan, in seconds
+
+    ``queue_wait`` is the time the trigger waited for the simulation that was
+    not spent writing the rml file, loading, tracing or exporting, e.g. waiting
+    for a free worker or for a prefetched point. ``readout`` is the time spent
+    reading the detectors.
+    """
+    queue_wait =   Cpt(Signal, value=0., kind='normal')
+    rml_mutation = Cpt(Signal, value=0., kind='normal')
+    rml_write =    Cpt(Signal, value=0., kind='normal')
+    engine_load =  Cpt(Signal, value=0., kind='normal')
+    trace =        Cpt(Signal, value=0., kind='normal')
+    export =       Cpt(Signal, value=0., kind='normal')
+    readout =      Cpt(Signal, value=0., kind='normal')
+    point =        Cpt(Signal, value=0., kind='normal')
+
+    # name of the spans recorded by the engines, see span
+    engine_spans = {'rml_serialization': 'rml_write', 'engine_load': 'engine_load',
+                    'trace': 'trace', 'export': 'export'}
+
+    def set_timings(self, timings:dict):
+        for name, value in timings.items():
+            getattr(self, name).put(value)
+
+
+class PointTimer():
+    """Time the messages of a run, point by point
+
+    Used by :func:`timing_wrapper`, see :class:`TimingDevice` for the timings.
+
+    Args:
+        device (TimingDevice): the device receiving the timings of each point
+        exporters (list, optional): objects with a method ``export(run_uid, point)``
+                                    receiving the spans of each point. Defaults to ().
+    """
+    def __init__(self, device:TimingDevice, exporters=()):
+        self.device = device
+        self.exporters = list(exporters)
+        self.recorder = None
+        self.run_uid = None
+        self.seq_num = 0
+        # True when the timings of a point are ready to be read
+        self.ready = False
+        self._stream = None
+        self._triggered = False
+        self._reset()
+
+    def _reset(self):
+        self._start = time.time()
+        self._spans = []
+        self._index = len(self.recorder.spans) if self.recorder is not None else 0
+        self._triggered = False
+
+    def add(self, msg, result, start:float, duration:float):
+        """Account for a message processed by the RunEngine
+
+        Args:
+            msg (Msg): the message
+            result: the value returned by the RunEngine
+            start (float): epoch time when the message was sent
+            duration (float): time spent processing the message
+        """
+        command = msg.command
+        if command == 'open_run':
+            self.close()
+            self.run_uid = result
+            self.seq_num = 0
+            self.recorder = TimingRecorder().__enter__()
+            self._reset()
+        elif command == 'close_run':
+            self.close()
+        elif command == 'set':
+            self._add_span('rml_mutation', start, duration, obj=getattr(msg.obj, 'name', None))
+        elif command == 'trigger':
+            self._triggered = True
+            self._add_span('simulation', start, duration)
+        elif command == 'wait' and self._triggered:
+            self._add_span('simulation', start, duration)
+        elif command == 'create':
+            self._stream = msg.kwargs.get('name', 'primary')
+        elif command == 'read' and self._stream == 'primary':
+            self._add_span('read', start, duration, obj=getattr(msg.obj, 'name', None))
+        elif command == 'save' and self._stream == 'primary' and self.recorder is not None:
+            self._add_span('document_emission', start, duration)
+            self._finish_point()
+            self.ready = True
+
+    def close(self):
+        """Stop recording the spans of the engines"""
+        if self.recorder is not None:
+            self.recorder.__exit__(None, None, None)
+            self.recorder = None
+
+    def _add_span(self, name, start, duration, **attributes):
+        self._spans.append({'name': name, 'start': start, 'duration': duration,
+                            'thread': threading.current_thread().name, **attributes})
+
+    def _finish_point(self):
+        self.seq_num += 1
+        spans = self._spans+self.recorder.spans[self._index:]
+        totals = {}
+        for s in spans:
+            totals[s['name']] = totals.get(s['name'], 0.)+s['duration']
+        timings = dict.fromkeys(self.device.component_names, 0.)
+        for name, field in self.device.engine_spans.items():
+            timings[field] = totals.get(name, 0.)
+        timings['rml_mutation'] = totals.get('rml_mutation', 0.)
+        timings['readout'] = totals.get('read', 0.)
+        working = sum(timings[field] for field in self.device.engine_spans.values())
+        timings['queue_wait'] = max(0., totals.get('simulation', 0.)-working)
+        timings['point'] = time.time()-self._start
+        self.device.set_timings(timings)
+        point = {'name': 'point', 'start': self._start, 'duration': timings['point'],
+                 'seq_num': self.seq_num, 'spans': spans}
+        for exporter in self.exporters:
+            try:
+                exporter.export(self.run_uid, point)
+            except Exception as e:
+                # the exporters must not stop the scan
+                logger.warning(f"Timing exporter {exporter} failed: {e}")
+        self._reset()
+
+
+def timing_wrapper(plan, device:TimingDevice, exporters=()):
+    """Add an event stream with the timings of each point of ``plan``
+
+    After each event of the primary stream an event is saved in the
+    ``timing`` stream, reading ``device``.
+
+    Args:
+        plan (bluesky.plan): the plan
+        device (TimingDevice): the device with the timings
+        exporters (list, optional): exporters of the spans, e.g. :class:`OTelFileExporter`. Defaults to ().
+    """
+    timer = PointTimer(device, exporters)
+
+    def timing_event():
+        yield Msg('create', name=TIMING_STREAM)
+        yield Msg('read', device)
+        yield Msg('save')
+
+    def time_msg(msg):
+        def timed():
+            start, t0 = time.time(), time.perf_counter()
+            result = yield msg
+            timer.add(msg, result, start, time.perf_counter()-t0)
+            return result
+
+        def tail():
+            if timer.ready:
+                timer.ready = False
+                yield from timing_event()
+
+        if msg.command == 'save':
+            return timed(), tail()
+        return timed(), None
+
+    try:
+        return (yield from plan_mutator(plan, time_msg))
+    finally:
+        timer.close()
+
+
+class TimingPreprocessor():
+    """RunEngine preprocessor adding the ``timing`` stream to every plan
+
+    It must be appended to ``RE.preprocessors`` after the preprocessor of
+    raypyng, see :class:`TwinOphydDevices`.
+
+    Args:
+        device (TimingDevice): the device with the timings
+        exporters (list, optional): exporters of the spans, e.g. :class:`OTelFileExporter`. Defaults to ().
+    """
+    def __init__(self, device:TimingDevice, exporters=()):
+        self.device = device
+        self.exporters = list(exporters)
+
+    def __call__(self, plan):
+        return (yield from timing_wrapper(plan, self.device, self.exporters))
+
+
+def _otel_value(value)->dict:
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+class OTelFileExporter():
+    """Write the spans of each point into a file, in the OpenTelemetry (OTLP) json format
+
+    Each line of the file is an OTLP ``ExportTraceServiceRequest``, as written
+    by the file exporter of the OpenTelemetry collector, so the file can be
+    loaded by the OpenTelemetry tools. The trace id is the uid of the run,
+    each point is a span whose children are the spans of its phases.
+
+    Args:
+        filename (str): the file, the lines are appended
+        service_name (str, optional): the ``service.name`` of the spans. Defaults to 'digital-twin'.
+    """
+    def __init__(self, filename:str, service_name:str='digital-twin'):
+        self.filename = filename
+        self.service_name = service_name
+        self._lock = threading.Lock()
+
+    def export(self, run_uid:str, point:dict):
+        """Append the spans of a point, see :class:`PointTimer`"""
+        trace_id = (run_uid or '').replace('-', '')[:32].rjust(32, '0')
+        point_id = os.urandom(8).hex()
+        spans = [self._span(trace_id, point_id, '', 'point', point['start'], point['duration'],
+                            {'seq_num': point['seq_num']})]
+        for s in point['spans']:
+            attributes = {k: v for k, v in s.items() if k not in ('name', 'start', 'duration') and v is not None}
+            spans.append(self._span(trace_id, os.urandom(8).hex(), point_id, s['name'], s['start'], s['duration'],
+                                    attributes))
+        request = {'resourceSpans': [{
+            'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': self.service_name}}]},
+            'scopeSpans': [{'scope': {'name': 'beamlinetools.simulation'}, 'spans': spans}]}]}
+        with self._lock:
+            with open(self.filename, 'a') as f:
+                f.write(json.dumps(request)+'\n')
+
+    @staticmethod
+    def _span(trace_id, span_id, parent_id, name, start, duration, attributes)->dict:
+        start_ns = int(start*1e9)
+        return {'traceId': trace_id, 'spanId': span_id, 'parentSpanId': parent_id, 'name': name,
+                'kind': 1, 'startTimeUnixNano': str(start_ns), 'endTimeUnixNano': str(start_ns+int(duration*1e9)),
+                'attributes': [{'key': k, 'value': _otel_value(v)} for k, v in attributes.items()]}
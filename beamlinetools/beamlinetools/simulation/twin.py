@@ -0,0 +1,311 @@
+import os
+import sys
+import logging
+import traceback
+from functools import partial
+
+from raypyng_bluesky.RaypyngOphydDevices import RaypyngOphydDevices
+from raypyng_bluesky.preprocessor import SupplementalDataRaypyng
+
+from .cache import CachedSimulationEngine
+from .pool import RayUIWorkerPool, PooledSimulationEngine
+from .numpy_tracer import NumpySimulationEngine
+from .client import SimulationClient
+from .dispatcher import SimulationDispatcher
+from .progressive import ProgressiveSimulationEngine
+from .lookahead import LookAheadSimulationEngine, SupplementalDataLookAhead
+from .surrogate import SurrogateSimulationEngine
+from .detectors import TwinDetectorDevice, TwinTriggerDetector
+from .timing_stream import TimingDevice, TimingPreprocessor
+from .workspace import ScratchWorkspace, WorkspacePreprocessor
+from .shared_rays import SharedRaysPreprocessor, uses_shared_memory
+from .lazy import LazyDevice
+from .scheduler import SimulationScheduler, SchedulerPreprocessor
+from .interrupts import AbortPreprocessor
+from .seeding import CommonRandomNumbersPreprocessor
+from .ring import RingCurrentScaling
+from .engine import submits_in_background
+
+logger = logging.getLogger(__name__)
+
+
+def _pool_engine(ray_ui_location=None, **kwargs):
+    return PooledSimulationEngine(RayUIWorkerPool(ray_ui_location=ray_ui_location, **kwargs))
+
+
+def _numpy_engine(ray_ui_location=None, **kwargs):
+    return NumpySimulationEngine(**kwargs)
+
+
+def _client_engine(ray_ui_location=None, ip='127.0.0.1', port=12345, **kwargs):
+    return SimulationClient(host=ip, port=port, **kwargs)
+
+
+def _dispatcher_engine(ray_ui_location=None, workers=(), **kwargs):
+    return SimulationDispatcher(workers, **kwargs)
+
+
+class TwinOphydDevices(RaypyngOphydDevices):
+    """RaypyngOphydDevices using the simulation engines of beamlinetools
+
+    Same as :class:`RaypyngOphydDevices`, ``simulation_engine`` can additionally be:
+
+    * ``'pool'``: a :class:`RayUIWorkerPool` of long-lived RAY-UI instances
+    * ``'numpy'``: the :class:`NumpySimulationEngine`, that does not need RAY-UI
+    * ``'rayuiClient'``: a :class:`SimulationClient` sending the simulations to the
+      :class:`SimulationServer` at ``ip`` and ``port``
+    * ``'dispatcher'``: a :class:`SimulationDispatcher` spreading the simulations over
+      the workers given in ``engine_options['workers']``, e.g. ``['node1:12345', 'node2:12345']``
+    * an engine instance, e.g. a :class:`PooledSimulationEngine`
+
+    Any other name (i.e. ``'rayui'``) is handled by raypyng-bluesky.
+
+    The image planes are :class:`TwinDetectorDevice`, reading the rays from the
+    binary ``.npy`` files (the csv files exported by RAY-UI are converted once).
+
+    Args:
+        simulation_engine (str or engine, optional): the simulation engine. Defaults to 'rayui'.
+        engine_options (dict, optional): keyword arguments used to create the engine
+                                         when ``simulation_engine`` is a name. Defaults to None.
+        progressive_tolerance (float, optional): if not None the rays are traced in batches until
+                                                 the relative Monte Carlo error of the intensity is
+                                                 below this value, see :class:`ProgressiveSimulationEngine`.
+                                                 Defaults to None.
+        cache (SimulationCache, optional): if not None the results are looked up in
+                                           the cache before simulating. Defaults to None.
+        surrogate (str, optional): if not None, folder of the surrogate models answering
+                                   the triggers whose predicted uncertainty is small enough,
+                                   see :class:`SurrogateSimulationEngine`. Defaults to None.
+        surrogate_threshold (float, optional): maximum relative uncertainty of the
+                                               predictions of the surrogate models. Defaults to 0.05.
+        lookahead (bool, optional): if True the points of the scans with a known trajectory
+                                    are submitted to the engine when the run is opened,
+                                    see :class:`LookAheadSimulationEngine`. Turned off with a
+                                    warning if the engine cannot simulate in the background,
+                                    i.e. ``'rayui'``. Defaults to False.
+        lookahead_window (int, optional): maximum number of points simulated ahead of the scan,
+                                          if None all of them. Defaults to None.
+        timing (bool, optional): if True the timings of each point (queue wait, rml write, trace,
+                                 export, read) are saved in the ``timing`` stream of the runs,
+                                 see :class:`TimingDevice`. Defaults to False.
+        timing_exporters (list, optional): exporters of the spans of each point, e.g. an
+                                           :class:`OTelFileExporter`. Defaults to None.
+        workspace (ScratchWorkspace or bool, optional): if not None the simulations are written into
+                                                        this scratch workspace (True for one on tmpfs),
+                                                        with quotas and the I/O of each scan in
+                                                        ``workspace.history``. Ignored if ``temporary_folder``
+                                                        is given. Defaults to None.
+        lazy_devices (bool, optional): if True the ``rp_<Element>`` names are registered at once,
+                                       but each device and its signals are only created at
+                                       their first use, see :class:`LazyDevice`. Defaults to False.
+        scheduler (bool, optional): if True the simulations are queued by priority class in
+                                    ``twin.scheduler``, the runs of ``RE`` are ``batch`` and
+                                    those of the RunEngines added with :meth:`attach` are
+                                    ``interactive`` by default, see :class:`SimulationScheduler`.
+                                    Defaults to False.
+        interactive_slots (int, optional): simulations slots kept for the interactive runs
+                                           by the scheduler. Defaults to 1.
+        common_random_numbers (bool, optional): if True all the points of a run are traced with the same
+                                                random rays, from a seed recorded as ``twin_seed`` in its
+                                                start document, see :class:`CommonRandomNumbersPreprocessor`.
+                                                Defaults to False.
+        seed (int, optional): with ``common_random_numbers``, the seed of every run, e.g. the
+                              ``twin_seed`` of a run to trace again. If None each run draws
+                              a new seed. Defaults to None.
+        ring_current (optional): if not None the intensities of the detectors are scaled to the
+                                 current of the storage ring when they are read, without simulating
+                                 again: a :class:`RingCurrentScaling`, or a device with a ``current``
+                                 signal in mA, e.g. a :class:`DetailedAccelerator` or a
+                                 :class:`ReplayedAccelerator`. Defaults to None.
+
+    All the other arguments are passed to :class:`RaypyngOphydDevices`.
+    """
+    engines = {'pool': _pool_engine,
+               'numpy': _numpy_engine,
+               'rayuiClient': _client_engine,
+               'dispatcher': _dispatcher_engine}
+
+    def __init__(self, *args, RE, rml_path, temporary_folder=None, name_space=None, ray_ui_location=None,
+                 simulation_engine='rayui', engine_options=None, progressive_tolerance=None, cache=None,
+                 surrogate=None, surrogate_threshold=0.05,
+                 lookahead=False, lookahead_window=None, timing=False, timing_exporters=None,
+                 workspace=None, lazy_devices=False, scheduler=False, interactive_slots=1,
+                 common_random_numbers=False, seed=None, ring_current=None, **kwargs):
+        # RaypyngOphydDevices looks for the namespace and the temporary folder
+        # in the stack of the caller, that is this class: resolve them here
+        if name_space is None:
+            name_space = sys._getframe(1)
+        if workspace is True:
+            workspace = ScratchWorkspace()
+        self.workspace = workspace if temporary_folder is None else None
+        if self.workspace is not None:
+            temporary_folder = self.workspace.folder('twin')
+        if temporary_folder is None:
+            fn = traceback.extract_stack()[-2].filename
+            temporary_folder = os.path.join(os.path.dirname(fn), 'tmp')
+        self.progressive_tolerance = progressive_tolerance
+        self.cache = cache
+        self.surrogate = surrogate
+        self.surrogate_threshold = surrogate_threshold
+        self.lookahead = lookahead
+        self.lookahead_window = lookahead_window
+        self.lazy_devices = lazy_devices
+        self.use_scheduler = scheduler
+        self.interactive_slots = interactive_slots
+        self.common_random_numbers = common_random_numbers
+        self.seed = seed
+        if ring_current is not None and not isinstance(ring_current, RingCurrentScaling):
+            ring_current = RingCurrentScaling(ring_current)
+        self.ring_current = ring_current
+        self.scheduler = None
+        self.timing_device = TimingDevice(name='twin_timing') if timing or timing_exporters else None
+        self.timing_exporters = list(timing_exporters or [])
+        self._engine = None
+        # the trigger detectors of the RunEngines added with attach
+        self._attached = []
+        if isinstance(simulation_engine, str) and simulation_engine in self.engines:
+            engine_options = dict(engine_options or {})
+            if simulation_engine == 'rayuiClient':
+                # same arguments as RaypyngOphydDevices
+                engine_options.update({k: kwargs.pop(k) for k in ('ip', 'port') if k in kwargs})
+            self._engine = self.engines[simulation_engine](ray_ui_location=ray_ui_location, **engine_options)
+            simulation_engine = 'rayui'
+        elif not isinstance(simulation_engine, str):
+            self._engine = simulation_engine
+            simulation_engine = 'rayui'
+        super().__init__(*args, RE=RE, rml_path=rml_path, temporary_folder=temporary_folder, name_space=name_space,
+                         ray_ui_location=ray_ui_location, simulation_engine=simulation_engine, **kwargs)
+
+    def create_raypyng_elements_from_rml(self):
+        """Create the Ophyd devices, using :class:`TwinDetectorDevice` for the image planes
+
+        With ``lazy_devices`` a :class:`LazyDevice` is registered for each element instead.
+        """
+        self.type_to_class_dict = {**self.type_to_class_dict,
+                                   'ImagePlane': partial(TwinDetectorDevice, ring_current=self.ring_current)}
+        if not self.lazy_devices:
+            return super().create_raypyng_elements_from_rml()
+        ret = ()
+        for oe in self.rml.beamline.children():
+            cls = self.type_to_class_dict[oe['type']]
+            k = oe['name']
+            if oe['type'] == 'ImagePlane':
+                factory = partial(cls, name=k, rml=self.rml, tmp=self.temporary_folder)
+            else:
+                factory = partial(cls, obj=oe, name=k)
+            self.name_space[k] = LazyDevice(k, factory, self.name_space)
+            ret = ret + (self.name_space[k],)
+        return ret
+
+    def create_trigger_detector(self):
+        """Create the trigger detector, a :class:`TwinTriggerDetector`"""
+        self.name_space['TriggerDetector'] = TwinTriggerDetector(name='RaypyngTriggerDetector', rml=self.rml,
+                                                                 temporary_folder=self.temporary_folder,
+                                                                 simulation_api=self.simulation_engine)
+
+    def setup_trigger_detector(self):
+        """Set the simulation engine of the trigger detector, wrapped in the progressive
+        engine, in the scheduler, in the cache, in the surrogate model and in the look-ahead
+        engine if needed
+        """
+        if self._engine is not None:
+            self.simulation_engine = self._engine
+        if self.lookahead and not submits_in_background(self.simulation_engine):
+            logger.warning("The look-ahead needs an engine that simulates in the background, e.g. 'pool' "
+                           "or 'numpy': it is turned off, the points are simulated when they are triggered")
+            self.lookahead = False
+        if self.progressive_tolerance is not None:
+            self.simulation_engine = ProgressiveSimulationEngine(self.simulation_engine,
+                                                                 tolerance=self.progressive_tolerance)
+        if self.use_scheduler:
+            self.scheduler = SimulationScheduler(self.simulation_engine, interactive_slots=self.interactive_slots)
+            self.simulation_engine = self.scheduler
+        if self.cache is not None:
+            self.simulation_engine = CachedSimulationEngine(self.simulation_engine, self.cache)
+        if self.surrogate is not None:
+            self.simulation_engine = SurrogateSimulationEngine(self.simulation_engine, self.surrogate,
+                                                               threshold=self.surrogate_threshold)
+        if self.lookahead:
+            self.simulation_engine = LookAheadSimulationEngine(self.simulation_engine, window=self.lookahead_window,
+                                                               workspace=self.workspace)
+        super().setup_trigger_detector()
+
+    def append_preprocessor(self):
+        """Add supplemental data to the RunEngine to trigger the simulations,
+        the cancellation of the simulations of the aborted runs, and the ``timing``
+        stream, the accounting of the workspace, the release of the rays in shared
+        memory, the priority class of the scheduler and the seed of the runs if needed
+        """
+        self.attach(self.RE, priority='batch')
+
+    def run_engine_trigger_detector(self, RE):
+        """Return the trigger detector of the runs of ``RE``
+
+        ``RE`` uses the trigger detector of the twin. Each other RunEngine gets
+        its own :class:`TwinTriggerDetector`, simulating with the same engine in
+        its own folder next to the temporary folder of the twin (raypyng-bluesky
+        removes the folder of the trigger detector when a run is closed).
+
+        Args:
+            RE (RunEngine): the RunEngine
+
+        Returns:
+            TwinTriggerDetector: the trigger detector
+        """
+        if RE is self.RE:
+            return self.trigger_detector()
+        if not submits_in_background(self.simulation_engine):
+            raise ValueError("The simulation engine simulates one point at a time in a single RAY-UI instance, "
+                             "it cannot simulate for another RunEngine: use simulation_engine='pool'")
+        n = len(self._attached)+1
+        if self.workspace is not None:
+            folder = self.workspace.folder(f'twin_{n}')
+        else:
+            folder = os.path.normpath(self.temporary_folder)+f'_{n}'
+        trigger_detector = TwinTriggerDetector(name=f'RaypyngTriggerDetector_{n}', rml=self.rml,
+                                               temporary_folder=folder, simulation_api=self.simulation_engine)
+        trigger_detector.set_ray_ui_location(self.ray_ui_location)
+        trigger_detector.set_simulation_engine(self.simulation_engine)
+        self._attached.append(trigger_detector)
+        # the interruptions of a RunEngine must not cancel the simulations of the others
+        for td in [self.trigger_detector()]+self._attached:
+            td.shared = True
+        return trigger_detector
+
+    def attach(self, RE, priority:str='interactive'):
+        """Trigger the simulations of the twin in the runs of another RunEngine too
+
+        E.g. ``twin.attach(BlueskyMagicsCustom.RE)``, so that ``%ct`` simulates
+        the twin, also while ``RE`` runs a scan. The RunEngine gets its own trigger
+        detector and simulation folder (see :meth:`run_engine_trigger_detector`),
+        its runs simulate the rml file as it is when they trigger, and the detectors
+        read the folder of the RunEngine that reads them (see :func:`reading_folder`).
+        With the scheduler the simulations of its runs are queued with ``priority``,
+        the interactive simulations jump ahead of the queued batch simulations.
+        Pausing or aborting a run only cancels the simulations of that run, see
+        :func:`cancel_run_simulations`. The common random numbers are only used
+        by the runs of ``RE``: the engines have a single seed.
+
+        Args:
+            RE (RunEngine): the RunEngine, running its plans in its own event loop
+            priority (str, optional): the priority class of its runs, see :class:`SimulationScheduler`.
+                                      Defaults to 'interactive'.
+        """
+        trigger_detector = self.run_engine_trigger_detector(RE)
+        if not self.lookahead:
+            RE.preprocessors.append(SupplementalDataRaypyng(trigger_detector=trigger_detector))
+        else:
+            sd = SupplementalDataLookAhead(trigger_detector=trigger_detector, engine=self.simulation_engine)
+            RE.preprocessors.append(sd)
+        RE.preprocessors.append(AbortPreprocessor(trigger_detector))
+        if self.timing_device is not None:
+            RE.preprocessors.append(TimingPreprocessor(self.timing_device, self.timing_exporters))
+        if self.workspace is not None:
+            RE.preprocessors.append(WorkspacePreprocessor(self.workspace))
+        if uses_shared_memory(self.simulation_engine):
+            RE.preprocessors.append(SharedRaysPreprocessor())
+        if self.common_random_numbers and RE is self.RE:
+            RE.preprocessors.append(CommonRandomNumbersPreprocessor(trigger_detector, seed=self.seed))
+        if self.scheduler is not None:
+            # after the look-ahead, so that the run is known before it submits its points
+            RE.preprocessors.append(SchedulerPreprocessor(priority))
@@ -0,0 +1,271 @@
+import os
+import time
+import shutil
+import logging
+import tempfile
+import threading
+import weakref
+
+from bluesky.preprocessors import plan_mutator
+
+logger = logging.getLogger(__name__)
+
+
+def default_scratch_root()->str:
+    """Return a folder on a RAM-backed file system if possible
+
+    ``/dev/shm`` is a tmpfs on most Linux systems, otherwise the temporary
+    folder of the system is used.
+    """
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+def _process_io()->dict:
+    # bytes read and written by this process, only available on Linux
+    try:
+        with open('/proc/self/io') as f:
+            return {k: int(v) for k, v in (line.split(':') for line in f)}
+    except (OSError, ValueError):
+        return {}
+
+
+class ScratchWorkspace():
+    """Scratch folder of the simulations, with quotas and per-scan I/O accounting
+
+    All the files are written into one folder on a fast file system
+    (by default on tmpfs, see :func:`default_scratch_root`), which is
+    removed when the workspace is closed or garbage collected.
+
+    * :meth:`folder` returns a named folder, e.g. the temporary folder of the twin
+    * :meth:`acquire` and :meth:`release` hand out worker folders that are emptied
+      and reused, instead of creating a new folder for each simulation
+    * :meth:`account` counts the bytes written since the last call and, when either
+      ``max_size`` or ``max_files`` is exceeded, removes the files least recently
+      used first. The acquired worker folders are never cleaned up.
+    * :meth:`start_scan` and :meth:`end_scan` collect the I/O statistics of a scan,
+      see :class:`WorkspacePreprocessor`
+
+    Args:
+        root (str, optional): folder where the workspace is created,
+                              if None :func:`default_scratch_root`. Defaults to None.
+        max_size (int, optional): maximum size of the files in bytes. Defaults to 1 GB.
+        max_files (int, optional): maximum number of files. Defaults to 10000.
+    """
+    workers_folder = 'workers'
+
+    def __init__(self, root:str=None, max_size:int=1024**3, max_files:int=10000):
+        self.root = root if root is not None else default_scratch_root()
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        self.path = tempfile.mkdtemp(prefix='beamlinetools-', dir=self.root)
+        self.max_size = max_size
+        self.max_files = max_files
+        self.size = 0
+        self.files = 0
+        self.history = []
+        self._lock = threading.RLock()
+        self._free = []
+        self._busy = set()
+        self._workers = 0
+        self._mark = time.time()
+        self._scan = None
+        self._io = {}
+        self._finalizer = weakref.finalize(self, shutil.rmtree, self.path, True)
+
+    def folder(self, name:str)->str:
+        """Return the folder ``name`` of the workspace, created if needed"""
+        path = os.path.join(self.path, name)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        return path
+
+    def acquire(self)->str:
+        """Return an empty worker folder, to be given back with :meth:`release`"""
+        with self._lock:
+            if self._free:
+                path = self._free.pop()
+            else:
+                path = self.folder(os.path.join(self.workers_folder, str(self._workers)))
+                self._workers += 1
+            self._busy.add(path)
+        return path
+
+    def release(self, path:str):
+        """Empty a worker folder and make it available again
+
+        The files written since the last :meth:`account` are accounted before
+        they are removed.
+        """
+        with self._lock:
+            if path not in self._busy:
+                return
+            written, files = 0, 0
+            for entry in os.scandir(path):
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                    continue
+                st = entry.stat(follow_symlinks=False)
+                if st.st_mtime > self._mark:
+                    written += st.st_size
+                    files += 1
+                os.unlink(entry.path)
+            self._count_written(written, files)
+            self._busy.discard(path)
+            self._free.append(path)
+
+    def account(self)->dict:
+        """Count the bytes written since the last call and enforce the quotas
+
+        Returns:
+            dict: bytes and files written, bytes and files removed
+        """
+        with self._lock:
+            start = time.time()
+            written, written_files = 0, 0
+            candidates = []
+            size, files = 0, 0
+            for path, st in self._walk(self.path):
+                if self._mark < st.st_mtime <= start:
+                    written += st.st_size
+                    written_files += 1
+                size += st.st_size
+                files += 1
+                if not any(path.startswith(busy+os.sep) for busy in self._busy):
+                    candidates.append((max(st.st_atime, st.st_mtime), st.st_size, path))
+            self._mark = start
+            removed, removed_files = 0, 0
+            if size > self.max_size or files > self.max_files:
+                for _, file_size, path in sorted(candidates):
+                    if size <= self.max_size and files <= self.max_files:
+                        break
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        continue
+                    size -= file_size
+                    files -= 1
+                    removed += file_size
+                    removed_files += 1
+                if size > self.max_size or files > self.max_files:
+                    logger.warning(f"Scratch workspace {self.path} above its quota: "
+                                   f"{size} bytes in {files} files")
+            self.size, self.files = size, files
+            self._count_written(written, written_files)
+            if self._scan is not None:
+                self._scan['bytes_removed'] += removed
+                self._scan['files_removed'] += removed_files
+                self._scan['peak_size'] = max(self._scan['peak_size'], size)
+                self._scan['peak_files'] = max(self._scan['peak_files'], files)
+        return {'bytes_written': written, 'files_written': written_files,
+                'bytes_removed': removed, 'files_removed': removed_files}
+
+    def start_scan(self, uid:str=None):
+        """Start collecting the I/O statistics of a scan"""
+        with self._lock:
+            self.account()
+            self._scan = {'uid': uid, 'start': time.time(), 'points': 0,
+                          'bytes_written': 0, 'files_written': 0, 'bytes_removed': 0, 'files_removed': 0,
+                          'peak_size': self.size, 'peak_files': self.files}
+            self._io = _process_io()
+
+    def end_scan(self)->dict:
+        """Stop collecting the I/O statistics of a scan
+
+        Returns:
+            dict: the statistics of the scan, also appended to ``history``. ``process_read``
+                  and ``process_written`` are the bytes read and written by this process
+                  (on Linux), the other values are for the files of the workspace
+        """
+        with self._lock:
+            if self._scan is None:
+                return None
+            self.account()
+            scan, self._scan = self._scan, None
+            io = _process_io()
+            scan['duration'] = time.time()-scan['start']
+            scan['process_read'] = io.get('rchar', 0)-self._io.get('rchar', 0)
+            scan['process_written'] = io.get('wchar', 0)-self._io.get('wchar', 0)
+            self.history.append(scan)
+        logger.info(f"Scan {scan['uid']}: {scan['bytes_written']/1024**2:.1f} MB written in "
+                    f"{scan['files_written']} files, {scan['bytes_removed']/1024**2:.1f} MB cleaned up")
+        return scan
+
+    def point_done(self):
+        """Account the files of a scan point, see :meth:`account`"""
+        with self._lock:
+            if self._scan is not None:
+                self._scan['points'] += 1
+            self.account()
+
+    def stats(self)->dict:
+        """Return the size and number of files, and the number of worker folders
+
+        Returns:
+            dict: size, files, workers and busy workers
+        """
+        return {'size': self.size,
+                'files': self.files,
+                'workers': self._workers,
+                'busy': len(self._busy)}
+
+    def close(self):
+        """Remove the workspace and all its files"""
+        self._finalizer()
+
+    def _count_written(self, written, files):
+        if self._scan is not None:
+            self._scan['bytes_written'] += written
+            self._scan['files_written'] += files
+
+    def _walk(self, path):
+        try:
+            entries = list(os.scandir(path))
+        except OSError:
+            return
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    yield from self._walk(entry.path)
+                else:
+                    yield entry.path, entry.stat(follow_symlinks=False)
+            except OSError:
+                # removed in the meantime
+                continue
+
+
+class WorkspacePreprocessor():
+    """RunEngine preprocessor accounting the I/O of each scan in a :class:`ScratchWorkspace`
+
+    The statistics of each run are collected between ``open_run`` and
+    ``close_run``, and the quotas are enforced after each event of the
+    primary stream.
+
+    Args:
+        workspace (ScratchWorkspace): the workspace
+    """
+    def __init__(self, workspace:ScratchWorkspace):
+        self.workspace = workspace
+
+    def __call__(self, plan):
+        workspace = self.workspace
+        stream = [None]
+
+        def account(msg):
+            def tracked():
+                result = yield msg
+                if msg.command == 'open_run':
+                    workspace.start_scan(result)
+                elif msg.command == 'close_run':
+                    workspace.end_scan()
+                elif msg.command == 'create':
+                    stream[0] = msg.kwargs.get('name', 'primary')
+                elif msg.command == 'save' and stream[0] == 'primary':
+                    workspace.point_done()
+                return result
+            if msg.command in ('open_run', 'close_run', 'create', 'save'):
+                return tracked(), None
+            return None, None
+
+        return (yield from plan_mutator(plan, account))
@@ -0,0 +1,27 @@
+import os
+import time
+
+import pytest
+
+from beamlinetools.simulation import load_rml
+
+RML_PATH = os.path.join(os.path.dirname(__file__), '..', '..', 'rml', 'elisa.rml')
+EXPORTS = ['DetectorAtFocus']
+
+
+def wait_until(condition, timeout:float=10., interval:float=0.02)->bool:
+    """Wait until ``condition()`` is true, return False after ``timeout`` seconds"""
+    end = time.monotonic()+timeout
+    while time.monotonic() < end:
+        if condition():
+            return True
+        time.sleep(interval)
+    return condition()
+
+
+@pytest.fixture
+def rml():
+    """The ELISA beamline, with few rays"""
+    rml = load_rml(RML_PATH)
+    rml.beamline.Dipole.numberRays.cdata = '2000'
+    return rml
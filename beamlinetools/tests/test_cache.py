@@ -0,0 +1,129 @@
+import os
+import json
+import shutil
+
+import numpy as np
+import pytest
+
+from beamlinetools.simulation import (SimulationCache, CachedSimulationEngine, FakeSimulationEngine,
+                                      ProgressiveSimulationEngine, load_rays, load_rml)
+
+from conftest import EXPORTS, RML_PATH
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return SimulationCache(str(tmp_path/'cache'))
+
+
+def simulate(engine, rml, folder, energy:float=None):
+    if energy is not None:
+        rml.beamline.Dipole.photonEnergy.cdata = str(energy)
+    engine.simulate(str(folder), rml, EXPORTS)
+    return engine._key(rml, EXPORTS)
+
+
+def read_index(cache)->dict:
+    with open(os.path.join(cache.cache_folder, cache.index_file)) as f:
+        return json.load(f)
+
+
+def test_hit(cache, rml, tmp_path):
+    fake = FakeSimulationEngine(seed=0)
+    engine = CachedSimulationEngine(fake, cache)
+    key = simulate(engine, rml, tmp_path/'first')
+    simulate(engine, rml, tmp_path/'second')
+    assert fake.simulations == 1
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1 and key in cache
+    first, second = (load_rays(str(tmp_path/name), 'DetectorAtFocus') for name in ('first', 'second'))
+    np.testing.assert_array_equal(first['EN'], second['EN'])
+
+
+def test_evict_least_recently_used_entries(tmp_path, rml):
+    cache = SimulationCache(str(tmp_path/'cache'), max_entries=2)
+    engine = CachedSimulationEngine(FakeSimulationEngine(seed=0), cache)
+    keys = [simulate(engine, rml, tmp_path/str(energy), energy) for energy in (500, 600)]
+    # the hit makes 500 eV the most recently used entry
+    simulate(engine, rml, tmp_path/'hit', 500)
+    keys.append(simulate(engine, rml, tmp_path/'700', 700))
+    assert len(cache) == 2
+    assert keys[0] in cache and keys[1] not in cache and keys[2] in cache
+    assert not os.path.exists(cache._entry_folder(keys[1]))
+
+
+def test_evict_above_max_size(tmp_path, rml):
+    cache = SimulationCache(str(tmp_path/'cache'))
+    engine = CachedSimulationEngine(FakeSimulationEngine(seed=0), cache)
+    keys = [simulate(engine, rml, tmp_path/'500', 500)]
+    cache.max_size = int(2.5*cache.size)
+    keys += [simulate(engine, rml, tmp_path/str(energy), energy) for energy in (600, 700)]
+    assert [key in cache for key in keys] == [False, True, True]
+    assert 0 < cache.size <= cache.max_size
+
+
+def test_index_writes_are_deferred(tmp_path, rml):
+    cache = SimulationCache(str(tmp_path/'cache'))
+    cache.index_save_interval = 3600
+    engine = CachedSimulationEngine(FakeSimulationEngine(seed=0), cache)
+    keys = [simulate(engine, rml, tmp_path/str(energy), energy) for energy in (500, 600)]
+    # each new entry is written at once
+    assert set(read_index(cache)) == set(keys)
+    saved = read_index(cache)[keys[0]]['last_access']
+    simulate(engine, rml, tmp_path/'hit', 500)
+    assert read_index(cache)[keys[0]]['last_access'] == saved
+    engine.shutdown()
+    assert read_index(cache)[keys[0]]['last_access'] > saved
+    # the order of the entries survives between sessions
+    reopened = SimulationCache(cache.cache_folder, max_entries=1)
+    assert keys[0] in reopened and keys[1] not in reopened
+
+
+def test_invalidate(cache, rml, tmp_path):
+    other_file = str(tmp_path/'other.rml')
+    shutil.copyfile(RML_PATH, other_file)
+    other = load_rml(other_file)
+    other.beamline.Dipole.numberRays.cdata = '2000'
+    engine = CachedSimulationEngine(FakeSimulationEngine(seed=0), cache)
+    keys = [simulate(engine, rml, tmp_path/str(energy), energy) for energy in (500, 600)]
+    other_key = simulate(engine, other, tmp_path/'other', 700)
+    assert cache.invalidate(rml.template) == 2
+    assert all(key not in cache for key in keys) and other_key in cache
+    assert not os.path.exists(cache._entry_folder(keys[0]))
+    assert cache.invalidate() == 1
+    assert len(cache) == 0 and read_index(cache) == {}
+
+
+def test_orphaned_folders(cache, rml, tmp_path):
+    fake = FakeSimulationEngine(seed=0)
+    engine = CachedSimulationEngine(fake, cache)
+    key = engine._key(rml, EXPORTS)
+    # a folder left by a crash, before the entry was written to the index
+    os.makedirs(cache._entry_folder(key))
+    with open(os.path.join(cache._entry_folder(key), 'DetectorAtFocus-partial.npy'), 'w'):
+        pass
+    simulate(engine, rml, tmp_path/'first')
+    assert key in cache and fake.simulations == 1
+    assert 'DetectorAtFocus-partial.npy' not in os.listdir(cache._entry_folder(key))
+    # an entry of the index whose folder was removed is a miss
+    shutil.rmtree(cache._entry_folder(key))
+    simulate(engine, rml, tmp_path/'second')
+    assert fake.simulations == 2 and cache.stats()['hits'] == 0
+    # and is dropped when the index is loaded
+    shutil.rmtree(cache._entry_folder(key))
+    assert key not in SimulationCache(cache.cache_folder)
+
+
+def test_key_depends_on_seed_and_precision(cache, rml):
+    def key(engine):
+        return CachedSimulationEngine(engine, cache)._key(rml, EXPORTS)
+    unseeded = key(FakeSimulationEngine())
+    seeded = key(FakeSimulationEngine(seed=1))
+    assert len({unseeded, seeded, key(FakeSimulationEngine(seed=2))}) == 3
+    assert seeded == key(FakeSimulationEngine(seed=1))
+    coarse = ProgressiveSimulationEngine(FakeSimulationEngine(seed=1), tolerance=0.1)
+    fine = ProgressiveSimulationEngine(FakeSimulationEngine(seed=1), tolerance=0.01)
+    try:
+        assert len({seeded, key(coarse), key(fine)}) == 3
+    finally:
+        coarse.shutdown()
+        fine.shutdown()
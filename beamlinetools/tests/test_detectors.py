@@ -0,0 +1,37 @@
+import types
+
+import pytest
+from bluesky import RunEngine
+from bluesky.plans import scan
+
+from beamlinetools.simulation import TwinOphydDevices, FakeSimulationEngine, source_element
+
+from conftest import RML_PATH
+
+
+class DipoleEngine(FakeSimulationEngine):
+    """Computes the photon flux of the source at its photon energy, as RAY-UI does for a Dipole"""
+    def run(self, path, rml_file, exports_list):
+        from raypyng.rml import RMLFile
+        rml = RMLFile(rml_file)
+        source = source_element(rml)
+        source.photonFlux.cdata = str(1e9*float(source.photonEnergy.cdata))
+        rml.write(rml_file)
+        return super().run(path, rml_file, exports_list)
+
+
+@pytest.mark.parametrize('lookahead', [False, True])
+def test_intensity_uses_the_simulated_flux(tmp_path, lookahead):
+    RE = RunEngine({}, context_managers=[])
+    ns = {}
+    twin = TwinOphydDevices(RE=RE, rml_path=RML_PATH, temporary_folder=str(tmp_path/'tmp'),
+                            name_space=types.SimpleNamespace(f_globals=ns),
+                            simulation_engine=DipoleEngine(seed=0, max_workers=2), lookahead=lookahead)
+    twin.rml.beamline.rp_Dipole.numberRays.cdata = '2000'
+    events = []
+    RE.subscribe(lambda name, doc: events.append(doc['data']) if name == 'event' else None)
+    RE(scan([ns['rp_DetectorAtFocus'].intensity], ns['rp_Dipole'].en, 500, 1500, 3))
+    assert len(events) == 3
+    for data, energy in zip(events, (500, 1000, 1500)):
+        # half of the rays reach the detector, the ring current is 3 times the current of the flux
+        assert data['rp_DetectorAtFocus_intensity[photons]'] == pytest.approx(3*0.5*1e9*energy)
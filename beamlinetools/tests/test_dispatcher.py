@@ -0,0 +1,76 @@
+import os
+import sys
+import signal
+import socket
+import subprocess
+
+import pytest
+
+from beamlinetools.simulation import SimulationDispatcher, load_rays
+
+from conftest import EXPORTS, wait_until
+
+pytestmark = pytest.mark.skipif(not hasattr(signal, 'SIGSTOP'), reason="needs POSIX signals")
+
+
+def free_port()->int:
+    with socket.create_server(('127.0.0.1', 0)) as listener:
+        return listener.getsockname()[1]
+
+
+def listening(port:int)->bool:
+    try:
+        socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+        return True
+    except OSError:
+        return False
+
+
+@pytest.fixture
+def workers():
+    """Three ``worker --engine fake`` processes on localhost, with 2 slots each"""
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    ports = [free_port() for _ in range(3)]
+    processes = [subprocess.Popen([sys.executable, '-m', 'beamlinetools.simulation', 'worker', '--engine', 'fake',
+                                   '--delay', '0.5', '--workers', '2', '--port', str(port)], env=env)
+                 for port in ports]
+    try:
+        assert all(wait_until(lambda port=port: listening(port), timeout=30) for port in ports)
+        yield ports, processes
+    finally:
+        for process in processes:
+            process.send_signal(signal.SIGCONT)
+            process.kill()
+            process.wait()
+
+
+def test_lost_workers(workers, rml, tmp_path):
+    ports, processes = workers
+    dispatcher = SimulationDispatcher([f'127.0.0.1:{port}' for port in ports], heartbeat_interval=0.2,
+                                      heartbeat_timeout=1.5, reconnect_interval=60)
+    try:
+        assert dispatcher.max_workers == 6
+        futures = []
+        for i in range(12):
+            rml.beamline.Dipole.photonEnergy.cdata = str(500+100*i)
+            futures.append(dispatcher.submit(str(tmp_path/str(i)), rml, EXPORTS))
+        names = list(dispatcher.stats()['workers'])
+        assert wait_until(lambda: all(w['running'] == 2 for w in dispatcher.stats()['workers'].values()))
+        # one worker dies, another one hangs with its connection open
+        processes[0].kill()
+        processes[1].send_signal(signal.SIGSTOP)
+        for future in futures:
+            future.result(timeout=60)
+        stats = dispatcher.stats()
+        assert stats['resubmitted'] >= 4
+        assert stats['workers'][names[0]]['lost'] == 1
+        # only the heartbeat timeout finds the hanging worker
+        assert stats['workers'][names[1]]['lost'] == 1
+        assert not stats['workers'][names[0]]['alive'] and not stats['workers'][names[1]]['alive']
+        assert stats['workers'][names[2]]['alive']
+        assert sum(w['done'] for w in stats['workers'].values()) >= 12
+        for i in range(12):
+            rays = load_rays(str(tmp_path/str(i)), 'DetectorAtFocus')
+            assert abs(rays['EN'].mean()-(500+100*i)) < 1
+    finally:
+        dispatcher.shutdown()
@@ -0,0 +1,55 @@
+import time
+import types
+import threading
+
+import pytest
+from bluesky import RunEngine
+from bluesky.plans import scan
+from bluesky.utils import RunEngineInterrupted
+
+from beamlinetools.simulation import TwinOphydDevices, FakeSimulationEngine
+
+from conftest import RML_PATH, wait_until
+
+
+def test_pause_and_resume_with_lookahead(tmp_path):
+    RE = RunEngine({}, context_managers=[])
+    ns = {}
+    fake = FakeSimulationEngine(delay=0.3, seed=0, max_workers=2)
+    twin = TwinOphydDevices(RE=RE, rml_path=RML_PATH, temporary_folder=str(tmp_path/'tmp'),
+                            name_space=types.SimpleNamespace(f_globals=ns), simulation_engine=fake, lookahead=True)
+    twin.rml.beamline.rp_Dipole.numberRays.cdata = '2000'
+    engine = twin.simulation_engine
+    events = []
+    RE.subscribe(lambda name, doc: events.append(doc['data']) if name == 'event' else None)
+
+    def run():
+        with pytest.raises(RunEngineInterrupted):
+            RE(scan([ns['rp_DetectorAtFocus'].intensity], ns['rp_Dipole'].en, 500, 1400, 10))
+    thread = threading.Thread(target=run)
+    thread.start()
+    try:
+        assert wait_until(lambda: len(events) > 0, timeout=30)
+        RE.request_pause()
+        assert wait_until(lambda: RE.state == 'paused', timeout=30)
+        thread.join(timeout=30)
+        # the prefetched points are cancelled, and the workers stay idle while the scan is paused
+        paused = engine.stats()
+        assert 0 < paused['pending'] < 10 and len(events) < 10
+        simulations = fake.simulations
+        time.sleep(1)
+        assert fake.simulations == simulations
+        # the points that are still needed are submitted again
+        RE.resume()
+    finally:
+        if RE.state == 'paused':
+            RE.halt()
+        twin.simulation_engine.shutdown()
+    assert RE.state == 'idle'
+    assert [data['rp_Dipole_en'] for data in events] == pytest.approx(list(range(500, 1500, 100)))
+    assert all(data['rp_DetectorAtFocus_intensity[photons]'] > 0 for data in events)
+    stats = engine.stats()
+    assert stats['pending'] == 0
+    # the point triggered again after the pause may be simulated without the look-ahead
+    assert stats['hits'] >= 9 and stats['hits']+stats['misses'] >= 10
+    assert simulations < fake.simulations <= 11
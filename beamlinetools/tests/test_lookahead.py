@@ -0,0 +1,64 @@
+import types
+import logging
+
+import pytest
+from bluesky import RunEngine
+from bluesky.plans import scan, grid_scan, list_grid_scan, rel_grid_scan, list_scan
+
+from beamlinetools.simulation import TwinOphydDevices, NumpySimulationEngine, LookAheadSimulationEngine
+
+from conftest import RML_PATH
+
+PLANS = {
+    'scan': lambda dets, en, angle: scan(dets, en, 500, 1500, 4),
+    'grid_scan': lambda dets, en, angle: grid_scan(dets, en, 800, 1200, 3, angle, 1.5, 1.7, 2),
+    'snaked_list_grid_scan': lambda dets, en, angle: list_grid_scan(dets, en, [900, 1000, 1100],
+                                                                   angle, [1.55, 1.6, 1.65], snake_axes=True),
+    'rel_grid_scan': lambda dets, en, angle: rel_grid_scan(dets, en, -100, 100, 3, angle, -0.05, 0.05, 2),
+    # the look-ahead does not know the trajectory of this pattern, every point is a miss
+    'unknown_pattern': lambda dets, en, angle: list_scan(dets, en, [700, 900, 700], md={'plan_pattern': 'custom'}),
+}
+
+
+def run_twin(tmp_path, plan, lookahead:bool):
+    RE = RunEngine({}, context_managers=[])
+    ns = {}
+    twin = TwinOphydDevices(RE=RE, rml_path=RML_PATH, temporary_folder=str(tmp_path/str(lookahead)),
+                            name_space=types.SimpleNamespace(f_globals=ns),
+                            simulation_engine=NumpySimulationEngine(seed=1), lookahead=lookahead)
+    twin.rml.beamline.rp_Dipole.numberRays.cdata = '2000'
+    events = []
+    RE.subscribe(lambda name, doc: events.append(doc['data']) if name == 'event' else None)
+    det = ns['rp_DetectorAtFocus']
+    RE(plan([det.intensity, det.hor_foc], ns['rp_Dipole'].en, ns['rp_KB2'].grazingIncAngle))
+    return events, twin.simulation_engine
+
+
+@pytest.mark.parametrize('name', PLANS)
+def test_prefetched_points_give_the_same_events(tmp_path, name):
+    expected, _ = run_twin(tmp_path, PLANS[name], lookahead=False)
+    events, engine = run_twin(tmp_path, PLANS[name], lookahead=True)
+    assert isinstance(engine, LookAheadSimulationEngine)
+    assert len(events) == len(expected) > 0
+    for data, expected_data in zip(events, expected):
+        assert data == pytest.approx(expected_data)
+    intensities = {data['rp_DetectorAtFocus_intensity[photons]'] for data in events}
+    assert len(intensities) > 1
+    stats = engine.stats()
+    if name == 'unknown_pattern':
+        assert stats['hits'] == 0 and stats['misses'] == len(events)
+    else:
+        assert stats['hits'] == len(events) and stats['misses'] == 0
+    assert stats['pending'] == 0
+
+
+def test_turned_off_without_submit(tmp_path, caplog):
+    # the default engine of raypyng-bluesky simulates in the RunEngine thread
+    ns = {}
+    with caplog.at_level(logging.WARNING):
+        twin = TwinOphydDevices(RE=RunEngine({}, context_managers=[]), rml_path=RML_PATH,
+                                temporary_folder=str(tmp_path/'tmp'), name_space=types.SimpleNamespace(f_globals=ns),
+                                lookahead=True)
+    assert not twin.lookahead
+    assert not isinstance(twin.simulation_engine, LookAheadSimulationEngine)
+    assert 'look-ahead' in caplog.text
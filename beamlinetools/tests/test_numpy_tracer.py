@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+from beamlinetools.simulation import (NumpySimulationEngine, run_numpy_simulation, load_rays, ray_statistics,
+                                      detector_statistics, source_flux)
+
+from conftest import EXPORTS
+
+COLUMNS = ('OX', 'OY', 'OZ', 'DX', 'DY', 'DZ', 'EN')
+
+
+def simulate(rml, path, seed=1, exports=EXPORTS, **kwargs):
+    rml_file = NumpySimulationEngine().write_rml(str(path), rml)
+    run_numpy_simulation(str(path), rml_file, exports, seed=seed, **kwargs)
+    return {exp: load_rays(str(path), exp) for exp in exports}
+
+
+def assert_same_rays(a, b):
+    assert len(a) == len(b)
+    for column in COLUMNS:
+        np.testing.assert_array_equal(a[column], b[column])
+
+
+def test_seeded_simulations_are_reproducible(rml, tmp_path):
+    exports = ['M1', 'DetectorAtFocus']
+    first = simulate(rml, tmp_path/'first', exports=exports)
+    second = simulate(rml, tmp_path/'second', exports=exports)
+    for exp in exports:
+        assert len(first[exp]) > 0
+        assert_same_rays(first[exp], second[exp])
+    other = simulate(rml, tmp_path/'other', seed=2, exports=exports)
+    assert not np.array_equal(first['M1']['OX'], other['M1']['OX'])
+
+
+def test_processes_give_the_same_rays(rml, tmp_path):
+    expected = simulate(rml, tmp_path/'expected')['DetectorAtFocus']
+    engine = NumpySimulationEngine(seed=1, max_workers=2)
+    try:
+        futures = [engine.submit(str(tmp_path/str(i)), rml, EXPORTS) for i in range(2)]
+        for i, future in enumerate(futures):
+            future.result(timeout=60)
+            assert_same_rays(load_rays(str(tmp_path/str(i)), 'DetectorAtFocus'), expected)
+    finally:
+        engine.shutdown()
+
+
+def test_bundle_cache_gives_the_same_rays(rml, tmp_path):
+    engine = NumpySimulationEngine(seed=1)
+    engine.simulate(str(tmp_path/'first'), rml, EXPORTS)
+    # only the last mirror moves, the rays leaving the elements before it come from the cache
+    rml.beamline.KB2.grazingIncAngle.cdata = str(float(rml.beamline.KB2.grazingIncAngle.cdata)+0.01)
+    engine.simulate(str(tmp_path/'cached'), rml, EXPORTS)
+    assert engine.bundle_cache.hits == 1 and engine.bundle_cache.elements_skipped > 0
+    expected = simulate(rml, tmp_path/'expected')['DetectorAtFocus']
+    assert_same_rays(load_rays(str(tmp_path/'cached'), 'DetectorAtFocus'), expected)
+
+
+def test_intensity(rml, tmp_path):
+    rays = simulate(rml, tmp_path)['DetectorAtFocus']
+    flux, nrays = source_flux(rml)
+    statistics = detector_statistics(rays, (flux, nrays))
+    assert 0 < len(rays) < nrays
+    assert statistics['intensity'] == pytest.approx(3*flux*len(rays)/nrays)
+
+
+def test_exit_slit(rml, tmp_path):
+    # the exit slit selects the bandwidth of the monochromator, and the KB mirrors image it on the detector
+    rml.beamline.Dipole.numberRays.cdata = '50000'
+    energy = float(rml.beamline.Dipole.photonEnergy.cdata)
+    results = []
+    for height in (0.1, 0.05, 0.02):
+        rml.beamline.ExitSlit.totalHeight.cdata = str(height)
+        rays = simulate(rml, tmp_path/str(height))['DetectorAtFocus']
+        np.testing.assert_array_equal(rays['OZ'], 0)
+        statistics = ray_statistics(rays, ('OY', 'EN'), 10**6)
+        assert statistics['EN']['mean'] == pytest.approx(energy, abs=0.1)
+        results.append((len(rays), statistics['EN']['fwhm'], statistics['OY']['fwhm']))
+    for wide, narrow in zip(results[:-1], results[1:]):
+        assert narrow[0] < wide[0]
+        assert narrow[1] < wide[1]
+        assert narrow[2] < wide[2]
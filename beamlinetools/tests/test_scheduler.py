@@ -0,0 +1,151 @@
+import types
+import threading
+from concurrent.futures import CancelledError
+
+import pytest
+from bluesky import RunEngine
+from bluesky import plan_stubs as bps
+from bluesky.plans import scan, count
+
+from beamlinetools.simulation import (SimulationScheduler, SchedulerPreprocessor, ScheduledRun, FakeSimulationEngine,
+                                      TwinOphydDevices, scheduled_run, current_run)
+
+from conftest import EXPORTS, RML_PATH, wait_until
+
+
+@pytest.fixture
+def schedulers():
+    schedulers = []
+    yield schedulers
+    for scheduler in schedulers:
+        scheduler.shutdown()
+
+
+def submit(scheduler, rml, folder, run:ScheduledRun=None, done:list=None):
+    with scheduled_run(run):
+        future = scheduler.submit(str(folder), rml, EXPORTS)
+    if done is not None:
+        future.add_done_callback(lambda f: done.append(folder.name))
+    return future
+
+
+def test_interactive_jumps_the_queue(schedulers, rml, tmp_path):
+    scheduler = SimulationScheduler(FakeSimulationEngine(delay=0.2), interactive_slots=1)
+    schedulers.append(scheduler)
+    # a single slot, it cannot be kept for the interactive simulations
+    assert scheduler.max_running == 1 and scheduler.interactive_slots == 0
+    batch, interactive, done = ScheduledRun('batch'), ScheduledRun('interactive'), []
+    futures = [submit(scheduler, rml, tmp_path/f'batch{i}', batch, done) for i in range(3)]
+    assert wait_until(lambda: scheduler.stats()['batch']['running'] == 1)
+    futures.append(submit(scheduler, rml, tmp_path/'ct', interactive, done))
+    for future in futures:
+        future.result(timeout=30)
+    assert done == ['batch0', 'ct', 'batch1', 'batch2']
+    stats = scheduler.stats()
+    assert stats['batch']['submitted'] == stats['batch']['done'] == 3
+    assert stats['interactive']['submitted'] == stats['interactive']['done'] == 1
+    assert stats['interactive']['max_wait'] < stats['batch']['max_wait']
+
+
+def test_interactive_slots(schedulers, rml, tmp_path):
+    scheduler = SimulationScheduler(FakeSimulationEngine(delay=0.5, max_workers=3), interactive_slots=1)
+    schedulers.append(scheduler)
+    assert scheduler.max_running == 3
+    batch = ScheduledRun('batch')
+    futures = [submit(scheduler, rml, tmp_path/f'batch{i}', batch) for i in range(4)]
+    assert wait_until(lambda: scheduler.stats()['batch']['running'] == 2)
+    # the third slot stays free for the interactive simulations
+    stats = scheduler.stats()
+    assert stats['batch']['queued'] == 2 and stats['batch']['running'] == 2
+    futures.append(submit(scheduler, rml, tmp_path/'ct', ScheduledRun('interactive')))
+    assert wait_until(lambda: scheduler.stats()['interactive']['running'] == 1, timeout=0.3)
+    for future in futures:
+        future.result(timeout=30)
+    assert scheduler.stats()['interactive']['max_wait'] < 0.3
+
+
+def test_cancel_run(schedulers, rml, tmp_path):
+    scheduler = SimulationScheduler(FakeSimulationEngine(delay=0.3))
+    schedulers.append(scheduler)
+    first, second = ScheduledRun('batch'), ScheduledRun('batch')
+    first.uid, second.uid = 'first', 'second'
+    futures = {run.uid: [submit(scheduler, rml, tmp_path/f'{run.uid}{i}', run) for i in range(3)]
+               for run in (first, second)}
+    assert wait_until(lambda: scheduler.stats()['batch']['running'] == 1)
+    # the running simulation of the first run is not interrupted
+    assert scheduler.cancel(uid='first') == 2
+    futures['first'][0].result(timeout=30)
+    for future in futures['first'][1:]:
+        with pytest.raises(CancelledError):
+            future.result()
+    for future in futures['second']:
+        future.result(timeout=30)
+    stats = scheduler.stats()['batch']
+    assert stats['cancelled'] == 2 and stats['done'] == 4 and stats['queued'] == 0
+
+
+def test_cancel_priority(schedulers, rml, tmp_path):
+    scheduler = SimulationScheduler(FakeSimulationEngine(delay=0.3))
+    schedulers.append(scheduler)
+    batch = [submit(scheduler, rml, tmp_path/f'batch{i}', ScheduledRun('batch')) for i in range(3)]
+    assert wait_until(lambda: scheduler.stats()['batch']['running'] == 1)
+    ct = submit(scheduler, rml, tmp_path/'ct', ScheduledRun('interactive'))
+    assert scheduler.cancel(priority='batch') == 2
+    ct.result(timeout=30)
+    assert scheduler.stats()['interactive']['done'] == 1
+    assert [future.cancelled() for future in batch] == [False, True, True]
+
+
+def test_preprocessor(schedulers, rml, tmp_path):
+    scheduler = SimulationScheduler(FakeSimulationEngine())
+    schedulers.append(scheduler)
+    RE = RunEngine({}, context_managers=[])
+    RE.preprocessors.append(SchedulerPreprocessor('interactive'))
+    runs = []
+
+    def plan():
+        for i in range(2):
+            uid = yield from bps.open_run()
+            runs.append((uid, current_run()))
+            scheduler.submit(str(tmp_path/str(i)), rml, EXPORTS).result(timeout=30)
+            yield from bps.close_run()
+
+    uids = RE(plan())
+    assert [uid for uid, run in runs] == list(uids)
+    # a new run after each close_run, with the uid of the run
+    assert runs[0][1] is not runs[1][1]
+    assert all(run.uid == uid and run.priority == 'interactive' for uid, run in runs)
+    assert scheduler.stats()['interactive']['done'] == 2 and scheduler.stats()['batch']['submitted'] == 0
+    # outside of the plans the simulations are batch
+    submit(scheduler, rml, tmp_path/'outside').result(timeout=30)
+    assert scheduler.stats()['batch']['done'] == 1
+
+
+def test_count_during_a_scan(tmp_path):
+    RE = RunEngine({}, context_managers=[])
+    magics_RE = RunEngine({}, context_managers=[])
+    ns = {}
+    twin = TwinOphydDevices(RE=RE, rml_path=RML_PATH, temporary_folder=str(tmp_path/'tmp'),
+                            name_space=types.SimpleNamespace(f_globals=ns),
+                            simulation_engine=FakeSimulationEngine(delay=0.2, seed=0, max_workers=2),
+                            lookahead=True, scheduler=True)
+    twin.rml.beamline.rp_Dipole.numberRays.cdata = '2000'
+    twin.attach(magics_RE)
+    det = ns['rp_DetectorAtFocus'].intensity
+    events = {'scan': [], 'count': []}
+    RE.subscribe(lambda name, doc: events['scan'].append(doc['data']) if name == 'event' else None)
+    try:
+        thread = threading.Thread(target=RE, args=(scan([det], ns['rp_Dipole'].en, 500, 1400, 10),))
+        thread.start()
+        assert wait_until(lambda: len(events['scan']) > 0, timeout=30)
+        magics_RE(count([det]), lambda name, doc: events['count'].append(doc['data']) if name == 'event' else None)
+        # the count ran while the scan was running
+        assert RE.state == 'running'
+        thread.join(timeout=60)
+    finally:
+        twin.simulation_engine.shutdown()
+    assert len(events['scan']) == 10 and len(events['count']) == 1
+    assert events['count'][0]['rp_DetectorAtFocus_intensity[photons]'] > 0
+    stats = twin.scheduler.stats()
+    assert stats['interactive']['done'] == 1 and stats['batch']['done'] == 10
+    assert twin.simulation_engine.stats()['hits'] == 10
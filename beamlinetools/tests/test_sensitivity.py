@@ -0,0 +1,58 @@
+import types
+
+import numpy as np
+import pytest
+from bluesky import RunEngine
+
+from beamlinetools.simulation import (TwinOphydDevices, FakeSimulationEngine, sensitivity_scan, submit_configurations,
+                                      sensitivity_configurations, rml_parameter)
+
+from conftest import RML_PATH
+
+
+class SingleInstanceEngine():
+    """Like the default 'rayui' engine of raypyng-bluesky: no ``submit``, and set up before simulating"""
+    def __init__(self):
+        self.backend = None
+
+    def setup_simulation(self):
+        self.backend = FakeSimulationEngine(seed=0)
+        return self
+
+    def simulate(self, path, rml, exports_list):
+        return self.backend.simulate(path, rml, exports_list)
+
+
+def test_sensitivity_scan_on_the_default_engine(tmp_path):
+    RE = RunEngine({}, context_managers=[], call_returns_result=True)
+    ns = {}
+    twin = TwinOphydDevices(RE=RE, rml_path=RML_PATH, temporary_folder=str(tmp_path/'tmp'),
+                            name_space=types.SimpleNamespace(f_globals=ns), simulation_engine=SingleInstanceEngine())
+    twin.rml.beamline.rp_Dipole.numberRays.cdata = '2000'
+    events = {}
+    RE.subscribe(lambda name, doc: events.setdefault(doc['descriptor'], []).append(doc) if name == 'event' else None)
+    motors = [ns['rp_M1'].rx, ns['rp_KB1'].grazingIncAngle]
+    result = RE(sensitivity_scan([ns['rp_DetectorAtFocus']], motors, 0.01, twin=twin)).plan_result
+    # the current position, and each motor moved by +step and -step
+    assert sorted(len(docs) for docs in events.values()) == [2, 5]
+    assert result['matrix'].shape == (4, 2) and np.all(np.isfinite(result['matrix']))
+    assert twin.simulation_engine.backend.simulations == 5
+
+
+def test_submit_configurations_is_deprecated(tmp_path):
+    ns = {}
+    twin = TwinOphydDevices(RE=RunEngine({}, context_managers=[]), rml_path=RML_PATH,
+                            temporary_folder=str(tmp_path/'tmp'), name_space=types.SimpleNamespace(f_globals=ns),
+                            simulation_engine=FakeSimulationEngine(seed=0))
+    twin.rml.beamline.rp_Dipole.numberRays.cdata = '2000'
+    params = [rml_parameter(ns['rp_M1'].rx)]
+    saved = params[0].cdata
+    configurations = sensitivity_configurations(1)
+    folders = [str(tmp_path/str(i)) for i in range(len(configurations))]
+    with pytest.warns(DeprecationWarning):
+        jobs = submit_configurations(twin.simulation_engine, twin.rml, params, [0.01], configurations,
+                                     ['DetectorAtFocus'], folders)
+    assert [folder for _, folder, _ in jobs] == folders
+    for future, _, _ in jobs:
+        future.result(timeout=30)
+    assert params[0].cdata == saved
@@ -0,0 +1,142 @@
+import os
+import socket
+import asyncio
+import threading
+from concurrent.futures import wait, FIRST_COMPLETED, CancelledError
+
+import pytest
+
+from beamlinetools.simulation import SimulationServer, SimulationClient, FakeSimulationEngine, load_rays, unpack_files
+
+from conftest import EXPORTS, wait_until
+
+
+@pytest.fixture
+def start_server():
+    """Start servers with a fake engine, in an event loop running in a background thread"""
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    servers = []
+
+    def start(delay:float=0., max_jobs:int=2, **kwargs):
+        server = SimulationServer(FakeSimulationEngine(delay=delay, seed=0), port=0, max_jobs=max_jobs, **kwargs)
+        asyncio.run_coroutine_threadsafe(server.start(), loop).result()
+        servers.append(server)
+        return server
+    yield start
+    for server in servers:
+        asyncio.run_coroutine_threadsafe(server.stop(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+
+
+@pytest.fixture
+def clients():
+    clients = []
+    yield clients
+    for client in clients:
+        client.shutdown()
+
+
+def submit_points(client, rml, tmp_path, n:int)->list:
+    # the points of a scan of the photon energy, each in its own folder
+    futures = []
+    for i in range(n):
+        rml.beamline.Dipole.photonEnergy.cdata = str(500+100*i)
+        futures.append(client.submit(str(tmp_path/str(i)), rml, EXPORTS))
+    return futures
+
+
+def test_batch_in_one_round_trip(start_server, clients, rml, tmp_path):
+    server = start_server(max_jobs=4)
+    client = SimulationClient(port=server.port, batch_window=0.2)
+    clients.append(client)
+    futures = submit_points(client, rml, tmp_path, 6)
+    for future in futures:
+        future.result(timeout=30)
+    assert client.stats() == {'round_trips': 1, 'pending': 0}
+    assert server.stats()['done'] == 6
+    for i in range(6):
+        rays = load_rays(str(tmp_path/str(i)), 'DetectorAtFocus')
+        assert len(rays) == 1000
+        assert abs(rays['EN'].mean()-(500+100*i)) < 1
+
+
+def test_results_streamed(start_server, clients, rml, tmp_path):
+    server = start_server(delay=0.3, max_jobs=1)
+    client = SimulationClient(port=server.port)
+    clients.append(client)
+    futures = submit_points(client, rml, tmp_path, 3)
+    done, pending = wait(futures, timeout=30, return_when=FIRST_COMPLETED)
+    # the first result comes back while the server still simulates the others
+    assert len(done) == 1 and len(pending) == 2
+    assert os.listdir(tmp_path/'0')
+    for future in futures:
+        future.result(timeout=30)
+    assert client.stats()['round_trips'] == 1
+
+
+def test_cancel(start_server, clients, rml, tmp_path):
+    server = start_server(delay=0.5, max_jobs=1)
+    client = SimulationClient(port=server.port)
+    clients.append(client)
+    futures = submit_points(client, rml, tmp_path, 4)
+    assert wait_until(lambda: server.jobs_running == 1)
+    assert client.cancel() == 4
+    for future in futures:
+        with pytest.raises(CancelledError):
+            future.result()
+    # the running job ends, the others are dropped before they start
+    assert wait_until(lambda: server.stats()['done']+server.stats()['cancelled'] == 4)
+    assert server.stats()['cancelled'] == 3
+    assert client.stats()['pending'] == 0
+
+
+def test_server_disconnect(clients, rml, tmp_path):
+    # a server closing the connection before sending the results
+    listener = socket.create_server(('127.0.0.1', 0))
+    port = listener.getsockname()[1]
+
+    def serve():
+        connection, address = listener.accept()
+        connection.recv(1024)
+        connection.close()
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    client = SimulationClient(port=port)
+    clients.append(client)
+    futures = submit_points(client, rml, tmp_path, 2)
+    for future in futures:
+        with pytest.raises(ConnectionError):
+            future.result(timeout=10)
+    thread.join()
+    listener.close()
+    assert client.stats()['pending'] == 0
+
+
+def test_server_not_running(clients, rml, tmp_path):
+    with socket.create_server(('127.0.0.1', 0)) as listener:
+        port = listener.getsockname()[1]
+    client = SimulationClient(port=port)
+    clients.append(client)
+    with pytest.raises(ConnectionError):
+        submit_points(client, rml, tmp_path, 1)[0].result(timeout=10)
+
+
+def test_token(start_server, clients, rml, tmp_path):
+    server = start_server(token='secret')
+    client = SimulationClient(port=server.port, token='secret')
+    clients.append(client)
+    submit_points(client, rml, tmp_path/'good', 1)[0].result(timeout=30)
+    intruder = SimulationClient(port=server.port, token='guess')
+    clients.append(intruder)
+    with pytest.raises(ConnectionError):
+        submit_points(intruder, rml, tmp_path/'bad', 1)[0].result(timeout=10)
+    assert server.stats()['done'] == 1
+
+
+@pytest.mark.parametrize('name', ['../escape.dat', '/tmp/escape.dat', 'sub/escape.dat', '..', ''])
+def test_unsafe_file_names(tmp_path, name):
+    with pytest.raises(ValueError):
+        unpack_files(str(tmp_path), [[name, 3]], b'abc')